@@ -1,9 +1,12 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import pandas as pd
 import numpy as np
 import plotly.express as px
+import plotly.graph_objects as go
 from datetime import datetime, timedelta
 import io
+import json
 import zipfile
 from fpdf import FPDF
 import matplotlib.pyplot as plt
@@ -16,6 +19,12 @@ import getpass
 from PIL import Image
 from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode, ColumnsAutoSizeMode
 import math
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo de archivos entre procesos
+    fcntl = None
 
 # === NUEVA CLASE PARA ENTORNO DE USUARIO ===
 class UserEnvironment:
@@ -241,8 +250,7 @@ def obtener_info_semana_actual(df_combinado):
     try:
         # Obtener la columna de fecha (asumiendo que está en la posición 13)
         columna_fecha = df_combinado.columns[13]
-        df_combinado[columna_fecha] = pd.to_datetime(df_combinado[columna_fecha], errors='coerce')
-        fecha_max = df_combinado[columna_fecha].max()
+        fecha_max = pd.to_datetime(df_combinado[columna_fecha], errors='coerce').max()
         
         if pd.isna(fecha_max):
             return None, None, None
@@ -273,9 +281,57 @@ def obtener_info_semana_actual(df_combinado):
         print(f"Error en obtener_info_semana_actual: {e}")
         return None, None, None
 
+class CalendarioSemanas:
+    """Calendario de semanas del informe (cierre en viernes), calculado una vez por conjunto de datos.
+    
+    Guarda la semana actual (número, viernes y texto), los viernes desde FECHA_REFERENCIA,
+    sus números y etiquetas, y una tabla día → semana para asignar fechas sin aritmética.
+    """
+    def __init__(self, df_combinado):
+        self.num_semana, self.fecha_max_str, self.fecha_max = obtener_info_semana_actual(df_combinado)
+        
+        if self.fecha_max is None:
+            fechas = pd.DatetimeIndex([])
+        else:
+            fechas = pd.date_range(start=FECHA_REFERENCIA, end=self.fecha_max, freq='W-FRI')
+        
+        dias_viernes = (fechas - FECHA_REFERENCIA).days.to_numpy()
+        self.semanas = fechas.tolist()
+        self.numeros = dias_viernes // 7 + 1
+        self.etiquetas = [
+            f"Semana {numero} ({fecha.strftime('%d/%m/%Y')})" for numero, fecha in zip(self.numeros, self.semanas)
+        ]
+        # Día desde FECHA_REFERENCIA → posición del viernes que cierra su semana
+        self.semana_por_dia = np.searchsorted(dias_viernes, np.arange(dias_viernes[-1] + 1 if len(dias_viernes) else 0))
+    
+    def info_semana_actual(self):
+        """(num_semana, fecha_max_str, fecha_max) como obtener_info_semana_actual"""
+        return self.num_semana, self.fecha_max_str, self.fecha_max
+    
+    def numero_semana(self, posicion):
+        """Número de semana del viernes en la posición `posicion` de `semanas`"""
+        return int(self.numeros[posicion])
+    
+    def posicion_semana(self, fechas):
+        """Posición en `semanas` de la semana de cada fecha (-1 fuera del calendario)"""
+        dias = (pd.to_datetime(pd.Series(fechas), errors='coerce') - FECHA_REFERENCIA).dt.days.to_numpy(dtype=float)
+        dentro = ~np.isnan(dias) & (dias >= 0) & (dias < len(self.semana_por_dia))
+        posiciones = np.full(len(dias), -1, dtype=np.int64)
+        posiciones[dentro] = self.semana_por_dia[dias[dentro].astype(np.int64)]
+        return posiciones
+
+def obtener_calendario_semanas(df_combinado):
+    """Calendario de semanas de la sesión, asociado al DataFrame del que sale (otros datos, otro calendario)"""
+    registro = st.session_state.get('calendario_semanas')
+    if registro is None or registro[0] is not df_combinado:
+        registro = (df_combinado, CalendarioSemanas(df_combinado))
+        st.session_state['calendario_semanas'] = registro
+    return registro[1]
+
 # Mostrar información de la semana actual en todas las páginas
 if "df_combinado" in st.session_state:
-    num_semana, fecha_max_str, fecha_max = obtener_info_semana_actual(st.session_state["df_combinado"])
+    calendario_semanas = obtener_calendario_semanas(st.session_state["df_combinado"])
+    num_semana, fecha_max_str, fecha_max = calendario_semanas.info_semana_actual()
     if num_semana and fecha_max_str:
         st.title(f"📊 Seguimiento Equipo Regional RECTAUTO - Semana {num_semana} a {fecha_max_str}")
     else:
@@ -303,7 +359,7 @@ class PDF(FPDF):
         self.set_font('Arial', 'I', 6)
         self.cell(0, 5, f'Página {self.page_no()}', 0, 0, 'C')
     
-    def aplicar_formato_condicional_pdf(self, df_original, idx, col_name, col_width, altura_fila, x, y):
+    def aplicar_formato_condicional_pdf(self, df_original, idx, col_name, col_width, altura_fila, x, y, es_prioritaria=False):
         """Aplica formato condicional a celdas específicas en el PDF con NUEVAS condiciones"""
         try:
             if idx >= len(df_original):
@@ -324,41 +380,9 @@ class PDF(FPDF):
                         self.rect(x, y, col_width, altura_fila, 'F')
                         self.set_fill_color(255, 255, 255)
             
-            # Condición 2: RUE con MÚLTIPLES condiciones específicas
+            # Condición 2: RUE prioritario (flags de prioridad precalculados)
             elif col_name == 'RUE':
-                etiq_penultimo = fila.get('ETIQ. PENÚLTIMO TRAM.', '')
-                fecha_notif = fila.get('FECHA NOTIFICACIÓN', None)
-                docum_incorp = fila.get('DOCUM.INCORP.', '')
-                
-                es_amarillo = False
-                
-                # CONDICIÓN 2.1: "80 PROPRES" con fecha límite superada
-                if (str(etiq_penultimo).strip() == "80 PROPRES" and 
-                    pd.notna(fecha_notif) and 
-                    isinstance(fecha_notif, (pd.Timestamp, datetime))):
-                    
-                    fecha_limite = fecha_notif + timedelta(days=23)
-                    if datetime.now() > fecha_limite:
-                        es_amarillo = True
-                
-                # NUEVA CONDICIÓN 2.2: "50 REQUERIR" con fecha límite superada
-                elif (str(etiq_penultimo).strip() == "50 REQUERIR" and 
-                    pd.notna(fecha_notif) and 
-                    isinstance(fecha_notif, (pd.Timestamp, datetime))):
-                    
-                    fecha_limite = fecha_notif + timedelta(days=23)
-                    if datetime.now() > fecha_limite:
-                        es_amarillo = True
-                
-                # NUEVA CONDICIÓN 2.3: "70 ALEGACI" o "60 CONTESTA"
-                elif str(etiq_penultimo).strip() in ["70 ALEGACI", "60 CONTESTA"]:
-                    es_amarillo = True
-                
-                # NUEVA CONDICIÓN 2.4: DOCUM.INCORP. no vacío Y distinto de "SOLICITUD" o "REITERA SOLICITUD"
-                elif (pd.notna(docum_incorp) and 
-                    str(docum_incorp).strip() != '' and
-                    str(docum_incorp).strip().upper() not in ["SOLICITUD", "REITERA SOLICITUD"]):
-                    es_amarillo = True
+                es_amarillo = es_prioritaria
                 
                 if es_amarillo:
                     # Fondo amarillo cuando se cumple alguna condición
@@ -510,6 +534,26 @@ def cargar_y_procesar_usuarios(archivo, _user_key=user_env.session_id):
         st.error(f"Error procesando USUARIOS: {e}")
         return None
 
+@st.cache_data(ttl=CACHE_TTL)
+def cargar_historico_usuarios(archivo, _user_key=user_env.session_id):
+    """Carga las hojas opcionales PERIODOS y BAJAS del archivo USUARIOS (altas por equipo y bajas con fechas)"""
+    historico = {'periodos': None, 'bajas': None}
+    try:
+        archivo.seek(0)
+        libro = pd.ExcelFile(archivo)
+        hojas = {nombre.upper().strip(): nombre for nombre in libro.sheet_names}
+        for clave, hoja in (('periodos', 'PERIODOS'), ('bajas', 'BAJAS')):
+            if hoja in hojas:
+                df_hoja = libro.parse(hojas[hoja])
+                df_hoja.columns = [str(col).upper().strip() for col in df_hoja.columns]
+                historico[clave] = df_hoja
+        return historico
+    except Exception as e:
+        st.warning(f"⚠️ No se pudieron leer las hojas PERIODOS/BAJAS de USUARIOS: {e}")
+        return historico
+    finally:
+        archivo.seek(0)
+
 @st.cache_data(ttl=CACHE_TTL)
 def cargar_y_procesar_documentos(archivo, _user_key=user_env.session_id):
     """Carga y procesa el archivo DOCUMENTOS"""
@@ -525,6 +569,7 @@ def cargar_y_procesar_documentos(archivo, _user_key=user_env.session_id):
         return {
             'opciones': opciones_docu,
             'documentos': df_documentos,
+            'docu': df_docu,  # hoja DOCU tal cual, para volver a escribirla al guardar
             'archivo': archivo
         }
     except Exception as e:
@@ -548,6 +593,7 @@ def procesar_archivos_combinado(archivos_dict, _user_key=user_env.session_id):
                     resultados['triaje'] = cargar_y_procesar_triaje(archivo)
                 elif nombre == 'usuarios':
                     resultados['usuarios'] = cargar_y_procesar_usuarios(archivo)
+                    resultados['historico_usuarios'] = cargar_historico_usuarios(archivo)
                 elif nombre == 'documentos':
                     resultados['documentos'] = cargar_y_procesar_documentos(archivo)
         
@@ -560,42 +606,333 @@ def procesar_archivos_combinado(archivos_dict, _user_key=user_env.session_id):
             resultados.get('documentos')
         )
         
-        return df_combinado, resultados.get('usuarios'), resultados.get('documentos')
+        return df_combinado, resultados.get('usuarios'), resultados.get('documentos'), resultados.get('historico_usuarios')
         
     except Exception as e:
         st.error(f"Error en procesamiento combinado: {e}")
-        return df_rectauto, None, None
+        return df_rectauto, None, None, None
 
-def guardar_documentos_actualizados(archivo_original, df_documentos_actualizado):
-    """Guarda los datos actualizados en el archivo DOCUMENTOS.xlsx"""
+def guardar_documentos_actualizados(df_docu, df_documentos_actualizado):
+    """Genera en memoria el DOCUMENTOS.xlsx actualizado (hojas DOCUMENTOS y DOCU)"""
     try:
-        # Usar directorio temporal único por usuario
-        tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx", dir=user_env.working_dir)
-        tmp_path = tmp_file.name
-        tmp_file.close()  # 🔹 Muy importante: libera el archivo en Windows
-
-        # Escribir las dos hojas en el archivo temporal
-        with pd.ExcelWriter(tmp_path, engine="openpyxl") as writer:
+        output = io.BytesIO()
+        
+        with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
             # Hoja DOCUMENTOS actualizada - SOLO los registros actuales
             df_documentos_actualizado.to_excel(writer, sheet_name="DOCUMENTOS", index=False)
+            
+            # Hoja DOCU - MANTENER las opciones del desplegable ya leídas al cargar el archivo
+            df_docu.to_excel(writer, sheet_name="DOCU", index=False)
+        
+        return output.getvalue()
+
+    except Exception as e:
+        st.error(f"Error guardando DOCUMENTOS: {e}")
+        return None
+
+def obtener_indice_rue(df):
+    """Índice RUE → posiciones de fila en `df` (df_combinado), construido una vez por carga de datos.
+    
+    Se asocia al propio DataFrame (no a su número de filas): otros datos, aunque tengan las
+    mismas filas, construyen su índice.
+    """
+    indice = st.session_state.get('indice_rue')
+    if indice is None or indice['df'] is not df:
+        indice = {'df': df, 'posiciones': df.groupby('RUE', sort=False).indices}
+        st.session_state['indice_rue'] = indice
+    return indice['posiciones']
+
+def aplicar_cambios_documentacion(df, cambios):
+    """Aplica {RUE: DOCUM.INCORP.} a `df` con una única asignación por posiciones"""
+    posiciones_rue = obtener_indice_rue(df)
+    posiciones, valores = [], []
+    for rue, nueva_docum in cambios.items():
+        filas = posiciones_rue.get(rue)
+        if filas is not None:
+            posiciones.append(filas)
+            valores.extend([nueva_docum] * len(filas))
+    if posiciones:
+        # Sin DOCUMENTOS la columna se crea vacía (float): pasarla a texto antes de asignar
+        if not (pd.api.types.is_object_dtype(df['DOCUM.INCORP.']) or pd.api.types.is_string_dtype(df['DOCUM.INCORP.'])):
+            df['DOCUM.INCORP.'] = df['DOCUM.INCORP.'].astype(object)
+        df.iloc[np.concatenate(posiciones), df.columns.get_loc('DOCUM.INCORP.')] = valores
+    return df
+
+# === DIARIO DE CAMBIOS DE DOCUM.INCORP. (COMPARTIDO ENTRE SESIONES) ===
+DIRECTORIO_DATOS_COMPARTIDOS = os.environ.get(
+    "RECTAUTO_DATOS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "datos")
+)
+TAMANO_COMPACTACION_DIARIO = 256 * 1024  # bytes de diario a partir de los que se compacta
+
+class DiarioDocumentos:
+    """Diario append-only de ediciones de DOCUM.INCORP. con instantánea compactada.
+    
+    Cada guardado añade una línea JSON por RUE (rue, valor, usuario, fecha). El estado
+    es la instantánea más el diario reproducido en orden (gana la última edición de cada
+    RUE); al superar TAMANO_COMPACTACION_DIARIO el diario se vuelca a la instantánea.
+    """
+    def __init__(self, directorio=DIRECTORIO_DATOS_COMPARTIDOS):
+        self.directorio = directorio
+        self.ruta_diario = os.path.join(directorio, "documentos_diario.jsonl")
+        self.ruta_instantanea = os.path.join(directorio, "documentos_instantanea.json")
+        self.ruta_bloqueo = os.path.join(directorio, "documentos.lock")
+    
+    @contextmanager
+    def _bloqueo(self):
+        """Bloqueo exclusivo entre sesiones (y procesos) mientras se lee o escribe"""
+        os.makedirs(self.directorio, exist_ok=True)
+        with open(self.ruta_bloqueo, 'a') as archivo_bloqueo:
+            if fcntl is not None:
+                fcntl.flock(archivo_bloqueo, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(archivo_bloqueo, fcntl.LOCK_UN)
+    
+    def _leer_estado(self):
+        try:
+            with open(self.ruta_instantanea, encoding='utf-8') as f:
+                estado = json.load(f)
+        except FileNotFoundError:
+            estado = {}
+        estado.setdefault('valores', {})
+        estado.setdefault('opciones', [])
+        
+        try:
+            with open(self.ruta_diario, encoding='utf-8') as f:
+                for linea in f:
+                    try:
+                        entrada = json.loads(linea)
+                    except ValueError:
+                        continue  # Línea incompleta de una escritura interrumpida
+                    if 'opciones' in entrada:
+                        estado['opciones'] = entrada['opciones']
+                    else:
+                        estado['valores'][entrada['rue']] = entrada['valor']
+        except FileNotFoundError:
+            pass
+        return estado
+    
+    def _anotar(self, entradas):
+        with open(self.ruta_diario, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(entrada, ensure_ascii=False) + '\n' for entrada in entradas))
+        if os.path.getsize(self.ruta_diario) >= TAMANO_COMPACTACION_DIARIO:
+            self._compactar()
+    
+    def _compactar(self):
+        estado = self._leer_estado()
+        ruta_temporal = self.ruta_instantanea + '.tmp'
+        with open(ruta_temporal, 'w', encoding='utf-8') as f:
+            json.dump(estado, f, ensure_ascii=False)
+        os.replace(ruta_temporal, self.ruta_instantanea)
+        open(self.ruta_diario, 'w').close()
+    
+    def leer(self):
+        """Estado actual: {'valores': {RUE: DOCUM.INCORP.}, 'opciones': [...]}"""
+        with self._bloqueo():
+            return self._leer_estado()
+    
+    def registrar(self, cambios, usuario):
+        """Añade al diario las ediciones {RUE: DOCUM.INCORP.} (una línea por RUE)"""
+        fecha = datetime.now().isoformat(timespec='seconds')
+        with self._bloqueo():
+            self._anotar(
+                {'rue': str(rue), 'valor': valor, 'usuario': usuario, 'fecha': fecha}
+                for rue, valor in cambios.items()
+            )
+    
+    def registrar_opciones(self, opciones):
+        """Guarda las opciones del desplegable (hoja DOCU) si han cambiado"""
+        opciones = [str(opcion) for opcion in opciones]
+        with self._bloqueo():
+            if self._leer_estado()['opciones'] != opciones:
+                self._anotar([{'opciones': opciones}])
 
-            # Hoja DOCU - MANTENER las opciones del desplegable del original
-            archivo_original.seek(0)
-            df_docu_original = pd.read_excel(archivo_original, sheet_name="DOCU")
-            df_docu_original.to_excel(writer, sheet_name="DOCU", index=False)
+diario_documentos = DiarioDocumentos()
 
-        # Leer contenido ya guardado
-        with open(tmp_path, "rb") as f:
-            contenido = f.read()
+def aplicar_diario_documentos(df, datos_documentos):
+    """Aplica a `df` las ediciones del diario de DOCUM.INCORP. (posteriores al DOCUMENTOS.xlsx).
+    
+    Sin DOCUMENTOS.xlsx, los datos de documentación se reconstruyen a partir del diario.
+    """
+    try:
+        if datos_documentos is not None:
+            diario_documentos.registrar_opciones(datos_documentos['opciones'])
+        estado = diario_documentos.leer()
+    except OSError as e:
+        st.warning(f"⚠️ No se pudo leer el diario de DOCUMENTOS: {e}")
+        return datos_documentos
+    
+    if estado['valores'] and 'DOCUM.INCORP.' in df.columns:
+        aplicar_cambios_documentacion(df, estado['valores'])
+    
+    if datos_documentos is None and estado['opciones']:
+        datos_documentos = {
+            'opciones': estado['opciones'],
+            'documentos': pd.DataFrame({
+                'RUE': list(estado['valores'].keys()),
+                'DOCUM.INCORP.': list(estado['valores'].values())
+            }),
+            'docu': pd.DataFrame({'DOCU': estado['opciones']}),
+            'archivo': None
+        }
+    return datos_documentos
 
-        # Eliminar el archivo temporal (libre ya de bloqueos)
-        os.remove(tmp_path)
+# =============================================
+# EXPORTACIÓN A EXCEL EN STREAMING (XLSXWRITER)
+# =============================================
 
-        return contenido
+FORMATO_EXCEL_FECHA = 'DD/MM/YYYY'
+FORMATO_EXCEL_ENTERO = '#,##0'
+ORIGEN_FECHAS_EXCEL = pd.Timestamp('1899-12-30')
+# Colores del resaltado de los PDF: RUE prioritario, USUARIO-CSV distinto y DOCUM.INCORP. con valor
+COLOR_EXCEL_PRIORITARIO = '#FFFF00'
+COLOR_EXCEL_USUARIO_DISTINTO = '#FF0000'
+COLOR_EXCEL_DOCUM_INCORP = '#ADD8E6'
+
+def valores_columna_excel(serie):
+    """Convierte una columna a valores nativos para xlsxwriter (fechas como serial de Excel, vacíos como None)"""
+    vacios = serie.isna().to_numpy()
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        valores = ((serie - ORIGEN_FECHAS_EXCEL) / pd.Timedelta(days=1)).to_numpy(dtype=float, na_value=np.nan).astype(object)
+    elif pd.api.types.is_bool_dtype(serie):
+        valores = serie.to_numpy(dtype=object)
+    elif pd.api.types.is_numeric_dtype(serie):
+        valores = serie.to_numpy(dtype=float, na_value=np.nan).astype(object)
+    else:
+        valores = serie.astype(str).to_numpy(dtype=object)
+    valores[vacios] = None
+    return valores
+
+def ancho_columna_excel(serie, titulo, ancho_minimo, ancho_maximo=50):
+    """Ancho de columna a partir de longitudes de texto vectorizadas"""
+    longitud = len(str(titulo))
+    datos = serie.dropna()
+    if not datos.empty:
+        if pd.api.types.is_datetime64_any_dtype(datos):
+            longitud = max(longitud, 10)
+        elif pd.api.types.is_numeric_dtype(datos) and not pd.api.types.is_bool_dtype(datos):
+            # Longitud del mayor valor absoluto con separador de miles
+            extremos = datos.astype(float).abs().max()
+            longitud = max(longitud, len(f"{extremos:,.0f}") + int((datos < 0).any()))
+        else:
+            longitud = max(longitud, int(datos.astype(str).str.len().max()))
+    return max(min(longitud + 2, ancho_maximo), ancho_minimo)
+
+def columnas_resaltado_excel(df, flags_prioridad=None):
+    """Columnas auxiliares (0/1 o máscara de bits) que alimentan el formato condicional del Excel"""
+    auxiliares = {}
+    if flags_prioridad is not None and 'RUE' in df.columns:
+        auxiliares['_PRIORIDAD'] = np.asarray(flags_prioridad, dtype=np.int64)
+    if 'USUARIO' in df.columns and 'USUARIO-CSV' in df.columns:
+        distinto = (
+            df['USUARIO'].notna() & df['USUARIO-CSV'].notna() &
+            (df['USUARIO'].astype(str).str.strip() != df['USUARIO-CSV'].astype(str).str.strip())
+        )
+        auxiliares['_USUARIO_DISTINTO'] = distinto.to_numpy(dtype=np.int64)
+    return auxiliares
 
-    except Exception as e:
-        st.error(f"Error guardando DOCUMENTOS: {e}")
-        return None
+def exportar_excel_streaming(df, nombre_hoja, formatos_numero=None, ancho_minimo=10,
+                             congelar=None, autofiltro=False, fila_total=False, flags_prioridad=None):
+    """
+    Genera un Excel con formato escribiendo las filas en modo constant_memory.
+    Los formatos se crean una vez por columna, los bordes son una regla de rango
+    y los anchos salen de longitudes vectorizadas. Devuelve los bytes del archivo.
+    
+    El resaltado de los PDF (RUE prioritario, USUARIO-CSV distinto, DOCUM.INCORP.)
+    se aplica con reglas de formato condicional sobre columnas auxiliares ocultas,
+    por lo que se mantiene al reordenar o filtrar en Excel.
+    """
+    import xlsxwriter
+    from xlsxwriter.utility import xl_col_to_name
+
+    formatos_numero = formatos_numero or {}
+    auxiliares = columnas_resaltado_excel(df, flags_prioridad)
+    columnas_visibles = len(df.columns)
+    if auxiliares:
+        df = df.assign(**auxiliares)
+    output = io.BytesIO()
+    # Los textos se escriben tal cual: sin detectar fórmulas ni URLs en cada celda
+    workbook = xlsxwriter.Workbook(output, {
+        'constant_memory': True,
+        'tmpdir': user_env.working_dir,
+        'strings_to_formulas': False,
+        'strings_to_urls': False,
+    })
+    ws = workbook.add_worksheet(nombre_hoja)
+
+    formato_encabezado = workbook.add_format({
+        'bold': True, 'font_color': '#FFFFFF', 'bg_color': '#007933', 'border': 1,
+        'align': 'center', 'valign': 'vcenter', 'text_wrap': True
+    })
+    formato_borde = workbook.add_format({'border': 1})
+
+    n_filas, n_columnas = df.shape
+    formatos_total = []
+    for col_num, col_name in enumerate(df.columns):
+        serie = df[col_name]
+        if col_num >= columnas_visibles:
+            # Columna auxiliar del formato condicional
+            ws.set_column(col_num, col_num, None, None, {'hidden': True})
+            if fila_total:
+                formatos_total.append(None)
+            continue
+        propiedades = {'font_size': 10, 'valign': 'vcenter'}
+        if col_name in formatos_numero:
+            propiedades.update(align='right', num_format=formatos_numero[col_name])
+        elif pd.api.types.is_datetime64_any_dtype(serie):
+            propiedades.update(align='center', num_format=FORMATO_EXCEL_FECHA)
+        elif pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie):
+            propiedades.update(align='right', num_format=FORMATO_EXCEL_ENTERO)
+        else:
+            propiedades.update(align='left')
+
+        # Formato de columna: se aplica a todas las celdas escritas sin formato propio
+        ws.set_column(col_num, col_num, ancho_columna_excel(serie, col_name, ancho_minimo),
+                      workbook.add_format(propiedades))
+        if fila_total:
+            formatos_total.append(workbook.add_format({**propiedades, 'bold': True, 'bg_color': '#E6F3FF'}))
+
+    if congelar:
+        ws.freeze_panes(congelar)
+
+    ws.write_row(0, 0, [str(col) for col in df.columns], formato_encabezado)
+
+    columnas = [valores_columna_excel(df[col]) for col in df.columns]
+    ultima_fila_datos = n_filas - 1 if fila_total else n_filas
+    for fila_num, fila in enumerate(zip(*columnas), 1):
+        if fila_num > ultima_fila_datos:
+            for col_num, valor in enumerate(fila):
+                ws.write(fila_num, col_num, valor, formatos_total[col_num])
+        else:
+            ws.write_row(fila_num, 0, fila)
+
+    if n_filas > 0 and n_columnas > 0:
+        # Bordes de la tabla como regla de rango, sin estilo por celda
+        ws.conditional_format(1, 0, n_filas, n_columnas - 1,
+                              {'type': 'formula', 'criteria': 'TRUE', 'format': formato_borde})
+        if autofiltro:
+            ws.autofilter(0, 0, n_filas, n_columnas - 1)
+        
+        posiciones = {col: num for num, col in enumerate(df.columns)}
+        reglas = []
+        if '_PRIORIDAD' in posiciones:
+            reglas.append(('RUE', f"=${xl_col_to_name(posiciones['_PRIORIDAD'])}2>0", COLOR_EXCEL_PRIORITARIO))
+        if '_USUARIO_DISTINTO' in posiciones:
+            reglas.append(('USUARIO-CSV', f"=${xl_col_to_name(posiciones['_USUARIO_DISTINTO'])}2=1", COLOR_EXCEL_USUARIO_DISTINTO))
+        if 'DOCUM.INCORP.' in posiciones:
+            celda = f"{xl_col_to_name(posiciones['DOCUM.INCORP.'])}2"
+            reglas.append(('DOCUM.INCORP.', f"=LEN(TRIM({celda}))>0", COLOR_EXCEL_DOCUM_INCORP))
+        for col_name, formula, color in reglas:
+            col_num = posiciones[col_name]
+            ws.conditional_format(1, col_num, n_filas, col_num, {
+                'type': 'formula', 'criteria': formula,
+                'format': workbook.add_format({'bg_color': color})
+            })
+
+    workbook.close()
+    return output.getvalue()
 
 @st.cache_data(ttl=CACHE_TTL)
 def combinar_archivos(rectauto_df, notifica_df=None, triaje_df=None, usuarios_df=None, documentos_data=None, _user_key=user_env.session_id):
@@ -1098,65 +1435,145 @@ def calcular_kpis_para_semana_optimizado(_df, semana_fin, es_semana_actual=False
     
     return resultados
 
-def identificar_filas_prioritarias(df):
-    """Versión optimizada usando operaciones vectorizadas - MEJORADA"""
-    try:
-        # Crear copia para no modificar el original
-        df_priorizado = df.copy(deep=True)
-        
-        # Inicializar todas las prioridades como 0
-        df_priorizado['_prioridad'] = 0
-        
-        # Verificar que las columnas necesarias existen
-        columnas_necesarias = ['ETIQ. PENÚLTIMO TRAM.', 'FECHA NOTIFICACIÓN', 'DOCUM.INCORP.']
-        if not all(col in df_priorizado.columns for col in columnas_necesarias):
-            return df_priorizado
-        
-        # Crear máscaras vectorizadas para cada condición
-        etiq_penultimo = df_priorizado['ETIQ. PENÚLTIMO TRAM.'].astype(str).str.strip()
-        fecha_notif = pd.to_datetime(df_priorizado['FECHA NOTIFICACIÓN'], errors='coerce')
-        docum_incorp = df_priorizado['DOCUM.INCORP.'].astype(str).str.strip()
-        
-        # Inicializar máscara de prioritarios
-        mask_prioritarios = pd.Series(False, index=df_priorizado.index)
-        
-        # CONDICIÓN 1: "80 PROPRES" con fecha límite superada
-        mask_80_propres = (etiq_penultimo == "80 PROPRES")
-        if mask_80_propres.any():
-            fechas_limite_80 = fecha_notif[mask_80_propres] + timedelta(days=23)
-            mask_80_vencido = mask_80_propres & (datetime.now() > fechas_limite_80)
-            mask_prioritarios = mask_prioritarios | mask_80_vencido
-        
-        # CONDICIÓN 2: "50 REQUERIR" con fecha límite superada  
-        mask_50_requerir = (etiq_penultimo == "50 REQUERIR")
-        if mask_50_requerir.any():
-            fechas_limite_50 = fecha_notif[mask_50_requerir] + timedelta(days=23)
-            mask_50_vencido = mask_50_requerir & (datetime.now() > fechas_limite_50)
-            mask_prioritarios = mask_prioritarios | mask_50_vencido
-        
-        # CONDICIÓN 3: "70 ALEGACI" o "60 CONTESTA"
-        mask_alegaci_contesta = etiq_penultimo.isin(["70 ALEGACI", "60 CONTESTA"])
-        mask_prioritarios = mask_prioritarios | mask_alegaci_contesta
-        
-        # CONDICIÓN 4: DOCUM.INCORP. válido
-        mask_docum_valido = (
-            docum_incorp.notna() & 
-            (docum_incorp != '') &
-            (docum_incorp != 'nan') &
-            (~docum_incorp.str.upper().isin(["SOLICITUD", "REITERA SOLICITUD"]))
+# === FLAGS DE PRIORIDAD (MÁSCARA DE BITS POR EXPEDIENTE) ===
+# Columna interna de df_combinado con la regla que hace prioritario cada RUE
+COLUMNA_FLAGS_PRIORIDAD = '_flags_prioridad'
+PRIORIDAD_80_PROPRES_VENCIDO = 1
+PRIORIDAD_50_REQUERIR_VENCIDO = 2
+PRIORIDAD_ALEGACI_CONTESTA = 4
+PRIORIDAD_DOCUM_INCORP = 8
+
+DIAS_PLAZO_NOTIFICACION = 23
+UMBRALES_ANTIGUEDAD = (120, 180)
+
+def calcular_flags_prioridad(df, fecha_referencia=None):
+    """Máscara de bits (uint8) con las reglas de prioridad que cumple cada fila.
+    
+    80 PROPRES / 50 REQUERIR con FECHA LÍMITE (notificación + 23 días) alcanzada en
+    `fecha_referencia` (hoy por defecto), 70 ALEGACI / 60 CONTESTA y DOCUM.INCORP.
+    con valor distinto de SOLICITUD / REITERA SOLICITUD.
+    """
+    flags = np.zeros(len(df), dtype=np.uint8)
+    
+    columnas_necesarias = ['ETIQ. PENÚLTIMO TRAM.', 'FECHA NOTIFICACIÓN', 'DOCUM.INCORP.']
+    if not all(col in df.columns for col in columnas_necesarias):
+        return flags
+    
+    fecha_referencia = pd.Timestamp(fecha_referencia if fecha_referencia is not None else pd.Timestamp.now()).normalize()
+    
+    etiq_penultimo = df['ETIQ. PENÚLTIMO TRAM.'].astype(str).str.strip()
+    fecha_notif = pd.to_datetime(df['FECHA NOTIFICACIÓN'], errors='coerce')
+    fecha_limite = (fecha_notif + timedelta(days=DIAS_PLAZO_NOTIFICACION)).dt.normalize()
+    plazo_vencido = (fecha_limite <= fecha_referencia).to_numpy()
+    
+    docum = df['DOCUM.INCORP.']
+    docum_texto = docum.astype(str).str.strip()
+    docum_valido = (
+        docum.notna() &
+        (docum_texto != '') &
+        (docum_texto.str.lower() != 'nan') &
+        ~docum_texto.str.upper().isin(["SOLICITUD", "REITERA SOLICITUD"])
+    ).to_numpy()
+    
+    flags[((etiq_penultimo == "80 PROPRES").to_numpy() & plazo_vencido)] |= PRIORIDAD_80_PROPRES_VENCIDO
+    flags[((etiq_penultimo == "50 REQUERIR").to_numpy() & plazo_vencido)] |= PRIORIDAD_50_REQUERIR_VENCIDO
+    flags[etiq_penultimo.isin(["70 ALEGACI", "60 CONTESTA"]).to_numpy()] |= PRIORIDAD_ALEGACI_CONTESTA
+    flags[docum_valido] |= PRIORIDAD_DOCUM_INCORP
+    
+    return flags
+
+def obtener_fecha_referencia_prioridad(fecha_informe=None):
+    """Fecha a la que se evalúa la prioridad: la elegida en Vista de Expedientes o,
+    por defecto, el viernes del informe (`fecha_informe`); hoy si no hay ninguna."""
+    fecha = st.session_state.get('fecha_referencia_prioridad')
+    if fecha is None:
+        fecha = fecha_informe
+    if fecha is None or pd.isna(fecha):
+        fecha = pd.Timestamp.now()
+    return pd.Timestamp(fecha).normalize()
+
+def actualizar_flags_prioridad(df, fecha_referencia=None):
+    """Recalcula y guarda en `df` la columna de flags de prioridad (tras cargar datos o editar DOCUMENTOS)"""
+    if fecha_referencia is None:
+        fecha_referencia = obtener_fecha_referencia_prioridad(obtener_calendario_semanas(df).fecha_max)
+    fecha_referencia = pd.Timestamp(fecha_referencia).normalize()
+    df[COLUMNA_FLAGS_PRIORIDAD] = calcular_flags_prioridad(df, fecha_referencia)
+    st.session_state['fecha_flags_prioridad'] = fecha_referencia
+    return df
+
+def asegurar_flags_prioridad(df, fecha_referencia):
+    """Calcula los flags si faltan o si se evaluaron a otra fecha de referencia"""
+    fecha_referencia = pd.Timestamp(fecha_referencia).normalize()
+    if (COLUMNA_FLAGS_PRIORIDAD not in df.columns or
+            st.session_state.get('fecha_flags_prioridad') != fecha_referencia):
+        actualizar_flags_prioridad(df, fecha_referencia)
+    return df
+
+def obtener_flags_prioridad(df):
+    """Flags de prioridad de las filas de `df` (de la columna guardada o calculados al vuelo)"""
+    if COLUMNA_FLAGS_PRIORIDAD in df.columns:
+        return df[COLUMNA_FLAGS_PRIORIDAD].to_numpy()
+    return calcular_flags_prioridad(df)
+
+# === ÍNDICE DE VENCIMIENTOS (FECHA LÍMITE Y UMBRALES DE ANTIGÜEDAD) ===
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def construir_indice_vencimientos(_df, huella_datos):
+    """Índice ordenado de vencimientos de los expedientes pendientes.
+    
+    Para cada tipo ('FECHA LÍMITE' de 80 PROPRES / 50 REQUERIR y 'ANTIGÜEDAD 120/180' días desde
+    FECHA INICIO TRAMITACIÓN) guarda las fechas ordenadas y la posición de cada fila en `_df`,
+    de modo que las consultas por horizonte son dos búsquedas binarias.
+    """
+    pendientes = _df['ESTADO'].isin(ESTADOS_PENDIENTES).to_numpy() if 'ESTADO' in _df.columns else np.ones(len(_df), dtype=bool)
+    eventos = {}
+    
+    def registrar(tipo, fechas, mask):
+        fechas = fechas.to_numpy(dtype='datetime64[ns]')
+        mask = mask & pendientes & ~np.isnat(fechas)
+        posiciones = np.flatnonzero(mask)
+        orden = np.argsort(fechas[posiciones], kind='mergesort')
+        eventos[tipo] = {'fechas': fechas[posiciones][orden], 'posiciones': posiciones[orden]}
+    
+    if 'ETIQ. PENÚLTIMO TRAM.' in _df.columns and 'FECHA NOTIFICACIÓN' in _df.columns:
+        etiq_penultimo = _df['ETIQ. PENÚLTIMO TRAM.'].astype(str).str.strip()
+        fecha_notif = pd.to_datetime(_df['FECHA NOTIFICACIÓN'], errors='coerce')
+        registrar(
+            'FECHA LÍMITE',
+            (fecha_notif + timedelta(days=DIAS_PLAZO_NOTIFICACION)).dt.normalize(),
+            etiq_penultimo.isin(["80 PROPRES", "50 REQUERIR"]).to_numpy()
         )
-        mask_prioritarios = mask_prioritarios | mask_docum_valido
-        
-        # Asignar prioridad 1 a los que cumplen alguna condición
-        df_priorizado.loc[mask_prioritarios, '_prioridad'] = 1
-        
-        return df_priorizado
     
-    except Exception as e:
-        st.error(f"❌ Error al identificar filas prioritarias: {e}")
-        # En caso de error, devolver DataFrame con prioridad 0
-        df['_prioridad'] = 0
-        return df
+    if 'FECHA INICIO TRAMITACIÓN' in _df.columns:
+        fecha_inicio = pd.to_datetime(_df['FECHA INICIO TRAMITACIÓN'], errors='coerce').dt.normalize()
+        for umbral in UMBRALES_ANTIGUEDAD:
+            registrar(f'ANTIGÜEDAD {umbral}', fecha_inicio + timedelta(days=umbral), np.ones(len(_df), dtype=bool))
+    
+    return eventos
+
+def consultar_vencimientos(indice, fecha_referencia, dias):
+    """Eventos con fecha en (fecha_referencia, fecha_referencia + dias]: DataFrame TIPO, FECHA, POSICION"""
+    desde = np.datetime64(pd.Timestamp(fecha_referencia).normalize(), 'ns')
+    hasta = desde + np.timedelta64(int(dias), 'D')
+    partes = []
+    for tipo, datos in indice.items():
+        inicio = np.searchsorted(datos['fechas'], desde, side='right')
+        fin = np.searchsorted(datos['fechas'], hasta, side='right')
+        partes.append(pd.DataFrame({
+            'TIPO': tipo,
+            'FECHA': datos['fechas'][inicio:fin],
+            'POSICION': datos['posiciones'][inicio:fin],
+        }))
+    if not partes:
+        return pd.DataFrame(columns=['TIPO', 'FECHA', 'POSICION'])
+    return pd.concat(partes, ignore_index=True)
+
+def sin_columnas_internas(df):
+    """`df` sin las columnas internas (flags) para mostrar o exportar"""
+    return df.drop(columns=[COLUMNA_FLAGS_PRIORIDAD], errors='ignore')
+
+def identificar_filas_prioritarias(df):
+    """Devuelve `df` con la columna _prioridad (1 si cumple alguna regla de prioridad)"""
+    return df.assign(_prioridad=(obtener_flags_prioridad(df) > 0).astype(int))
 
 @st.cache_data(ttl=3600)
 def dataframe_to_pdf_bytes(df_mostrar, title, df_original):
@@ -1221,6 +1638,9 @@ def dataframe_to_pdf_bytes(df_mostrar, title, df_original):
         imprimir_encabezados()
         pdf.set_font("Arial", "", 5)
 
+        # Prioridad de cada fila leída una sola vez de los flags
+        filas_prioritarias = obtener_flags_prioridad(df_original) > 0
+
         # --- Filas de datos ---
         for idx, (_, row) in enumerate(df_mostrar.iterrows()):
             max_lineas = 1
@@ -1276,7 +1696,8 @@ def dataframe_to_pdf_bytes(df_mostrar, title, df_original):
                 y_celda = y_inicio
 
                 pdf.aplicar_formato_condicional_pdf(
-                    df_original, idx, col_name, COL_WIDTHS_OPTIMIZED[col_idx_visible], altura_fila, x_celda, y_celda
+                    df_original, idx, col_name, COL_WIDTHS_OPTIMIZED[col_idx_visible], altura_fila, x_celda, y_celda,
+                    es_prioritaria=idx < len(filas_prioritarias) and bool(filas_prioritarias[idx])
                 )
 
                 pdf.set_xy(x_celda, y_celda)
@@ -1305,14 +1726,11 @@ def dataframe_to_pdf_bytes(df_mostrar, title, df_original):
 
 # === FUNCIONES ORIGINALES (MANTENIDAS POR COMPATIBILIDAD) ===
 
-def ordenar_dataframe_por_prioridad_y_antiguedad(df):
-    """Ordena el DataFrame: RUE amarillos primero, luego por antigüedad descendente - CORREGIDA DEFINITIVAMENTE"""
+def ordenar_dataframe_por_prioridad_y_antiguedad(df, conservar_prioridad=False):
+    """Ordena el DataFrame: RUE amarillos primero, luego por antigüedad descendente (orden estable)"""
     try:
-        # Crear una COPIA PROFUNDA para no modificar el original
-        df_priorizado = df.copy(deep=True)
-        
-        # Identificar filas prioritarias en la copia
-        df_priorizado = identificar_filas_prioritarias(df_priorizado)
+        # Identificar filas prioritarias (ya trabaja sobre una copia profunda)
+        df_priorizado = identificar_filas_prioritarias(df)
         
         # Buscar la columna de antigüedad
         columnas_antiguedad = [col for col in df_priorizado.columns if 'ANTIGÜEDAD' in col.upper() or 'DÍAS' in col.upper()]
@@ -1338,16 +1756,17 @@ def ordenar_dataframe_por_prioridad_y_antiguedad(df):
         if columna_para_ordenar:
             df_ordenado = df_priorizado.sort_values(
                 ['_prioridad', columna_para_ordenar], 
-                ascending=[False, False]
+                ascending=[False, False],
+                kind='mergesort'
             )
             # Eliminar columna temporal si se creó
             if '_antiguedad_temp' in df_ordenado.columns:
                 df_ordenado = df_ordenado.drop('_antiguedad_temp', axis=1)
         else:
-            df_ordenado = df_priorizado.sort_values('_prioridad', ascending=False)
+            df_ordenado = df_priorizado.sort_values('_prioridad', ascending=False, kind='mergesort')
         
-        # Eliminar columna temporal de prioridad
-        if '_prioridad' in df_ordenado.columns:
+        # Eliminar columna temporal de prioridad (salvo que se pida conservarla)
+        if '_prioridad' in df_ordenado.columns and not conservar_prioridad:
             df_ordenado = df_ordenado.drop('_prioridad', axis=1)
         
         return df_ordenado
@@ -1356,61 +1775,81 @@ def ordenar_dataframe_por_prioridad_y_antiguedad(df):
         st.error(f"❌ Error al ordenar DataFrame: {e}")
         return df
 
-def generar_pdf_usuario(usuario, df_pendientes, num_semana, fecha_max_str):
-    """Genera el PDF para un usuario específico con nombre único - CORREGIDA PARA DECIMALES"""
-    # Crear copia para no modificar el original
-    df_user = df_pendientes[df_pendientes["USUARIO"] == usuario].copy(deep=True)
+def formatear_columnas_para_pdf(df):
+    """Formatea todas las columnas a texto para el PDF de forma vectorizada - CORREGIDA PARA DECIMALES"""
+    df_texto = pd.DataFrame(index=df.index)
     
-    if df_user.empty:
-        return None
+    for col in df.columns:
+        serie = df[col]
+        
+        if pd.api.types.is_object_dtype(serie) or pd.api.types.is_string_dtype(serie):
+            texto = serie.astype(str)
+            vacios = serie.isna() | texto.str.lower().isin(["nan", "nat", "none"])
+            df_texto[col] = texto.mask(vacios, "")
+        elif 'fecha' in col.lower():
+            fechas = pd.to_datetime(serie, errors='coerce')
+            df_texto[col] = fechas.dt.strftime("%d/%m/%Y").fillna("")
+        # 🔥 REDONDEAR EN LUGAR DE TRUNCAR (round de Python y numpy redondean igual: mitad al par)
+        elif pd.api.types.is_float_dtype(serie):
+            redondeado = serie.round().fillna(0).astype('int64')
+            df_texto[col] = redondeado.astype(str)
+        elif pd.api.types.is_integer_dtype(serie):
+            df_texto[col] = serie.fillna(0).astype('int64').astype(str)
+        else:
+            df_texto[col] = serie
     
-    # ORDENAR el DataFrame: RUE amarillos primero Y luego por antigüedad
-    df_user_ordenado = ordenar_dataframe_por_prioridad_y_antiguedad(df_user)
+    return df_texto
+
+@st.cache_data(ttl=CACHE_TTL)
+def preparar_datos_informes(_df_pendientes, huella):
+    """Prepara una sola vez el texto de los PDFs y las particiones por usuario y equipo.
     
-    # Procesar datos para PDF - mantener las columnas originales para el formato condicional
-    indices_a_incluir = list(range(df_user_ordenado.shape[1]))
+    `huella` identifica el contenido de _df_pendientes y es la clave de la caché.
+    """
+    # Columnas visibles en el PDF (misma proyección para usuarios y equipos)
     indices_a_excluir = {1, 4, 5, 6, 13}
     
     # EXCLUIR también la columna "FECHA DE ACTUALIZACIÓN DATOS" si existe
-    for idx, col_name in enumerate(df_user_ordenado.columns):
+    for idx, col_name in enumerate(_df_pendientes.columns):
         if "FECHA DE ACTUALIZACIÓN DATOS" in col_name.upper():
             indices_a_excluir.add(idx)
     
-    indices_finales = [i for i in indices_a_incluir if i not in indices_a_excluir]
-    NOMBRES_COLUMNAS_PDF = df_user_ordenado.columns[indices_finales].tolist()
+    indices_finales = [i for i in range(_df_pendientes.shape[1]) if i not in indices_a_excluir]
+    columnas_pdf = [col for col in _df_pendientes.columns[indices_finales] if col != COLUMNA_FLAGS_PRIORIDAD]
+    
+    # ORDEN GLOBAL: prioritarios primero y luego antigüedad descendente (estable).
+    # Los informes por usuario y por equipo heredan este orden al tomar sus filas.
+    df_ordenado = ordenar_dataframe_por_prioridad_y_antiguedad(_df_pendientes, conservar_prioridad=True)
+    if '_prioridad' in df_ordenado.columns:
+        prioritarios = df_ordenado['_prioridad'].to_numpy() == 1
+        df_ordenado = df_ordenado.drop('_prioridad', axis=1)
+    else:
+        prioritarios = np.zeros(len(df_ordenado), dtype=bool)
+    
+    # Texto formateado para todos los pendientes (SOLO para visualización)
+    df_display = formatear_columnas_para_pdf(df_ordenado[columnas_pdf])
+    
+    # Particiones: posiciones (ascendentes, por tanto ya ordenadas) de cada usuario y equipo
+    return {
+        'huella': huella,
+        'pendientes': df_ordenado,
+        'display': df_display,
+        'prioritarios': prioritarios,
+        'columnas_pdf': columnas_pdf,
+        'usuarios': df_ordenado.groupby("USUARIO", sort=False).indices,
+        'equipos': df_ordenado.groupby("EQUIPO", sort=False).indices,
+    }
 
-    # 🔥 CORRECCIÓN: Identificar columna de antigüedad
-    columnas_antiguedad = [col for col in NOMBRES_COLUMNAS_PDF if 'ANTIGÜEDAD' in col.upper() or 'DÍAS' in col.upper()]
+def generar_pdf_usuario(usuario, datos_informes, num_semana, fecha_max_str):
+    """Genera el PDF para un usuario específico a partir de los datos preparados"""
+    posiciones = datos_informes['usuarios'].get(usuario)
     
-    # Crear DataFrame para mostrar (SOLO para visualización)
-    df_pdf_mostrar = df_user_ordenado[NOMBRES_COLUMNAS_PDF].copy()
+    if posiciones is None or len(posiciones) == 0:
+        return None
     
-    # Formatear para visualización - CORREGIDO PARA DECIMALES
-    for col in df_pdf_mostrar.columns:
-        if df_pdf_mostrar[col].dtype == 'object':
-            df_pdf_mostrar[col] = df_pdf_mostrar[col].apply(
-                lambda x: "" if pd.isna(x) or str(x).lower() in ["nan", "nat", "none"] else str(x)
-            )
-        elif 'fecha' in col.lower():
-            df_pdf_mostrar[col] = df_pdf_mostrar[col].apply(
-                lambda x: x.strftime("%d/%m/%Y") if pd.notna(x) else ""
-            )
-        # 🔥 CORRECCIÓN DEFINITIVA: REDONDEAR EN LUGAR DE TRUNCAR
-        elif df_pdf_mostrar[col].dtype in ['float64', 'float32']:
-            # Para columnas flotantes (como antigüedad con decimales), REDONDEAR
-            if col in columnas_antiguedad:
-                df_pdf_mostrar[col] = df_pdf_mostrar[col].apply(
-                    lambda x: str(round(x)) if pd.notna(x) else "0"
-                )
-            else:
-                df_pdf_mostrar[col] = df_pdf_mostrar[col].apply(
-                    lambda x: str(round(x)) if pd.notna(x) else "0"
-                )
-        elif df_pdf_mostrar[col].dtype in ['int64', 'int32']:
-            # Para columnas enteras, mostrar normalmente
-            df_pdf_mostrar[col] = df_pdf_mostrar[col].apply(
-                lambda x: str(int(x)) if pd.notna(x) else "0"
-            )
+    # Filas ya ordenadas (RUE amarillos primero y luego antigüedad) y texto ya formateado
+    df_user_ordenado = datos_informes['pendientes'].iloc[posiciones]
+    df_pdf_mostrar = datos_informes['display'].iloc[posiciones]
 
     num_expedientes = len(df_pdf_mostrar)
     
@@ -1429,78 +1868,402 @@ def obtener_hash_archivo(archivo):
     archivo.seek(0)
     return file_hash
 
+def contenido_diferido(archivo):
+    """Callable para st.download_button: el contenido se lee al pulsar la descarga, no en cada ejecución.
+    
+    `archivo` es una ruta en disco o un archivo abierto (p. ej. SpooledTemporaryFile), que se lee desde el inicio.
+    """
+    def leer():
+        if isinstance(archivo, (str, os.PathLike)):
+            with open(archivo, 'rb') as archivo_disco:
+                return archivo_disco.read()
+        archivo.seek(0)
+        return archivo.read()
+    return leer
+
+def calcular_huella_dataframe(df):
+    """Genera un hash del contenido del DataFrame para usarlo como clave de caché"""
+    if df is None:
+        return None
+    try:
+        hashes_filas = pd.util.hash_pandas_object(df, index=True).values
+    except TypeError:
+        # Celdas no hashables (listas, dicts...): hashear su representación en texto
+        hashes_filas = pd.util.hash_pandas_object(df.astype(str), index=True).values
+    huella = hashlib.md5(hashes_filas.tobytes())
+    huella.update("|".join(map(str, df.columns)).encode('utf-8'))
+    return huella.hexdigest()
+
+def guardar_df_combinado(df):
+    """Guarda df_combinado en la sesión y renueva su huella (una vez por carga o guardado de DOCUMENTOS)"""
+    st.session_state["df_combinado"] = df
+    st.session_state["huella_df_combinado"] = (df, calcular_huella_dataframe(sin_columnas_internas(df)))
+
+def obtener_huella_df_combinado():
+    """Huella de df_combinado para las claves de caché, sin volver a recorrer los datos.
+    
+    La huella de los datos se calcula al guardarlos en la sesión; se le añade la fecha a la que
+    se evaluaron los flags de prioridad, que es lo único que cambia sin volver a guardarlos.
+    """
+    df = st.session_state["df_combinado"]
+    registro = st.session_state.get("huella_df_combinado")
+    if registro is None or registro[0] is not df:
+        guardar_df_combinado(df)
+        registro = st.session_state["huella_df_combinado"]
+    return f"{registro[1]}_{st.session_state.get('fecha_flags_prioridad')}"
+
+def calcular_huella_historico_usuarios(historico):
+    """Huella de las hojas opcionales PERIODOS/BAJAS de USUARIOS"""
+    if not historico:
+        return None
+    return "_".join(str(calcular_huella_dataframe(historico.get(clave))) for clave in ('periodos', 'bajas'))
+
+class AlmacenInformes:
+    """Registro por sesión de los informes ya generados para un conjunto de datos concreto"""
+    def __init__(self, huella):
+        self.huella = huella
+        self._artefactos = {}
+    
+    def obtener_o_generar(self, clave, generador):
+        """Devuelve el artefacto guardado con `clave` o lo genera una única vez"""
+        if clave not in self._artefactos:
+            self._artefactos[clave] = generador()
+        return self._artefactos[clave]
+
+def obtener_almacen_informes(huella):
+    """Devuelve el almacén de informes de la sesión, renovándolo si cambian los datos"""
+    almacen = st.session_state.get('almacen_informes')
+    if almacen is None or almacen.huella != huella:
+        almacen = AlmacenInformes(huella)
+        st.session_state['almacen_informes'] = almacen
+    return almacen
+
 @st.cache_data(ttl=CACHE_TTL)
-def generar_pdf_equipo_prioritarios(equipo, df_pendientes, num_semana, fecha_max_str):
-    """Genera el PDF para un equipo específico solo con expedientes prioritarios - CORREGIDA PARA DECIMALES"""
-    # Crear copia para no modificar el original
-    df_equipo = df_pendientes[df_pendientes["EQUIPO"] == equipo].copy(deep=True)
+def generar_pdf_equipo_prioritarios(equipo, _datos_informes, huella_datos, num_semana, fecha_max_str):
+    """Genera el PDF para un equipo específico solo con expedientes prioritarios a partir de los datos preparados"""
+    posiciones = _datos_informes['equipos'].get(equipo)
     
-    if df_equipo.empty:
+    if posiciones is None or len(posiciones) == 0:
         return None
     
-    # CORRECCIÓN: Usar la función de identificación de prioritarios
-    df_prioritarios = identificar_filas_prioritarias(df_equipo)
-    df_prioritarios = df_prioritarios[df_prioritarios['_prioridad'] == 1].copy()
+    # Solo expedientes prioritarios (calculados una vez en preparar_datos_informes)
+    posiciones = posiciones[_datos_informes['prioritarios'][posiciones]]
     
-    if df_prioritarios.empty:
+    if len(posiciones) == 0:
         return None
     
-    # Eliminar columna temporal de prioridad
-    df_prioritarios = df_prioritarios.drop('_prioridad', axis=1)
+    # Filas ya ordenadas por antigüedad y texto ya formateado
+    df_prioritarios = _datos_informes['pendientes'].iloc[posiciones]
+    df_pdf_mostrar = _datos_informes['display'].iloc[posiciones]
+
+    num_expedientes = len(df_pdf_mostrar)
     
-    # 🔥 CORRECCIÓN: ORDENAR POR PRIORIDAD Y ANTIGÜEDAD
-    df_prioritarios = ordenar_dataframe_por_prioridad_y_antiguedad(df_prioritarios)
+    titulo_pdf = f"{equipo} - Semana {num_semana} a {fecha_max_str} - Expedientes Prioritarios ({num_expedientes})"
     
-    # Procesar datos para PDF
-    indices_a_incluir = list(range(df_prioritarios.shape[1]))
-    indices_a_excluir = {1, 4, 5, 6, 13}
+    return dataframe_to_pdf_bytes(df_pdf_mostrar, titulo_pdf, df_original=df_prioritarios)
+
+# === EXCEL DE PENDIENTES POR EQUIPO (LOTE EN UN ZIP) ===
+TAMANO_MEMORIA_ZIP_EXCEL = 32 * 1024 * 1024  # por encima se vuelca a disco
+
+def generar_excel_equipo(equipo, datos_informes):
+    """Excel con todos los pendientes de un equipo: mismas columnas y orden que sus PDF"""
+    posiciones = datos_informes['equipos'].get(equipo)
     
-    # EXCLUIR también la columna "FECHA DE ACTUALIZACIÓN DATOS" si existe
-    for idx, col_name in enumerate(df_prioritarios.columns):
-        if "FECHA DE ACTUALIZACIÓN DATOS" in col_name.upper():
-            indices_a_excluir.add(idx)
+    if posiciones is None or len(posiciones) == 0:
+        return None
     
-    indices_finales = [i for i in indices_a_incluir if i not in indices_a_excluir]
-    NOMBRES_COLUMNAS_PDF = df_prioritarios.columns[indices_finales].tolist()
-
-    # 🔥 CORRECCIÓN: Identificar columna de antigüedad
-    columnas_antiguedad = [col for col in NOMBRES_COLUMNAS_PDF if 'ANTIGÜEDAD' in col.upper() or 'DÍAS' in col.upper()]
+    df_equipo = datos_informes['pendientes'].iloc[posiciones]
+    df_export = df_equipo[datos_informes['columnas_pdf']]
     
-    # Crear DataFrame para mostrar (SOLO para visualización)
-    df_pdf_mostrar = df_prioritarios[NOMBRES_COLUMNAS_PDF].copy()
+    if 'ANTIGÜEDAD EXP. (DÍAS)' in df_export.columns:
+        df_export = df_export.assign(**{
+            'ANTIGÜEDAD EXP. (DÍAS)': df_export['ANTIGÜEDAD EXP. (DÍAS)'].round().astype('Int64')
+        })
     
-    # Formatear para visualización - CORREGIDO PARA DECIMALES
-    for col in df_pdf_mostrar.columns:
-        if df_pdf_mostrar[col].dtype == 'object':
-            df_pdf_mostrar[col] = df_pdf_mostrar[col].apply(
-                lambda x: "" if pd.isna(x) or str(x).lower() in ["nan", "nat", "none"] else str(x)
-            )
-        elif 'fecha' in col.lower():
-            df_pdf_mostrar[col] = df_pdf_mostrar[col].apply(
-                lambda x: x.strftime("%d/%m/%Y") if pd.notna(x) else ""
-            )
-        # 🔥 CORRECCIÓN DEFINITIVA: REDONDEAR EN LUGAR DE TRUNCAR
-        elif df_pdf_mostrar[col].dtype in ['float64', 'float32']:
-            # Para columnas flotantes (como antigüedad con decimales), REDONDEAR
-            if col in columnas_antiguedad:
-                df_pdf_mostrar[col] = df_pdf_mostrar[col].apply(
-                    lambda x: str(round(x)) if pd.notna(x) else "0"
-                )
-            else:
-                df_pdf_mostrar[col] = df_pdf_mostrar[col].apply(
-                    lambda x: str(round(x)) if pd.notna(x) else "0"
-                )
-        elif df_pdf_mostrar[col].dtype in ['int64', 'int32']:
-            # Para columnas enteras, mostrar normalmente
-            df_pdf_mostrar[col] = df_pdf_mostrar[col].apply(
-                lambda x: str(int(x)) if pd.notna(x) else "0"
-            )
+    formatos_numero = {
+        col: FORMATO_EXCEL_ENTERO for col in df_export.columns
+        if 'ANTIGÜEDAD' in col.upper() or 'DÍAS' in col.upper()
+    }
+    
+    return exportar_excel_streaming(
+        df_export, "Pendientes",
+        formatos_numero=formatos_numero,
+        ancho_minimo=12,
+        congelar='B2',
+        autofiltro=True,
+        flags_prioridad=obtener_flags_prioridad(df_equipo)
+    )
 
-    num_expedientes = len(df_pdf_mostrar)
+def generar_zip_excel_equipos(equipos, datos_informes, num_semana):
+    """Genera los Excel por equipo uno a uno y los reúne en un ZIP temporal (spooled).
     
-    titulo_pdf = f"{equipo} - Semana {num_semana} a {fecha_max_str} - Expedientes Prioritarios ({num_expedientes})"
+    xlsxwriter es Python puro y retiene el GIL: un pool de hilos no acelera la generación.
+    Devuelve el archivo ZIP posicionado al inicio y el número de libros incluidos.
+    """
+    archivo_zip = tempfile.SpooledTemporaryFile(max_size=TAMANO_MEMORIA_ZIP_EXCEL, dir=user_env.working_dir)
+    incluidos = 0
+    
+    # Un .xlsx ya va comprimido: se almacena sin recomprimir (ZIP_STORED)
+    with zipfile.ZipFile(archivo_zip, 'w', zipfile.ZIP_STORED) as zip_file:
+        for equipo in equipos:
+            contenido = generar_excel_equipo(equipo, datos_informes)
+            if contenido:
+                zip_file.writestr(f"{num_semana}{equipo}_PENDIENTES.xlsx", contenido)
+                incluidos += 1
+    
+    archivo_zip.seek(0)
+    return archivo_zip, incluidos
+
+# === SERVICIO DE GRÁFICOS DEL PDF RESUMEN KPI (matplotlib Agg, en memoria) ===
+
+# Definición de los 5 gráficos de evolución: columnas y colores, títulos y posición en el PDF
+GRAFICOS_RESUMEN_KPI = [
+    {
+        'columnas': {
+            'nuevos_expedientes': '#1f77b4',
+            'despachados_semana': '#ff7f0e',
+            'expedientes_cerrados': '#2ca02c',
+        },
+        'titulo': 'Evolucion de Expedientes - Semana {num_semana}',
+        'eje_y': 'Cantidad',
+        'leyenda': True,
+        'encabezado_pdf': "Evolucion de Expedientes (Nuevos, Despachados, Cerrados)",
+        'nueva_pagina': False,
+    },
+    {
+        'columnas': {'total_abiertos': '#d62728'},
+        'titulo': 'Expedientes Abiertos - Semana {num_semana}',
+        'eje_y': 'Cantidad',
+        'leyenda': False,
+        'encabezado_pdf': "Evolucion de Expedientes Abiertos",
+        'nueva_pagina': False,
+    },
+    {
+        'columnas': {
+            'c_abs_despachados_sem': '#9467bd',
+            'c_abs_despachados_tot': '#c5b0d5',
+            'c_abs_cerrados_sem': '#8c564b',
+            'c_abs_cerrados_tot': '#c49c94',
+        },
+        'titulo': 'Evolución de Coeficientes de Absorción (%)',
+        'eje_y': 'Porcentaje (%)',
+        'leyenda': True,
+        'encabezado_pdf': "Coeficientes de Absorcion Semanales (%)",
+        'nueva_pagina': False,
+    },
+    {
+        'columnas': {
+            'tiempo_medio_despachados': '#ff7f0e',
+            'tiempo_medio_cerrados': '#2ca02c',
+            'percentil_90_despachados': '#ffbb78',
+            'percentil_90_cerrados': '#98df8a',
+        },
+        'titulo': 'Tiempos Medios y Percentiles 90 (días)',
+        'eje_y': 'Días',
+        'leyenda': True,
+        'encabezado_pdf': "Tiempos de Tramitacion (Medios)",
+        'nueva_pagina': True,
+    },
+    {
+        'columnas': {
+            'percentil_180_despachados': '#ff7f0e',
+            'percentil_120_despachados': '#ffddaa',
+            'percentil_180_cerrados': '#2ca02c',
+            'percentil_120_cerrados': '#98df8a',
+        },
+        'titulo': 'Porcentaje de Expedientes ≤120 y ≤180 días (%)',
+        'eje_y': 'Porcentaje (%)',
+        'leyenda': True,
+        'encabezado_pdf': "Porcentaje de Expedientes Despachados dentro de Plazos (120/180 dias)",
+        'nueva_pagina': False,
+    },
+]
+
+# Gráficos de evolución de la página KPI: columnas y colores, títulos y bloque (fila) en la página
+GRAFICOS_EVOLUCION_KPI = [
+    {
+        'columnas': {
+            'nuevos_expedientes': '#1f77b4',
+            'despachados_semana': '#ff7f0e',
+            'expedientes_cerrados': '#2ca02c',
+        },
+        'titulo': 'Evolución de Expedientes (Nuevos, Despachados, Cerrados)',
+        'eje_y': 'Cantidad',
+        'leyenda': 'KPI',
+        'bloque': 'evolucion',
+    },
+    {
+        'columnas': {'total_abiertos': '#d62728'},
+        'titulo': 'Evolución de Expedientes Abiertos',
+        'eje_y': 'Cantidad',
+        'leyenda': 'KPI',
+        'bloque': 'evolucion',
+    },
+    {
+        'columnas': {
+            'c_abs_despachados_sem': '#9467bd',
+            'c_abs_despachados_tot': '#c5b0d5',
+            'c_abs_cerrados_sem': '#8c564b',
+            'c_abs_cerrados_tot': '#c49c94',
+        },
+        'titulo': 'Evolución de Coeficientes de Absorción (%)',
+        'eje_y': 'Porcentaje (%)',
+        'leyenda': 'Indicador',
+        'bloque': 'evolucion',
+    },
+    {
+        'columnas': {
+            'tiempo_medio_despachados': '#ff7f0e',
+            'tiempo_medio_cerrados': '#2ca02c',
+            'percentil_90_despachados': '#ffbb78',
+            'percentil_90_cerrados': '#98df8a',
+        },
+        'titulo': 'Tiempos Medios y Percentiles 90 (días)',
+        'eje_y': 'Días',
+        'leyenda': 'Indicador',
+        'bloque': 'tiempos',
+    },
+    {
+        'columnas': {
+            'percentil_180_despachados': '#ff7f0e',
+            'percentil_120_despachados': '#ffddaa',
+            'percentil_180_cerrados': '#2ca02c',
+            'percentil_120_cerrados': '#98df8a',
+        },
+        'titulo': 'Porcentaje de Expedientes ≤120 y ≤180 días (%)',
+        'eje_y': 'Porcentaje (%)',
+        'leyenda': 'Indicador',
+        'bloque': 'tiempos',
+    },
+]
+
+SEMANAS_MODO_LIGERO_KPI = 300  # a partir de aquí los gráficos pasan a WebGL con diezmado
+PUNTOS_MAX_MODO_LIGERO_KPI = 400  # puntos por serie en modo ligero
+
+def diezmar_serie(x, y, max_puntos):
+    """Diezmado mín-máx: conserva el mínimo y el máximo de cada tramo y el último punto"""
+    if len(y) <= max_puntos:
+        return x, y
+    limites = np.linspace(0, len(y), max_puntos // 2 + 1).astype(int)
+    indices = [len(y) - 1]
+    for inicio, fin in zip(limites[:-1], limites[1:]):
+        validos = np.flatnonzero(~np.isnan(y[inicio:fin]))
+        if validos.size == 0:
+            indices.append(inicio)
+            continue
+        tramo = y[inicio:fin][validos]
+        indices.extend((inicio + validos[np.argmin(tramo)], inicio + validos[np.argmax(tramo)]))
+    indices = np.unique(indices)
+    return x[indices], y[indices]
+
+@st.cache_data(ttl=CACHE_TTL_DYNAMIC, show_spinner=False)
+def construir_figuras_evolucion_kpi(_df_kpis_semanales, huella_kpis, modo_ligero=False):
+    """Figuras base (sin marca de semana) de GRAFICOS_EVOLUCION_KPI.
+    
+    Las series van como arrays numpy (int32/float32), que Plotly envía codificados
+    en binario. En `modo_ligero` se dibujan con WebGL y diezmadas a
+    PUNTOS_MAX_MODO_LIGERO_KPI puntos. `huella_kpis` es la clave de la caché.
+    """
+    semanas = _df_kpis_semanales['semana_numero'].to_numpy(dtype=np.int32)
+    traza = go.Scattergl if modo_ligero else go.Scatter
+    
+    figuras = []
+    for spec in GRAFICOS_EVOLUCION_KPI:
+        fig = go.Figure()
+        for columna, color in spec['columnas'].items():
+            x = semanas
+            y = pd.to_numeric(_df_kpis_semanales[columna], errors='coerce').to_numpy(dtype=np.float32)
+            if modo_ligero:
+                x, y = diezmar_serie(x, y, PUNTOS_MAX_MODO_LIGERO_KPI)
+            fig.add_trace(traza(x=x, y=y, mode='lines', name=columna, line=dict(color=color)))
+        fig.update_layout(
+            title=spec['titulo'],
+            xaxis_title='Semana',
+            yaxis_title=spec['eje_y'],
+            height=400,
+            hovermode="x unified",
+            legend_title=spec['leyenda'],
+            legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='center', x=0.5)
+        )
+        figuras.append(fig)
+    return figuras
+
+def obtener_figuras_evolucion_kpi(df_kpis_semanales, modo_ligero=None):
+    """Figuras de evolución de la sesión para el conjunto de KPIs (caché por huella).
     
-    return dataframe_to_pdf_bytes(df_pdf_mostrar, titulo_pdf, df_original=df_prioritarios)
+    `modo_ligero=None` lo activa automáticamente a partir de SEMANAS_MODO_LIGERO_KPI semanas.
+    """
+    if modo_ligero is None:
+        modo_ligero = len(df_kpis_semanales) > SEMANAS_MODO_LIGERO_KPI
+    clave = (calcular_huella_dataframe(df_kpis_semanales), bool(modo_ligero))
+    guardadas = st.session_state.get('figuras_evolucion_kpi')
+    if guardadas is None or guardadas['clave'] != clave:
+        # Copia propia de la sesión: la marca de semana se mueve sobre ella
+        guardadas = {'clave': clave, 'figuras': construir_figuras_evolucion_kpi(df_kpis_semanales, clave[0], clave[1])}
+        st.session_state['figuras_evolucion_kpi'] = guardadas
+    return guardadas['figuras']
+
+def marcar_semana_en_figura(fig, num_semana):
+    """Mueve la línea discontinua de la semana seleccionada sobre una figura ya construida"""
+    fig.update_layout(shapes=[], annotations=[])
+    fig.add_vline(
+        x=num_semana,
+        line_dash="dash",
+        line_color="red",
+        annotation_text=f"Semana {num_semana}",
+        annotation_position="top left"
+    )
+    return fig
+
+def dibujar_grafico_evolucion(semanas, series, spec, num_semana):
+    """Dibuja un gráfico de evolución en un PNG en memoria (sin pyplot: seguro entre hilos)"""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    
+    # 7x3 pulgadas a 100 ppp = mismos 700x300 px que la exportación anterior
+    fig = Figure(figsize=(7, 3), dpi=100)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    
+    for columna, color in spec['columnas'].items():
+        ax.plot(semanas, series[columna], color=color, linewidth=1.5, label=columna)
+    
+    ax.axvline(num_semana, color='red', linestyle='--', linewidth=1)
+    ax.set_title(spec['titulo'].format(num_semana=num_semana), fontsize=10)
+    ax.set_xlabel('Semana', fontsize=8)
+    ax.set_ylabel(spec['eje_y'], fontsize=8)
+    ax.tick_params(labelsize=7)
+    ax.grid(True, alpha=0.3)
+    if spec['leyenda']:
+        ax.legend(fontsize=6, loc='center left', bbox_to_anchor=(1.0, 0.5), frameon=False)
+    fig.tight_layout()
+    
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+@st.cache_data(ttl=CACHE_TTL_DYNAMIC, show_spinner=False)
+def renderizar_graficos_resumen_kpi(_df_kpis_semanales, huella_kpis, num_semana):
+    """Renderiza en paralelo los 5 gráficos del resumen KPI y devuelve sus PNG en bytes.
+    
+    `huella_kpis` identifica el contenido de _df_kpis_semanales y es la clave de la caché.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    # Solo arrays numpy hacia los hilos de dibujo
+    semanas = _df_kpis_semanales['semana_numero'].to_numpy()
+    series = {
+        columna: pd.to_numeric(_df_kpis_semanales[columna], errors='coerce').to_numpy(dtype=float)
+        for spec in GRAFICOS_RESUMEN_KPI
+        for columna in spec['columnas']
+    }
+    
+    with ThreadPoolExecutor(max_workers=len(GRAFICOS_RESUMEN_KPI)) as executor:
+        imagenes = executor.map(
+            lambda spec: dibujar_grafico_evolucion(semanas, series, spec, num_semana),
+            GRAFICOS_RESUMEN_KPI
+        )
+        return tuple(imagenes)
 
 # === FUNCIÓN OPTIMIZADA PARA GENERAR PDF RESUMEN KPI CON GRÁFICOS ===
 @st.cache_data(ttl=CACHE_TTL_DYNAMIC)
@@ -1682,169 +2445,22 @@ def generar_pdf_resumen_kpi_optimizado(df_kpis_semanales, num_semana, fecha_max_
         pdf.add_page()
         pdf.add_section_title("GRAFICOS DE EVOLUCION - SEMANA " + str(num_semana))
 
+        # Datos ya calculados en la página 3 - SIN RECÁLCULOS
+        datos_grafico = df_kpis_semanales
+
         try:
-            # VERIFICACIÓN RÁPIDA DE KALEIDO
-            import plotly.io as pio
-            if not hasattr(pio, 'kaleido') or pio.kaleido.scope is None:
-                st.warning("Kaleido no disponible para gráficos")
-                raise ImportError("Kaleido no disponible")
-            
-            # USAR DATOS YA CALCULADOS - SIN RECÁLCULOS
-            datos_grafico = df_kpis_semanales.copy()
-            
-            # CONFIGURACIÓN DE GRÁFICOS MÁS RÁPIDA
-            config_rapida = {
-                'displayModeBar': False,
-                'staticPlot': True,  # Gráficos estáticos más rápidos
-            }
-            
-            # GRÁFICO 1: Evolución de expedientes principales
-            fig1 = px.line(
-                datos_grafico,
-                x='semana_numero',
-                y=['nuevos_expedientes', 'despachados_semana', 'expedientes_cerrados'],
-                title=f'Evolucion de Expedientes - Semana {num_semana}',
-                labels={'semana_numero': 'Semana', 'value': 'Cantidad', 'variable': 'KPI'},
-                color_discrete_map={
-                    'nuevos_expedientes': '#1f77b4',
-                    'despachados_semana': '#ff7f0e', 
-                    'expedientes_cerrados': '#2ca02c'
-                }
-            )
-            # CONFIGURACIÓN MÍNIMA PARA RAPIDEZ
-            fig1.update_layout(
-                height=300,  # Menor altura = más rápido
-                showlegend=True,
-                margin=dict(l=40, r=20, t=40, b=20)
-            )
-            fig1.add_vline(x=num_semana, line_dash="dash", line_color="red")
-            
-            # GUARDAR CON CONFIGURACIÓN RÁPIDA
-            temp_chart1 = user_env.get_temp_path(f"chart1_{num_semana}.png")
-            fig1.write_image(temp_chart1, engine="kaleido", scale=1, width=700, height=300)
-            
-            # INSERTAR EN PDF
-            pdf.ln(3)
-            pdf.set_font('Arial', 'B', 10)
-            pdf.cell(0, 8, "Evolucion de Expedientes (Nuevos, Despachados, Cerrados)", 0, 1)
-            pdf.image(temp_chart1, x=10, w=190)
-            
-            pdf.ln(3)
-            
-            # GRÁFICO 2: Expedientes Abiertos
-            fig2 = px.line(
-                datos_grafico,
-                x='semana_numero', 
-                y=['total_abiertos'],
-                title=f'Expedientes Abiertos - Semana {num_semana}',
-                labels={'semana_numero': 'Semana', 'value': 'Cantidad'},
-                color_discrete_sequence=['#d62728']
-            )
-            fig2.update_layout(height=300, showlegend=False, margin=dict(l=40, r=20, t=40, b=20))
-            fig2.add_vline(x=num_semana, line_dash="dash", line_color="red")
-            
-            temp_chart2 = user_env.get_temp_path(f"chart2_{num_semana}.png")
-            fig2.write_image(temp_chart2, engine="kaleido", scale=1, width=700, height=300)
-            
-            pdf.set_font('Arial', 'B', 10)
-            pdf.cell(0, 8, "Evolucion de Expedientes Abiertos", 0, 1)
-            pdf.image(temp_chart2, x=10, w=190)
-            
-            pdf.ln(3)
-            
-            # GRÁFICO 3: Coeficientes de absorción
-            fig3 = px.line(
-                datos_grafico,
-                x='semana_numero',
-                y=[
-                    'c_abs_despachados_sem', 'c_abs_despachados_tot',
-                    'c_abs_cerrados_sem', 'c_abs_cerrados_tot'
-                ],
-                title='Evolución de Coeficientes de Absorción (%)',
-                labels={'semana_numero': 'Semana', 'value': 'Porcentaje (%)', 'variable': 'Indicador'},
-                color_discrete_map={
-                    'c_abs_despachados_sem': '#9467bd',
-                    'c_abs_despachados_tot': '#c5b0d5',
-                    'c_abs_cerrados_sem': '#8c564b',
-                    'c_abs_cerrados_tot': '#c49c94'
-                }
-            )
-            fig3.update_layout(height=300, showlegend=True, margin=dict(l=40, r=20, t=40, b=20))
-            fig3.add_vline(x=num_semana, line_dash="dash", line_color="red")
-            
-            temp_chart3 = user_env.get_temp_path(f"chart3_{num_semana}.png")
-            fig3.write_image(temp_chart3, engine="kaleido", scale=1, width=700, height=300)
-            
-            pdf.set_font('Arial', 'B', 10)
-            pdf.cell(0, 8, "Coeficientes de Absorcion Semanales (%)", 0, 1)
-            pdf.image(temp_chart3, x=10, w=190)
-            
-            pdf.ln(3)
-            
-            # GRÁFICO 4: Tiempos de tramitación
-            fig4 = px.line(
-                datos_grafico,
-                x='semana_numero',
-                y=[
-                    'tiempo_medio_despachados', 'tiempo_medio_cerrados',
-                    'percentil_90_despachados', 'percentil_90_cerrados'
-                ],
-                title='Tiempos Medios y Percentiles 90 (días)',
-                labels={'semana_numero': 'Semana', 'value': 'Días', 'variable': 'Indicador'},
-                color_discrete_map={
-                    'tiempo_medio_despachados': '#ff7f0e',
-                    'tiempo_medio_cerrados': '#2ca02c',
-                    'percentil_90_despachados': '#ffbb78',
-                    'percentil_90_cerrados': '#98df8a'
-                }
-            )
-            fig4.update_layout(height=300, showlegend=True, margin=dict(l=40, r=20, t=40, b=20))
-            fig4.add_vline(x=num_semana, line_dash="dash", line_color="red")
-            
-            temp_chart4 = user_env.get_temp_path(f"chart4_{num_semana}.png")
-            fig4.write_image(temp_chart4, engine="kaleido", scale=1, width=700, height=300)
-            
-            pdf.add_page()
-            pdf.set_font('Arial', 'B', 10)
-            pdf.cell(0, 8, "Tiempos de Tramitacion (Medios)", 0, 1)
-            pdf.image(temp_chart4, x=10, w=190)
-            
-            pdf.ln(3)
-            
-            # GRÁFICO 5: Porcentajes 120/180 días
-            fig5 = px.line(
-                datos_grafico,
-                x='semana_numero',
-                y=[
-                    'percentil_180_despachados', 'percentil_120_despachados',
-                    'percentil_180_cerrados', 'percentil_120_cerrados'
-                ],
-                title='Porcentaje de Expedientes ≤120 y ≤180 días (%)',
-                labels={'semana_numero': 'Semana', 'value': 'Porcentaje (%)', 'variable': 'Indicador'},
-                color_discrete_map={
-                    'percentil_180_despachados': '#ff7f0e',
-                    'percentil_120_despachados': '#ffddaa',
-                    'percentil_180_cerrados': '#2ca02c',
-                    'percentil_120_cerrados': '#98df8a'
-                }
-            )
-            fig5.update_layout(height=300, showlegend=True, margin=dict(l=40, r=20, t=40, b=20))
-            fig5.add_vline(x=num_semana, line_dash="dash", line_color="red")
-            
-            temp_chart5 = user_env.get_temp_path(f"chart5_{num_semana}.png")
-            fig5.write_image(temp_chart5, engine="kaleido", scale=1, width=700, height=300)
+            # Gráficos renderizados en memoria (cacheados por datos + semana)
+            huella_kpis = calcular_huella_dataframe(df_kpis_semanales)
+            imagenes = renderizar_graficos_resumen_kpi(df_kpis_semanales, huella_kpis, num_semana)
             
-            pdf.set_font('Arial', 'B', 10)
-            pdf.cell(0, 8, "Porcentaje de Expedientes Despachados dentro de Plazos (120/180 dias)", 0, 1)
-            pdf.image(temp_chart5, x=10, w=190)
-            
-            # LIMPIAR TEMPORALES INMEDIATAMENTE
-            for temp_file in [temp_chart1, temp_chart2, temp_chart3, temp_chart4, temp_chart5]:
-                try:
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                except:
-                    pass
+            for spec, imagen_png in zip(GRAFICOS_RESUMEN_KPI, imagenes):
+                if spec['nueva_pagina']:
+                    pdf.add_page()
+                else:
+                    pdf.ln(3)
+                pdf.set_font('Arial', 'B', 10)
+                pdf.cell(0, 8, spec['encabezado_pdf'], 0, 1)
+                pdf.image(io.BytesIO(imagen_png), x=10, w=190)
                 
         except Exception as chart_error:
             # FALLBACK: TABLA DE DATOS SIN GRÁFICOS
@@ -2031,14 +2647,42 @@ def enviar_correo_outlook(destinatario, asunto, cuerpo_mensaje, archivos_adjunto
             pass
 
 # Función para gráficos dinámicos (SIN CACHE)
+TOP_N_GRAFICOS_VISTA = 15  # categorías con barra propia; el resto se agrupa en "Otros"
+
+def agrupar_top_n(conteo, columna, top_n=TOP_N_GRAFICOS_VISTA):
+    """Las `top_n` categorías con más expedientes y una fila "Otros (k)" con el resto"""
+    if len(conteo) <= top_n + 1:
+        return conteo
+    resto = conteo.iloc[top_n:]
+    otros = pd.DataFrame({columna: [f"Otros ({len(resto)})"], 'Cantidad': [int(resto['Cantidad'].sum())]})
+    return pd.concat([conteo.iloc[:top_n], otros], ignore_index=True)
+
 def crear_grafico_dinamico(_conteo, columna, titulo):
-    """Crea gráficos dinámicos que responden a los filtros"""
+    """Crea gráficos dinámicos que responden a los filtros (top-N + "Otros", una sola traza)"""
     if _conteo.empty:
         return None
     
-    fig = px.bar(_conteo, y=columna, x="Cantidad", title=titulo, text="Cantidad", 
-                 color=columna, height=400)
-    fig.update_traces(texttemplate='%{text:,}', textposition="auto")
+    conteo = agrupar_top_n(_conteo, columna)
+    categorias = conteo[columna].astype(str).tolist()
+    paleta = px.colors.qualitative.Plotly
+    colores = [paleta[i % len(paleta)] for i in range(len(conteo))]
+    if len(conteo) < len(_conteo):
+        colores[-1] = '#B0B0B0'  # "Otros"
+    
+    fig = go.Figure(go.Bar(
+        y=categorias,
+        x=conteo['Cantidad'].to_numpy(),
+        orientation='h',
+        marker_color=colores,
+        text=conteo['Cantidad'].to_numpy(),
+        texttemplate='%{text:,}',
+        textposition="auto"
+    ))
+    fig.update_layout(
+        title=titulo, height=400, showlegend=False,
+        xaxis_title="Cantidad", yaxis_title=columna,
+        yaxis=dict(autorange="reversed")
+    )
     return fig
 
 # === NUEVA CLASE PDF PARA RENDIMIENTO ===
@@ -2088,8 +2732,12 @@ class PDFRendimiento(FPDF):
 
 # === FUNCIÓN PARA GENERAR PDF DE RENDIMIENTO ===
 @st.cache_data(ttl=CACHE_TTL_DYNAMIC)
-def generar_pdf_rendimiento(df_rendimiento_completo, num_semana, fecha_max_str):
-    """Genera un PDF con la tabla de rendimiento por usuario"""
+def generar_pdf_rendimiento(df_rendimiento_completo, num_semana, fecha_max_str, _puente_equipos=None):
+    """Genera un PDF con la tabla de rendimiento por usuario.
+    
+    `_puente_equipos` es la tabla puente de calcular_rendimiento_usuarios_agrupado; las filas
+    de `df_rendimiento_completo` conservan el índice posicional del rendimiento completo.
+    """
     
     try:
         # Verificar que haya datos
@@ -2125,10 +2773,7 @@ def generar_pdf_rendimiento(df_rendimiento_completo, num_semana, fecha_max_str):
         potencial_anual_conjunto = potencial_anual_promedio*total_usuarios
         
         # Obtener lista de equipos únicos
-        todos_equipos = set()
-        for equipos_str in df_rendimiento_completo['EQUIPOS'].dropna():
-            equipos_lista = [eq.strip() for eq in str(equipos_str).split(',')]
-            todos_equipos.update(equipos_lista)
+        todos_equipos = equipos_en_filas(_puente_equipos, df_rendimiento_completo.index)
         
         pdf.add_metric("Total de Usuarios", total_usuarios)
         pdf.add_metric("Total de Expedientes Despachados", f"{total_expedientes:,}".replace(",", "."))
@@ -2233,9 +2878,231 @@ def generar_pdf_rendimiento(df_rendimiento_completo, num_semana, fecha_max_str):
         st.error(f"❌ Error generando PDF de rendimiento: {e}")
         return None
 
+# =============================================
+# PLANTILLA DE USUARIOS CON FECHAS EFECTIVAS
+# =============================================
+
+# Mapeo de posibles nombres de columnas en USUARIOS (y en sus hojas PERIODOS/BAJAS)
+MAPEO_COLUMNAS_USUARIOS = {
+    'usuario': ['USUARIOS', 'USUARIO', 'NOMBRE', 'NOMBRE USUARIO'],
+    'equipo': ['EQUIPO', 'EQUIPOS'],
+    'fecha_inicio': ['FECHA INICIO', 'INICIO', 'FECHA_ALTA', 'ALTA'],
+    'fecha_fin': ['FECHA FIN', 'FIN', 'FECHA_BAJA', 'BAJA', 'FECHA SALIDA'],
+    'semanas_baja': ['SEMANAS DE BAJA', 'SEMANAS_BAJA', 'BAJAS', 'DIAS BAJA']
+}
+
+def resolver_columnas_usuarios(df):
+    """Devuelve el nombre real de cada columna de MAPEO_COLUMNAS_USUARIOS (o None si no existe)"""
+    return {
+        col_tipo: next((nombre for nombre in posibles_nombres if nombre in df.columns), None)
+        for col_tipo, posibles_nombres in MAPEO_COLUMNAS_USUARIOS.items()
+    }
+
+class PlantillaUsuarios:
+    """Plantilla de usuarios con fechas efectivas.
+    
+    Cada usuario tiene uno o varios periodos de alta (con su equipo) y, opcionalmente,
+    periodos de baja (IT de larga duración...), ambos guardados en IntervalIndex [inicio, fin).
+    Los periodos salen de la hoja principal de USUARIOS o, si existe, de la hoja PERIODOS;
+    las bajas con fechas salen de la hoja BAJAS. Las SEMANAS DE BAJA de la hoja principal
+    se mantienen como descuento global sobre las semanas efectivas.
+    """
+    # Extremos para periodos abiertos (fecha de inicio o fin vacía)
+    FECHA_MINIMA = pd.Timestamp('1900-01-01')
+    FECHA_MAXIMA = pd.Timestamp('2200-01-01')
+    
+    def __init__(self, df_usuarios, historico=None):
+        historico = historico or {}
+        self.columnas = resolver_columnas_usuarios(df_usuarios)
+        columna_usuario = self.columnas['usuario']
+        
+        # Hoja principal: una fila por usuario (si se repite, manda la primera)
+        principal = self._normalizar(df_usuarios, self.columnas)
+        principal['SEMANAS_BAJA'] = (
+            pd.to_numeric(df_usuarios[self.columnas['semanas_baja']], errors='coerce').fillna(0).to_numpy()
+            if self.columnas['semanas_baja'] else 0.0
+        )
+        principal = principal[principal['USUARIO'].notna()].drop_duplicates(subset='USUARIO', keep='first')
+        self.semanas_baja = principal.set_index('USUARIO')['SEMANAS_BAJA']
+        
+        # Periodos de alta: la hoja PERIODOS sustituye a la fila principal de sus usuarios
+        periodos = principal.drop(columns='SEMANAS_BAJA')
+        df_periodos = historico.get('periodos')
+        if df_periodos is not None and not df_periodos.empty:
+            extra = self._normalizar(df_periodos, resolver_columnas_usuarios(df_periodos))
+            extra = extra[extra['USUARIO'].notna()]
+            periodos = pd.concat([periodos[~periodos['USUARIO'].isin(extra['USUARIO'])], extra], ignore_index=True)
+        
+        self.usuarios = pd.Index(periodos['USUARIO'].unique())
+        self.periodos = periodos.reset_index(drop=True)
+        self.periodos['CODIGO'] = self.usuarios.get_indexer(self.periodos['USUARIO'])
+        self.intervalos = self._intervalos(self.periodos)
+        
+        # Periodos de baja con fechas (opcional)
+        bajas = pd.DataFrame(columns=['USUARIO', 'EQUIPO', 'INICIO', 'FIN'])
+        df_bajas = historico.get('bajas')
+        if df_bajas is not None and not df_bajas.empty:
+            bajas = self._normalizar(df_bajas, resolver_columnas_usuarios(df_bajas))
+            bajas = bajas[bajas['USUARIO'].isin(self.usuarios)]
+        self.bajas = bajas.reset_index(drop=True)
+        self.intervalos_bajas = self._intervalos(self.bajas)
+        
+        self.columna_usuario = columna_usuario
+    
+    @classmethod
+    def _normalizar(cls, df, columnas):
+        """Convierte una hoja a columnas USUARIO, EQUIPO, INICIO, FIN.
+        
+        Las fechas se recortan a [FECHA_MINIMA, FECHA_MAXIMA]: un fin abierto como 31/12/9999
+        no cabe en datetime64[ns].
+        """
+        def columna_o_vacia(nombre_columna):
+            if nombre_columna:
+                return df[nombre_columna]
+            return pd.Series(np.nan, index=df.index)
+        
+        def fechas(nombre_columna):
+            return pd.to_datetime(columna_o_vacia(nombre_columna), errors='coerce').clip(cls.FECHA_MINIMA, cls.FECHA_MAXIMA)
+        
+        return pd.DataFrame({
+            'USUARIO': columna_o_vacia(columnas['usuario']),
+            'EQUIPO': columna_o_vacia(columnas['equipo']),
+            'INICIO': fechas(columnas['fecha_inicio']),
+            'FIN': fechas(columnas['fecha_fin']),
+        })
+    
+    @classmethod
+    def _intervalos(cls, df):
+        """IntervalIndex [inicio, fin) con los extremos vacíos abiertos"""
+        inicio = df['INICIO'].fillna(cls.FECHA_MINIMA).astype('datetime64[ns]')
+        fin = df['FIN'].fillna(cls.FECHA_MAXIMA).astype('datetime64[ns]')
+        fin = fin.where(fin > inicio, inicio)  # Datos incoherentes: periodo vacío
+        return pd.IntervalIndex.from_arrays(inicio, fin, closed='left')
+    
+    def contiene(self, usuarios):
+        """Máscara de los usuarios que están en la plantilla"""
+        return pd.Index(usuarios).isin(self.usuarios)
+    
+    def estados(self, usuarios, fecha):
+        """ACTIVO si algún periodo sigue abierto después de `fecha` (INACTIVO si no está en la plantilla)"""
+        abierto = (self.periodos['FIN'].isna() | (self.periodos['FIN'] > fecha)).to_numpy()
+        activos = self.periodos.loc[abierto, 'USUARIO'].unique()
+        return np.where(pd.Index(usuarios).isin(activos), 'ACTIVO', 'INACTIVO')
+    
+    def inicios_actividad(self, usuarios):
+        """Primera fecha de alta de cada usuario (NaT si alguno de sus periodos no tiene inicio)"""
+        inicio = self.periodos['INICIO'].fillna(self.FECHA_MINIMA)
+        primer_inicio = inicio.groupby(self.periodos['USUARIO']).min()
+        primer_inicio = primer_inicio.where(primer_inicio > self.FECHA_MINIMA)
+        return primer_inicio.reindex(usuarios)
+    
+    def semanas_baja_globales(self, usuarios):
+        """SEMANAS DE BAJA de la hoja principal (0 si no constan)"""
+        return self.semanas_baja.reindex(usuarios).fillna(0).to_numpy(dtype=float)
+    
+    def semanas_activas(self, usuarios, inicios, fin):
+        """Semanas de alta (descontando bajas con fechas) de cada usuario en cada ventana.
+        
+        `inicios` es una matriz usuarios × ventanas de fechas de inicio y `fin` la fecha
+        de fin común. Los días solapados se cuentan completos por periodo, como antes.
+        """
+        usuarios = pd.Index(usuarios)
+        inicios = np.asarray(inicios, dtype='datetime64[ns]').reshape(len(usuarios), -1)
+        fin = np.datetime64(pd.Timestamp(fin), 'ns')
+        dias = np.zeros(inicios.shape, dtype=float)
+        
+        def dias_solapados(posiciones, izquierda, derecha):
+            # (periodos × ventanas): días completos entre max(izquierda, inicio) y min(derecha, fin)
+            desde = np.maximum(izquierda[:, None], inicios[posiciones])
+            hasta = np.minimum(derecha, fin)[:, None]
+            return np.maximum((hasta - desde) // np.timedelta64(1, 'D'), 0)
+        
+        # Días de alta: suma de todos los periodos del usuario
+        posiciones = usuarios.get_indexer(self.periodos['USUARIO'])
+        validos = posiciones >= 0
+        np.add.at(
+            dias, posiciones[validos],
+            dias_solapados(posiciones[validos], self.intervalos.left.to_numpy()[validos], self.intervalos.right.to_numpy()[validos])
+        )
+        
+        # Días de baja: solo cuentan dentro de un periodo de alta
+        if len(self.bajas):
+            cruce = self.bajas.reset_index().merge(
+                self.periodos[['USUARIO']].reset_index(), on='USUARIO', suffixes=('_baja', '_periodo')
+            )
+            posiciones = usuarios.get_indexer(cruce['USUARIO'])
+            validos = posiciones >= 0
+            izquierda = np.maximum(
+                self.intervalos_bajas.left.to_numpy()[cruce['index_baja']],
+                self.intervalos.left.to_numpy()[cruce['index_periodo']]
+            )
+            derecha = np.minimum(
+                self.intervalos_bajas.right.to_numpy()[cruce['index_baja']],
+                self.intervalos.right.to_numpy()[cruce['index_periodo']]
+            )
+            np.subtract.at(
+                dias, posiciones[validos],
+                dias_solapados(posiciones[validos], izquierda[validos], derecha[validos])
+            )
+        
+        return np.maximum(dias, 0) / 7
+
+# === TABLA PUENTE USUARIO ↔ EQUIPO ===
+def construir_puente_equipos(usuarios, pares_usuario_equipo):
+    """Tabla puente normalizada USUARIO ↔ EQUIPO con un mapa de bits por equipo.
+    
+    `usuarios` es el índice de filas de df_rendimiento y `pares_usuario_equipo` los pares
+    (USUARIO, EQUIPO) sin duplicar. La fila i de `matriz` marca qué filas de df_rendimiento
+    pertenecen al equipo `equipos[i]`, de modo que filtrar por equipos, listar los equipos
+    disponibles o contarlos son operaciones de conjuntos sin volver a partir cadenas.
+    """
+    equipos = sorted(pares_usuario_equipo['EQUIPO'].unique())
+    codigos_equipo = pd.Index(equipos).get_indexer(pares_usuario_equipo['EQUIPO'])
+    filas_usuario = pd.Index(usuarios).get_indexer(pares_usuario_equipo['USUARIO'])
+    
+    matriz = np.zeros((len(equipos), len(usuarios)), dtype=bool)
+    matriz[codigos_equipo, filas_usuario] = True
+    
+    return {
+        'pares': pares_usuario_equipo[['USUARIO', 'EQUIPO']],
+        'equipos': equipos,
+        'matriz': matriz,
+    }
+
+def _mascara_filas_puente(puente, filas):
+    """Convierte `filas` (máscara booleana o posiciones de df_rendimiento) en máscara booleana"""
+    filas = np.asarray(filas)
+    if filas.dtype == bool:
+        return filas
+    mascara = np.zeros(puente['matriz'].shape[1], dtype=bool)
+    mascara[filas.astype(np.int64)] = True
+    return mascara
+
+def equipos_en_filas(puente, filas=None):
+    """Equipos (ordenados) con al menos un usuario entre las filas indicadas de df_rendimiento"""
+    if puente is None:
+        return []
+    if filas is None:
+        presentes = puente['matriz'].any(axis=1)
+    else:
+        presentes = puente['matriz'][:, _mascara_filas_puente(puente, filas)].any(axis=1)
+    return [equipo for equipo, presente in zip(puente['equipos'], presentes) if presente]
+
+def filas_de_equipos(puente, equipos):
+    """Máscara booleana de las filas de df_rendimiento que pertenecen a alguno de los equipos"""
+    seleccionados = set(equipos)
+    posiciones = [i for i, equipo in enumerate(puente['equipos']) if equipo in seleccionados]
+    return puente['matriz'][posiciones].any(axis=0)
+
 @st.cache_data(ttl=CACHE_TTL)
-def calcular_rendimiento_usuarios_agrupado(_df, _df_usuarios, _fecha_max):
-    """Calcula rendimiento AGRUPADO POR USUARIO (sin duplicar por equipos)"""
+def calcular_rendimiento_usuarios_agrupado(_df, _df_usuarios, _fecha_max, huella_datos, _historico_usuarios=None):
+    """Calcula rendimiento AGRUPADO POR USUARIO (sin duplicar por equipos) de forma vectorizada.
+    
+    `huella_datos` identifica los datos y la fecha de cálculo y es la clave de la caché.
+    `_historico_usuarios` son las hojas opcionales PERIODOS/BAJAS de USUARIOS.
+    
+    Devuelve (df_rendimiento, puente_equipos); ver construir_puente_equipos.
+    """
     
     # 1. IDENTIFICAR EXPEDIENTES DESPACHADOS
     fecha_9999 = pd.to_datetime('9999-09-09', errors='coerce')
@@ -2259,375 +3126,642 @@ def calcular_rendimiento_usuarios_agrupado(_df, _df_usuarios, _fecha_max):
     )
     
     mask_despachados = mask_despachados_reales | mask_despachados_cerrados
-    df_despachados = _df[mask_despachados].copy()
     
     # 2. CALCULAR DESPACHADOS POR USUARIO (agrupando todos los equipos)
-    if 'USUARIO' not in df_despachados.columns:
+    if 'USUARIO' not in _df.columns:
         st.error("❌ No se encuentra la columna USUARIO en los datos")
-        return pd.DataFrame()
-        
-    despachados_por_usuario = df_despachados.groupby('USUARIO').size().reset_index(name='EXPEDIENTES_DESPACHADOS')
+        return pd.DataFrame(), None
+    
+    df_despachados = _df.loc[mask_despachados, ['USUARIO', 'EQUIPO', 'FECHA RESOLUCIÓN']]
+    df_despachados = df_despachados[df_despachados['USUARIO'].notna()]
+    
+    # Códigos de usuario en el mismo orden que groupby (ordenado por nombre)
+    codigos_usuario, usuarios = pd.factorize(df_despachados['USUARIO'], sort=True)
+    expedientes_despachados = np.bincount(codigos_usuario, minlength=len(usuarios))
     
     # 3. OBTENER EQUIPOS POR USUARIO (para mostrar en la tabla)
-    equipos_por_usuario = df_despachados.groupby('USUARIO')['EQUIPO'].apply(
-        lambda x: ', '.join(sorted(set(x.dropna().astype(str))))
-    ).reset_index(name='EQUIPOS')
+    pares_usuario_equipo = pd.DataFrame({
+        'USUARIO': df_despachados['USUARIO'].to_numpy(),
+        'EQUIPO': df_despachados['EQUIPO'],
+    }).dropna(subset=['EQUIPO'])
+    pares_usuario_equipo['EQUIPO'] = pares_usuario_equipo['EQUIPO'].astype(str)
+    pares_usuario_equipo = pares_usuario_equipo.drop_duplicates().reset_index(drop=True)
+    puente_equipos = construir_puente_equipos(usuarios, pares_usuario_equipo)
+    
+    # La cadena EQUIPOS solo se usa para mostrar; los filtros usan el puente
+    equipos_por_usuario = (
+        pares_usuario_equipo
+        .sort_values('EQUIPO', kind='mergesort')
+        .groupby('USUARIO')['EQUIPO']
+        .agg(', '.join)
+        .reindex(usuarios, fill_value='')
+    )
     
-    # 4. PREPARAR DATOS DE USUARIOS
-    usuarios_data = []
+    # 4. PLANTILLA DE USUARIOS (periodos de alta y bajas con fechas)
     
     # Verificar columnas en el archivo de usuarios
     columnas_usuarios = _df_usuarios.columns.tolist()
     st.info(f"📋 Columnas en archivo USUARIOS: {', '.join(columnas_usuarios)}")
     
     # Buscar nombres alternativos para las columnas
-    columna_usuario = None
-    columna_fecha_inicio = None
-    columna_fecha_fin = None
-    columna_semanas_baja = None
-    
-    # Mapeo de posibles nombres de columnas
-    mapeo_columnas = {
-        'usuario': ['USUARIOS', 'USUARIO', 'NOMBRE', 'NOMBRE USUARIO'],
-        'fecha_inicio': ['FECHA INICIO', 'INICIO', 'FECHA_ALTA', 'ALTA'],
-        'fecha_fin': ['FECHA FIN', 'FIN', 'FECHA_BAJA', 'BAJA', 'FECHA SALIDA'],
-        'semanas_baja': ['SEMANAS DE BAJA', 'SEMANAS_BAJA', 'BAJAS', 'DIAS BAJA']
-    }
-    
-    for col_tipo, posibles_nombres in mapeo_columnas.items():
-        for nombre in posibles_nombres:
-            if nombre in _df_usuarios.columns:
-                if col_tipo == 'usuario':
-                    columna_usuario = nombre
-                elif col_tipo == 'fecha_inicio':
-                    columna_fecha_inicio = nombre
-                elif col_tipo == 'fecha_fin':
-                    columna_fecha_fin = nombre
-                elif col_tipo == 'semanas_baja':
-                    columna_semanas_baja = nombre
-                break
+    columna_usuario = resolver_columnas_usuarios(_df_usuarios)['usuario']
     
     if not columna_usuario:
         st.error("❌ No se encuentra la columna de usuarios en el archivo USUARIOS")
         st.info("💡 Las columnas disponibles son: " + ", ".join(columnas_usuarios))
-        return pd.DataFrame()
+        return pd.DataFrame(), None
     
     st.success(f"✅ Columna de usuario identificada: {columna_usuario}")
     
-    for _, usuario_row in _df_usuarios.iterrows():
-        usuario_nombre = usuario_row[columna_usuario]
-        
-        # Obtener fechas con nombres alternativos
-        fecha_inicio = usuario_row.get(columna_fecha_inicio, None) if columna_fecha_inicio else None
-        fecha_fin = usuario_row.get(columna_fecha_fin, None) if columna_fecha_fin else None
-        semanas_baja = usuario_row.get(columna_semanas_baja, 0) if columna_semanas_baja else 0
-        
-        # Determinar estado
-        if pd.isna(fecha_fin) or str(fecha_fin).strip() == '':
-            estado = "ACTIVO"
-        else:
-            try:
-                fecha_fin_dt = pd.to_datetime(fecha_fin, errors='coerce')
-                if pd.isna(fecha_fin_dt) or fecha_fin_dt > _fecha_max:
-                    estado = "ACTIVO"
-                else:
-                    estado = "INACTIVO"
-            except:
-                estado = "ACTIVO"
-        
-        usuarios_data.append({
-            'USUARIO': usuario_nombre,
-            'FECHA_INICIO': fecha_inicio,
-            'FECHA_FIN': fecha_fin,
-            'SEMANAS_BAJA': semanas_baja,
-            'ESTADO': estado
-        })
+    plantilla = PlantillaUsuarios(_df_usuarios, _historico_usuarios)
+    
+    # 5. ESTADO Y SEMANAS EFECTIVAS (todos los usuarios a la vez)
+    # Los usuarios que no están en USUARIOS se consideran INACTIVOS
+    encontrado = plantilla.contiene(usuarios)
+    estado = plantilla.estados(usuarios, _fecha_max)
+    es_activo = estado == 'ACTIVO'
+    
+    # Semanas de alta desde el 01/11/2022 menos SEMANAS DE BAJA (1 si el usuario no está en USUARIOS)
+    semanas_alta = plantilla.semanas_activas(
+        usuarios, np.full(len(usuarios), np.datetime64(fecha_inicio_totales, 'ns')), _fecha_max
+    )[:, 0]
+    semanas_efectivas = np.where(
+        encontrado,
+        np.maximum(semanas_alta - plantilla.semanas_baja_globales(usuarios), 0),
+        1
+    )
     
-    df_usuarios_info = pd.DataFrame(usuarios_data)
+    # 6. CALCULAR RENDIMIENTOS POR PERÍODOS (todas las ventanas y usuarios a la vez)
+    # Ventanas: (días hacia atrás, semanas máximas)
+    ventanas = {
+        'ANUAL': (365, 52),
+        'TRIMESTRAL': (90, 13),
+        'MENSUAL': (30, 4),
+        'SEMANAL': (7, 1),
+    }
+    inicios_ventana = np.array(
+        [np.datetime64(pd.Timestamp(_fecha_max - timedelta(days=dias)), 'ns') for dias, _ in ventanas.values()]
+    )
+    inicios_ventana = np.tile(inicios_ventana, (len(usuarios), 1))
+    
+    # Inicio de cada ventana ajustado a la primera fecha de alta del usuario (usuarios × ventanas)
+    fecha_inicio = plantilla.inicios_actividad(usuarios).to_numpy(dtype='datetime64[ns]')
+    inicios = np.where(
+        ~np.isnat(fecha_inicio)[:, None] & (fecha_inicio[:, None] > inicios_ventana),
+        fecha_inicio[:, None],
+        inicios_ventana
+    )
     
-    # 5. COMBINAR DATOS Y CALCULAR INDICADORES POR USUARIO
-    resultados = []
+    # Claves ordenadas (usuario, segundo de resolución) de los despachos del último año:
+    # cada recuento por ventana son dos búsquedas binarias sobre el mismo array
+    fecha_max_ns = np.datetime64(pd.Timestamp(_fecha_max), 'ns')
+    fecha_base = pd.Timestamp(_fecha_max) - timedelta(days=366)
+    fechas_resolucion = df_despachados['FECHA RESOLUCIÓN']
+    en_rango = (fechas_resolucion.notna() & (fechas_resolucion >= fecha_base) & (fechas_resolucion <= _fecha_max)).to_numpy()
+    
+    def a_segundos(fechas):
+        return (fechas - np.datetime64(fecha_base, 'ns')) // np.timedelta64(1, 's')
+    
+    segundos = a_segundos(fechas_resolucion.to_numpy(dtype='datetime64[ns]')[en_rango])
+    claves = np.sort(codigos_usuario[en_rango].astype(np.int64) * 2**32 + segundos)
+    
+    codigos = np.arange(len(usuarios), dtype=np.int64)[:, None] * 2**32
+    segundos_inicio = np.clip(a_segundos(inicios), 0, None)
+    segundos_fin = a_segundos(fecha_max_ns)
+    recuentos = np.maximum(
+        np.searchsorted(claves, codigos + segundos_fin, side='right') -
+        np.searchsorted(claves, codigos + segundos_inicio, side='left'),
+        0
+    )
+    # Solo cuentan los despachos de usuarios ACTIVOS
+    recuentos = np.where(es_activo[:, None], recuentos, 0)
+    
+    # Semanas de alta en cada ventana (sin superar las semanas de la ventana)
+    semanas_maximas = np.array([semanas for _, semanas in ventanas.values()])
+    semanas_ventana = np.minimum(
+        semanas_maximas,
+        plantilla.semanas_activas(usuarios, inicios_ventana, _fecha_max)
+    )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rendimientos = np.where(semanas_ventana > 0, recuentos / semanas_ventana, 0)
+        rendimiento_total = np.where(semanas_efectivas > 0, expedientes_despachados / semanas_efectivas, 0)
+    
+    rendimiento_anual = rendimientos[:, 0]
+    
+    df_rendimiento = pd.DataFrame({
+        'USUARIO': usuarios,
+        'EQUIPOS': equipos_por_usuario.to_numpy(),  # Mostrar todos los equipos en una columna
+        'ESTADO': estado,
+        'EXPEDIENTES_DESPACHADOS': expedientes_despachados,
+        'SEMANAS_EFECTIVAS': np.round(semanas_efectivas, 1),
+        'RENDIMIENTO_TOTAL': np.round(rendimiento_total, 2),
+        'RENDIMIENTO_ANUAL': np.round(rendimiento_anual, 2),
+        'POTENCIAL_ANUAL': np.round(rendimiento_anual * 52, 1),  # Rendimiento anual * 52 semanas
+        'RENDIMIENTO_TRIMESTRAL': np.round(rendimientos[:, 1], 2),
+        'RENDIMIENTO_MENSUAL': np.round(rendimientos[:, 2], 2),
+        'RENDIMIENTO_SEMANAL': np.round(rendimientos[:, 3], 2)
+    })
+    
+    return df_rendimiento, puente_equipos
+
+# === MATRIZ SEMANAL DE DESPACHOS (USUARIOS × SEMANAS) ===
+def calcular_fecha_despacho(df):
+    """Fecha de despacho de cada expediente: FECHA RESOLUCIÓN real o, en los cerrados sin ella, FECHA CIERRE"""
+    fecha_9999 = pd.to_datetime('9999-09-09', errors='coerce')
+    fecha_resolucion = df['FECHA RESOLUCIÓN']
+    resolucion_real = fecha_resolucion.notna() & (fecha_resolucion != fecha_9999)
     
-    for _, row in despachados_por_usuario.iterrows():
-        usuario = row['USUARIO']
-        expedientes_despachados = row['EXPEDIENTES_DESPACHADOS']
-        
-        # Obtener equipos del usuario (para mostrar)
-        equipos_usuario = equipos_por_usuario[equipos_por_usuario['USUARIO'] == usuario]
-        equipos_str = equipos_usuario['EQUIPOS'].iloc[0] if not equipos_usuario.empty else "Sin equipo"
-        
-        # Buscar información del usuario
-        usuario_info = None
-        if not df_usuarios_info.empty:
-            usuario_match = df_usuarios_info[df_usuarios_info['USUARIO'] == usuario]
-            if not usuario_match.empty:
-                usuario_info = usuario_match.iloc[0]
-        
-        # CALCULAR SEMANAS EFECTIVAS (UNA SOLA VEZ POR USUARIO)
-        semanas_efectivas = 1
-        estado = "INACTIVO"  # Por defecto si no se encuentra en usuarios
-        
-        if usuario_info is not None:
-            # Usuario encontrado en archivo USUARIOS
-            fecha_inicio = pd.to_datetime(usuario_info['FECHA_INICIO'], errors='coerce')
-            fecha_fin = pd.to_datetime(usuario_info['FECHA_FIN'], errors='coerce')
-            semanas_baja = float(usuario_info['SEMANAS_BAJA']) if pd.notna(usuario_info['SEMANAS_BAJA']) and str(usuario_info['SEMANAS_BAJA']).strip() != '' else 0
-            estado = usuario_info['ESTADO']
-            
-            # Calcular fecha fin efectiva
-            fecha_fin_efectiva = fecha_fin if pd.notna(fecha_fin) and fecha_fin <= _fecha_max else _fecha_max
-            
-            # Calcular semanas efectivas de trabajo
-            fecha_inicio_efectiva = max(fecha_inicio, fecha_inicio_totales) if pd.notna(fecha_inicio) else fecha_inicio_totales
-            
-            if pd.notna(fecha_inicio_efectiva):
-                dias_totales = (fecha_fin_efectiva - fecha_inicio_efectiva).days
-                semanas_totales = max(dias_totales / 7, 0)
-                semanas_efectivas = max(semanas_totales - semanas_baja, 0)
-        
-        # CALCULAR RENDIMIENTOS POR PERÍODOS
-        
-        # Definir períodos
-        fecha_inicio_anio = _fecha_max - timedelta(days=365)
-        fecha_inicio_trimestre = _fecha_max - timedelta(days=90)
-        fecha_inicio_mes = _fecha_max - timedelta(days=30)
-        fecha_inicio_semana = _fecha_max - timedelta(days=7)
-        
-        # Ajustar fechas de inicio según fecha_inicio del usuario
-        if usuario_info is not None and pd.notna(usuario_info['FECHA_INICIO']):
-            fecha_inicio_usuario = pd.to_datetime(usuario_info['FECHA_INICIO'])
-            fecha_inicio_anio = max(fecha_inicio_anio, fecha_inicio_usuario)
-            fecha_inicio_trimestre = max(fecha_inicio_trimestre, fecha_inicio_usuario)
-            fecha_inicio_mes = max(fecha_inicio_mes, fecha_inicio_usuario)
-            fecha_inicio_semana = max(fecha_inicio_semana, fecha_inicio_usuario)
-        
-        # Último año
-        despachados_ultimo_anio = len(df_despachados[
-            (df_despachados['USUARIO'] == usuario) & 
-            (estado == 'ACTIVO') &
-            (df_despachados['FECHA RESOLUCIÓN'] >= fecha_inicio_anio) &
-            (df_despachados['FECHA RESOLUCIÓN'] <= _fecha_max)
-        ])
-        semanas_anio = min(52, ((_fecha_max - fecha_inicio_anio).days / 7)) if fecha_inicio_anio < _fecha_max else 0
-        rendimiento_anual = despachados_ultimo_anio / semanas_anio if semanas_anio > 0 else 0
-        
-        # NUEVO: POTENCIAL ANUAL (Rendimiento anual * 52 semanas)
-        potencial_anual = rendimiento_anual * 52
-        
-        # Últimos tres meses
-        despachados_trimestre = len(df_despachados[
-            (df_despachados['USUARIO'] == usuario) & 
-            (estado == 'ACTIVO') &
-            (df_despachados['FECHA RESOLUCIÓN'] >= fecha_inicio_trimestre) &
-            (df_despachados['FECHA RESOLUCIÓN'] <= _fecha_max)
-        ])
-        semanas_trimestre = min(13, ((_fecha_max - fecha_inicio_trimestre).days / 7)) if fecha_inicio_trimestre < _fecha_max else 0
-        rendimiento_trimestral = despachados_trimestre / semanas_trimestre if semanas_trimestre > 0 else 0
-        
-        # Último mes
-        despachados_mes = len(df_despachados[
-            (df_despachados['USUARIO'] == usuario) & 
-            (estado == 'ACTIVO') &
-            (df_despachados['FECHA RESOLUCIÓN'] >= fecha_inicio_mes) &
-            (df_despachados['FECHA RESOLUCIÓN'] <= _fecha_max)
-        ])
-        semanas_mes = min(4, ((_fecha_max - fecha_inicio_mes).days / 7)) if fecha_inicio_mes < _fecha_max else 0
-        rendimiento_mensual = despachados_mes / semanas_mes if semanas_mes > 0 else 0
-        
-        # Última semana
-        despachados_semana = len(df_despachados[
-            (df_despachados['USUARIO'] == usuario) & 
-            (estado == 'ACTIVO') &
-            (df_despachados['FECHA RESOLUCIÓN'] >= fecha_inicio_semana) &
-            (df_despachados['FECHA RESOLUCIÓN'] <= _fecha_max)
-        ])
-        semanas_semana = min(1, ((_fecha_max - fecha_inicio_semana).days / 7)) if fecha_inicio_semana < _fecha_max else 0
-        rendimiento_semanal = despachados_semana / semanas_semana if semanas_semana > 0 else 0
-        
-        # Rendimiento total
-        rendimiento_total = expedientes_despachados / semanas_efectivas if semanas_efectivas > 0 else 0
-        
-        resultados.append({
-            'USUARIO': usuario,
-            'EQUIPOS': equipos_str,  # Mostrar todos los equipos en una columna
-            'ESTADO': estado,
-            'EXPEDIENTES_DESPACHADOS': expedientes_despachados,
-            'SEMANAS_EFECTIVAS': round(semanas_efectivas, 1),
-            'RENDIMIENTO_TOTAL': round(rendimiento_total, 2),
-            'RENDIMIENTO_ANUAL': round(rendimiento_anual, 2),
-            'POTENCIAL_ANUAL': round(potencial_anual, 1),  # NUEVA COLUMNA
-            'RENDIMIENTO_TRIMESTRAL': round(rendimiento_trimestral, 2),
-            'RENDIMIENTO_MENSUAL': round(rendimiento_mensual, 2),
-            'RENDIMIENTO_SEMANAL': round(rendimiento_semanal, 2)
-        })
-    
-    return pd.DataFrame(resultados)
+    fecha_despacho = fecha_resolucion.where(resolucion_real)
+    cerrados_sin_resolucion = (df['ESTADO'] == 'Cerrado') & ~resolucion_real
+    return fecha_despacho.mask(cerrados_sin_resolucion, df['FECHA CIERRE'])
+
+@st.cache_data(ttl=CACHE_TTL)
+def calcular_matriz_despachos_semanales(_df, _calendario, huella_datos):
+    """Matriz compacta usuarios × semanas con los despachos de cada usuario desde el 01/11/2022.
+    
+    Las columnas son las semanas (cierre en viernes) de `_calendario`, las mismas del KPI y de los
+    informes; los despachos fuera del calendario (p. ej. 9999) no cuentan. Se construye con un único
+    bincount sobre (usuario, semana) y `huella_datos` (huella del DataFrame, de la que sale el
+    calendario) es la clave de la caché. Incluye la suma acumulada por filas para consultar
+    cualquier ventana de semanas en O(1).
+    """
+    posiciones = _calendario.posicion_semana(calcular_fecha_despacho(_df))
+    mask = _df['USUARIO'].notna().to_numpy() & (posiciones >= 0)
+    
+    codigos_usuario, usuarios = pd.factorize(_df.loc[mask, 'USUARIO'], sort=True)
+    ids_semana = posiciones[mask]
+    
+    num_semanas = len(_calendario.semanas)
+    matriz = np.bincount(
+        codigos_usuario.astype(np.int64) * num_semanas + ids_semana,
+        minlength=len(usuarios) * num_semanas
+    ).reshape(len(usuarios), num_semanas).astype(np.int32)
+    
+    acumulado = np.zeros((len(usuarios), num_semanas + 1), dtype=np.int64)
+    np.cumsum(matriz, axis=1, out=acumulado[:, 1:])
+    
+    return {
+        'usuarios': usuarios,
+        'semanas': pd.DatetimeIndex(_calendario.semanas),
+        'etiquetas': _calendario.etiquetas,
+        'matriz': matriz,
+        'acumulado': acumulado,
+    }
+
+def despachos_en_ventana(matriz_semanal, semana_inicio, semana_fin):
+    """Despachos por usuario en las semanas [semana_inicio, semana_fin] a partir de la suma acumulada"""
+    acumulado = matriz_semanal['acumulado']
+    inicio = int(np.clip(semana_inicio, 0, acumulado.shape[1] - 1))
+    fin = int(np.clip(semana_fin + 1, inicio, acumulado.shape[1] - 1))
+    return acumulado[:, fin] - acumulado[:, inicio]
+
+def media_movil_semanal(matriz_semanal, semanas):
+    """Media móvil de `semanas` semanas por usuario (las primeras columnas usan las semanas disponibles)"""
+    acumulado = matriz_semanal['acumulado']
+    fin = np.arange(1, acumulado.shape[1])
+    inicio = np.maximum(fin - semanas, 0)
+    return (acumulado[:, fin] - acumulado[:, inicio]) / (fin - inicio)
 
 # =============================================
-# HANDSONTABLE - VERSIÓN CORREGIDA (VISUALIZACIÓN COMPLETA)
+# PREVISIÓN DE VACIADO DEL PENDIENTE (MONTE CARLO)
 # =============================================
-def mostrar_con_handsontable(df_filtrado):
-    """
-    Versión funcional que muestra todas las columnas
+SIMULACIONES_VACIADO = 20000
+HORIZONTE_VACIADO_SEMANAS = 104
+SEMANAS_HISTORIA_VACIADO = 26
+
+def simular_vaciado_pendiente(pendiente, nuevos, despachados, rng,
+                              num_simulaciones=SIMULACIONES_VACIADO, horizonte=HORIZONTE_VACIADO_SEMANAS):
+    """Semanas hasta vaciar `pendiente` en cada trayectoria simulada (inf si no se vacía en el horizonte).
+    
+    Las trayectorias remuestrean semanas completas del historial (pares nuevos/despachados, para
+    conservar su correlación) y se simulan todas a la vez como una matriz simulaciones × semanas.
     """
-    import io
-    import streamlit.components.v1 as components
-    import json
-    from datetime import datetime
+    if pendiente <= 0:
+        return np.zeros(num_simulaciones)
+    if len(nuevos) == 0:
+        return np.full(num_simulaciones, np.inf)
+    
+    neto = np.asarray(nuevos, dtype=np.int32) - np.asarray(despachados, dtype=np.int32)
+    semanas = rng.integers(0, len(neto), size=(num_simulaciones, horizonte))
+    trayectorias = pendiente + np.cumsum(neto[semanas], axis=1, dtype=np.int32)
     
-    # 1. Crear copia y formatear fechas de forma SEGURA
-    df_display = df_filtrado.copy()
+    vaciado = trayectorias <= 0
+    return np.where(vaciado.any(axis=1), vaciado.argmax(axis=1) + 1, np.inf)
 
-    df_display['ANTIGÜEDAD EXP. (DÍAS)'] = df_display['ANTIGÜEDAD EXP. (DÍAS)'].round().astype('Int64')
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def calcular_historial_semanal_equipos(_df, huella_datos, fecha_max, semanas_historia=SEMANAS_HISTORIA_VACIADO):
+    """Nuevos y despachados por equipo en las últimas semanas y pendiente actual de cada equipo.
     
-    # Función segura para formatear fechas
-    def formatear_fecha(x):
-        try:
-            # Si es NaT o NaN
-            if pd.isna(x):
-                return ""
-            
-            # Si es string que contiene 9999
-            if isinstance(x, str) and '9999' in str(x):
-                return "09/09/9999"
-            
-            # Si es Timestamp 9999
-            if isinstance(x, pd.Timestamp) and hasattr(x, 'year') and x.year == 9999:
-                return "09/09/9999"
-            
-            # Si es datetime válido
-            if isinstance(x, (pd.Timestamp, datetime)):
-                return x.strftime("%d/%m/%Y")
-            
-            # Si es otro tipo, convertir a string
-            return str(x)
-            
-        except Exception:
-            return ""
+    Las semanas se cuentan hacia atrás desde `fecha_max` (semana 0 = la más reciente) con un
+    bincount por (equipo, semana). El pendiente son los abiertos no despachados a `fecha_max`.
+    Sin FECHA ASIG (no se cargó TRIAJE) los nuevos cuentan 0, como en los KPI.
+    """
+    fecha_max = pd.Timestamp(fecha_max)
+    equipos_validos = _df['EQUIPO'].notna()
+    codigos_equipo, equipos = pd.factorize(_df['EQUIPO'].astype(str).where(equipos_validos), sort=True)
+    
+    def recuento_semanal(fechas):
+        semana = ((fecha_max - fechas).dt.days // 7).to_numpy(dtype=float)
+        mask = (codigos_equipo >= 0) & ~np.isnan(semana) & (semana >= 0) & (semana < semanas_historia)
+        claves = codigos_equipo[mask].astype(np.int64) * semanas_historia + semana[mask].astype(np.int64)
+        recuentos = np.bincount(claves, minlength=len(equipos) * semanas_historia)
+        # Columnas en orden cronológico (la última es la semana más reciente)
+        return recuentos.reshape(len(equipos), semanas_historia)[:, ::-1]
+    
+    fecha_despacho = calcular_fecha_despacho(_df)
+    abiertos = (_df['FECHA APERTURA'] <= fecha_max) & (_df['FECHA CIERRE'].isna() | (_df['FECHA CIERRE'] > fecha_max))
+    no_despachados = fecha_despacho.isna() | (fecha_despacho > fecha_max)
+    mask_pendiente = (abiertos & no_despachados).to_numpy() & (codigos_equipo >= 0)
+    
+    if 'FECHA ASIG' in _df.columns:
+        nuevos = recuento_semanal(_df['FECHA ASIG'])
+    else:
+        nuevos = np.zeros((len(equipos), semanas_historia), dtype=np.int64)
     
-    # Aplicar a columnas de fecha
-    columnas_fecha = [col for col in df_display.columns if 'FECHA' in col.upper()]
+    return {
+        'equipos': list(equipos),
+        'nuevos': nuevos,
+        'despachados': recuento_semanal(fecha_despacho),
+        'pendiente': np.bincount(codigos_equipo[mask_pendiente], minlength=len(equipos)),
+    }
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner="🔮 Simulando vaciado del pendiente...")
+def calcular_prevision_vaciado(_df, _df_kpis_semanales, huella_datos, fecha_max, semanas_historia=SEMANAS_HISTORIA_VACIADO):
+    """Previsión Monte Carlo de las semanas necesarias para vaciar el pendiente (P50/P90).
+    
+    El TOTAL se ajusta con el histórico de KPIs (nuevos, despachados y abiertos no despachados)
+    y cada equipo con su propio historial semanal. `huella_datos` es la clave de la caché.
+    """
+    rng = np.random.default_rng(int(pd.Timestamp(fecha_max).strftime('%Y%m%d')))
+    
+    historia_kpis = _df_kpis_semanales.tail(semanas_historia)
+    series = [(
+        'TOTAL',
+        int(historia_kpis['total_abiertos_no_despachados'].iloc[-1]) if len(historia_kpis) else 0,
+        historia_kpis['nuevos_expedientes'].to_numpy(dtype=np.int32),
+        historia_kpis['despachados_semana'].to_numpy(dtype=np.int32),
+    )]
+    
+    historial = calcular_historial_semanal_equipos(_df, huella_datos, fecha_max, semanas_historia)
+    for i, equipo in enumerate(historial['equipos']):
+        series.append((equipo, int(historial['pendiente'][i]), historial['nuevos'][i], historial['despachados'][i]))
+    
+    filas = []
+    for equipo, pendiente, nuevos, despachados in series:
+        semanas_vaciado = simular_vaciado_pendiente(pendiente, nuevos, despachados, rng)
+        # Percentiles sin interpolar: las trayectorias que no vacían valen inf
+        p50, p90 = np.percentile(semanas_vaciado, [50, 90], method='inverted_cdf')
+        filas.append({
+            'EQUIPO': equipo,
+            'PENDIENTE': pendiente,
+            'NUEVOS_SEMANA': round(float(np.mean(nuevos)), 1) if len(nuevos) else 0.0,
+            'DESPACHADOS_SEMANA': round(float(np.mean(despachados)), 1) if len(despachados) else 0.0,
+            'SEMANAS_P50': p50,
+            'SEMANAS_P90': p90,
+            'PROB_VACIADO': round(float(np.isfinite(semanas_vaciado).mean()) * 100, 1),
+        })
     
-    for col in columnas_fecha:
-        if col in df_display.columns:
-            df_display[col] = df_display[col].apply(formatear_fecha)
+    return pd.DataFrame(filas)
+
+# =============================================
+# ÍNDICE INVERTIDO DE FILTROS (MAPAS DE BITS POR VALOR)
+# =============================================
+COLUMNAS_FILTROS_VISTA = ['ESTADO', 'EQUIPO', 'USUARIO', 'ETIQ. PENÚLTIMO TRAM.', 'ETIQ. ÚLTIMO TRAM.']
+
+# Número de bits a 1 de cada byte (popcount por tabla)
+BITS_POR_BYTE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint16)
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def construir_indice_filtros(_df, huella_datos, columnas=tuple(COLUMNAS_FILTROS_VISTA)):
+    """Índice invertido valor -> mapa de bits de filas para las columnas de los filtros.
     
-    # 2. Preparar datos para Handsontable CORRECTAMENTE
-    # Convertir DataFrame a lista de diccionarios (formato que espera Handsontable)
-    data = df_display.to_dict('records')
+    Cada columna guarda sus valores ordenados y una matriz valores × bytes (filas empaquetadas
+    con np.packbits). Se construye una vez por conjunto de datos (`huella_datos`).
+    """
+    num_filas = len(_df)
+    num_bytes = (num_filas + 7) // 8
+    posiciones = np.arange(num_filas)
+    indice = {'num_filas': num_filas, 'columnas': {}}
     
-    # Preparar columnas
-    columns = []
-    for idx, col_name in enumerate(df_display.columns):
-        col_config = {
-            'data': col_name,
-            'title': col_name,
-            'type': 'text'
+    for columna in columnas:
+        if columna not in _df.columns:
+            continue
+        codigos, valores = pd.factorize(_df[columna], sort=True)
+        validos = codigos >= 0
+        mapas = np.zeros((len(valores), num_bytes), dtype=np.uint8)
+        np.bitwise_or.at(
+            mapas,
+            (codigos[validos], posiciones[validos] >> 3),
+            (0x80 >> (posiciones[validos] & 7)).astype(np.uint8)
+        )
+        indice['columnas'][columna] = {
+            'valores': list(valores),
+            'posicion': {valor: i for i, valor in enumerate(valores)},
+            'mapas': mapas,
         }
-        
-        # Configurar columnas de fecha
-        if 'FECHA' in col_name.upper():
-            col_config.update({
-                'type': 'date',
-                'dateFormat': 'DD/MM/YYYY',
-                'correctFormat': True
-            })
-        
-        # Configurar columnas numéricas
-        elif df_display[col_name].dtype in ['int64', 'float64']:
-            col_config.update({
-                'type': 'numeric',
-                'numericFormat': {
-                    'pattern': '0,0'
-                }
-            })
-        
-        columns.append(col_config)
-    
-    # 3. HTML/JavaScript CORREGIDO
-    hot_html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <script src="https://cdn.jsdelivr.net/npm/handsontable/dist/handsontable.full.min.js"></script>
-        <link href="https://cdn.jsdelivr.net/npm/handsontable/dist/handsontable.full.min.css" rel="stylesheet">
-        <style>
-            body {{
-                margin: 0;
-                padding: 0;
-            }}
-            #hot-container {{
-                width: 100%;
-                height: 600px;
-                overflow: hidden;
-            }}
-            .handsontable {{
-                font-size: 11px;
-            }}
-            .handsontable thead th {{
-                background-color: #007933 !important;
-                color: white !important;
-                font-weight: bold !important;
-            }}
-        </style>
-    </head>
-    <body>
-        <div id="hot-container"></div>
-        
-        <script>
-            // Datos y columnas
-            var data = {json.dumps(data, default=str)};
-            var columns = {json.dumps(columns)};
-            
-            console.log("Datos cargados:", data.length, "registros");
-            console.log("Columnas:", columns.length);
-            
-            // Configuración
-            var config = {{
-                data: data,
-                columns: columns,
-                colHeaders: true,
-                rowHeaders: true,
-                height: 600,
-                width: '100%',
-                autoColumnSize: {{
-                    useHeaders: true,       // IMPORTANTE: Considerar encabezados
-                    syncLimit: 50,          // Reducir para mejor rendimiento
-                    samplingRatio: 10,      // Menor ratio para cálculo más rápido
-                    limitToWindowSize: false // Permitir anchos mayores que la ventana
-                }},
-                manualColumnResize: true,   // Permitir ajuste manual después
-                manualRowResize: true,
-                stretchH: 'all',           // Cambiado de 'last' a 'all' para mejor ajuste
-                licenseKey: 'non-commercial-and-evaluation',
-                filters: true,
-                dropdownMenu: true,
-                contextMenu: true,
-                autoWrapRow: true,
-                wordWrap: true,             // Cambiado a true para mejor visualización
-                columnSorting: true         // Añadido para mejor UX
-            }};
-            
-            // Inicializar
-            var container = document.getElementById('hot-container');
-            var hot = new Handsontable(container, config);
-            
-            // Asegurar que se renderice completamente
-            setTimeout(function() {{
-                hot.render();
-                console.log("Handsontable renderizado");
-            }}, 100);
-        </script>
-    </body>
-    </html>
+    
+    return indice
+
+def mapa_todas_filas(indice):
+    """Mapa de bits con todas las filas del índice"""
+    return np.packbits(np.ones(indice['num_filas'], dtype=bool))
+
+def mapa_seleccion(indice, columna, seleccion):
+    """Unión de los mapas de bits de los valores seleccionados de `columna`"""
+    datos = indice['columnas'][columna]
+    filas = [datos['posicion'][valor] for valor in seleccion if valor in datos['posicion']]
+    return np.bitwise_or.reduce(datos['mapas'][filas], axis=0) if filas else np.zeros_like(mapa_todas_filas(indice))
+
+def opciones_disponibles(indice, columna, mapa):
+    """Valores de `columna` presentes en las filas de `mapa` (popcount de cada intersección)"""
+    if columna not in indice['columnas']:
+        return []
+    datos = indice['columnas'][columna]
+    presentes = BITS_POR_BYTE[datos['mapas'] & mapa].sum(axis=1) > 0
+    return [valor for valor, presente in zip(datos['valores'], presentes) if presente]
+
+def filas_de_mapa(indice, mapa):
+    """Posiciones de las filas marcadas en `mapa`"""
+    return np.flatnonzero(np.unpackbits(mapa, count=indice['num_filas']))
+
+def mapa_de_filas(indice, marcadas):
+    """Mapa de bits a partir de una máscara booleana de filas"""
+    return np.packbits(np.asarray(marcadas, dtype=bool)[:indice['num_filas']])
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=50)
+def contar_valores_mapa(_indice, huella_datos, firma_filtro, _mapa, columnas):
+    """Filas de `_mapa` por valor de cada columna (popcount), de mayor a menor.
+    
+    `firma_filtro` (huella del mapa de bits) y `huella_datos` son la clave de la caché.
+    """
+    conteos = {}
+    for columna in columnas:
+        if columna not in _indice['columnas']:
+            continue
+        datos = _indice['columnas'][columna]
+        cantidades = BITS_POR_BYTE[datos['mapas'] & _mapa].sum(axis=1)
+        orden = np.argsort(-cantidades, kind='stable')
+        orden = orden[cantidades[orden] > 0]
+        conteos[columna] = pd.DataFrame({
+            columna: [datos['valores'][i] for i in orden],
+            'Cantidad': cantidades[orden].astype(np.int64),
+        })
+    return conteos
+
+# =============================================
+# REJILLA PAGINADA (COMPONENTE CON TRANSPORTE POR VENTANAS)
+# =============================================
+FILAS_VENTANA_REJILLA = 500
+
+_rejilla_paginada = components.declare_component(
+    "rejilla_paginada",
+    path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "componentes", "rejilla")
+)
+
+def formatear_fecha_celda(x):
+    """Formatea una celda de fecha de tipo no datetime (texto o mezcla de tipos)"""
+    try:
+        if pd.isna(x):
+            return ""
+        if '9999' in str(x):
+            return "09/09/9999"
+        if isinstance(x, (pd.Timestamp, datetime)):
+            return x.strftime("%d/%m/%Y")
+        return str(x)
+    except Exception:
+        return ""
+
+def formatear_numeros_es(serie, decimales):
+    """Números con formato español (1.000 / 1.000,00); vacío si faltan"""
+    numeros = pd.to_numeric(serie, errors='coerce')
+    texto = numeros.map(lambda valor: f"{valor:,.{decimales}f}", na_action='ignore')
+    return texto.str.translate(str.maketrans(',.', '.,')).fillna('')
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=20)
+def preparar_vista_rejilla(_df, huella_vista, decimales_columnas=()):
+    """Vista formateada y en columnas para la rejilla paginada.
+    
+    Se calcula una vez por firma de filtro (`huella_vista`, huella del DataFrame mostrado).
+    `decimales_columnas` son pares (columna, decimales) que se muestran como texto con formato
+    español; el resto de columnas numéricas se envían como números. `orden` indica cómo comparar
+    cada columna al ordenar o filtrar en el servidor (ver filas_vista_rejilla).
+    """
+    decimales_columnas = dict(decimales_columnas)
+    columnas = []
+    valores = []
+    
+    for col in _df.columns:
+        serie = _df[col]
+        spec = {'titulo': str(col), 'tipo': 'texto', 'orden': 'texto'}
+        
+        if col in decimales_columnas:
+            serie = formatear_numeros_es(serie, decimales_columnas[col])
+            spec.update(alineacion='derecha', orden='numero_es')
+        elif 'FECHA' in str(col).upper():
+            spec['orden'] = 'fecha'
+            if pd.api.types.is_datetime64_any_dtype(serie):
+                serie = serie.dt.strftime("%d/%m/%Y").fillna("")
+            else:
+                serie = serie.map(formatear_fecha_celda)
+        elif pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie):
+            if col == 'ANTIGÜEDAD EXP. (DÍAS)':
+                serie = serie.round()
+            serie = serie.astype(object).where(serie.notna(), None)
+            spec.update(tipo='numerico', orden='numero')
+        else:
+            serie = serie.astype(str).where(serie.notna(), "")
+        
+        columnas.append(spec)
+        valores.append(serie.tolist())
+    
+    return {'huella': huella_vista, 'total': len(_df), 'columnas': columnas, 'valores': valores}
+
+def claves_columna_rejilla(valores, tipo_orden):
+    """Valores de una columna de la vista convertidos a claves comparables (NaN/NaT si faltan)"""
+    serie = pd.Series(valores, dtype=object)
+    if tipo_orden == 'numero':
+        return pd.to_numeric(serie, errors='coerce')
+    if tipo_orden == 'numero_es':
+        texto = serie.astype(str).str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+        return pd.to_numeric(texto, errors='coerce')
+    if tipo_orden == 'fecha':
+        return pd.to_datetime(serie, format='%d/%m/%Y', errors='coerce')
+    return serie.fillna('').astype(str).str.lower()
+
+def argumento_condicion_rejilla(argumento, tipo_orden):
+    """Convierte el argumento de una condición de filtro al tipo de las claves de la columna"""
+    if tipo_orden in ('numero', 'numero_es'):
+        if isinstance(argumento, (int, float)):
+            return float(argumento)
+        texto = str(argumento).strip()
+        if ',' in texto:  # escrito en formato español (1.000,5)
+            texto = texto.replace('.', '').replace(',', '.')
+        return pd.to_numeric(texto, errors='coerce')
+    if tipo_orden == 'fecha':
+        return pd.to_datetime(str(argumento), dayfirst=True, errors='coerce')
+    return str(argumento).lower()
+
+def mascara_condicion_rejilla(valores, tipo_orden, nombre, argumentos):
+    """Filas que cumplen una condición de la fila de filtros de la rejilla.
+    
+    `nombre` es 'contains' (texto contenido) o una comparación ('eq', 'gt', 'gte', 'lt', 'lte')
+    con un único argumento; las condiciones desconocidas o sin valor no filtran.
+    """
+    texto = pd.Series(valores, dtype=object).fillna('').astype(str).str.lower()
+    argumentos = list(argumentos)
+    if not argumentos:
+        return np.ones(len(texto), dtype=bool)
+    
+    patron = str(argumentos[0]).lower()
+    if nombre == 'contains':
+        return texto.str.contains(patron, regex=False).to_numpy()
+    
+    # Comparaciones: numéricas o de fecha según la columna; en texto, igualdad sin mayúsculas
+    if tipo_orden == 'texto':
+        if nombre == 'eq':
+            return (texto == patron).to_numpy()
+        return np.ones(len(texto), dtype=bool)
+    
+    claves = claves_columna_rejilla(valores, tipo_orden)
+    limite = argumento_condicion_rejilla(argumentos[0], tipo_orden)
+    if pd.isna(limite):
+        return np.ones(len(texto), dtype=bool)
+    comparaciones = {
+        'eq': lambda: claves == limite,
+        'gt': lambda: claves > limite,
+        'gte': lambda: claves >= limite,
+        'lt': lambda: claves < limite,
+        'lte': lambda: claves <= limite,
+    }
+    if nombre not in comparaciones:
+        return np.ones(len(texto), dtype=bool)
+    return comparaciones[nombre]().fillna(False).to_numpy(dtype=bool)
+
+def normalizar_estado_rejilla(peticion):
+    """Orden y filtros pedidos por la rejilla como tuplas hashables (vacíos si no son válidos).
+    
+    `orden` es (columna, descendente) o None; `filtros` son (columna, condiciones) con
+    condiciones (nombre, argumentos), que se cumplen todas a la vez.
+    """
+    orden = None
+    filtros = []
+    try:
+        if peticion.get('orden'):
+            orden = (int(peticion['orden']['columna']), bool(peticion['orden']['descendente']))
+        for filtro in peticion.get('filtros') or []:
+            condiciones = tuple(
+                (str(condicion['nombre']), json.dumps(condicion.get('args') or [], ensure_ascii=False))
+                for condicion in filtro.get('condiciones') or []
+            )
+            if condiciones:
+                filtros.append((int(filtro['columna']), condiciones))
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None, ()
+    return orden, tuple(filtros)
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=20)
+def filas_vista_rejilla(_vista, huella_vista, orden=None, filtros=(), fila_total=False):
+    """Posiciones de la vista tras aplicar en el servidor el orden y los filtros de columna de la rejilla.
+    
+    El navegador solo tiene la ventana visible, así que ordenar y filtrar se hace aquí sobre la vista
+    completa; la clave de la caché es la huella de la vista más el estado pedido. La fila de total,
+    si la hay, queda siempre al final.
+    """
+    total = _vista['total'] - (1 if fila_total and _vista['total'] else 0)
+    posiciones = np.arange(total)
+    columnas = _vista['columnas']
+    
+    for columna, condiciones in filtros:
+        if not 0 <= columna < len(columnas):
+            continue
+        valores = _vista['valores'][columna][:total]
+        tipo_orden = columnas[columna].get('orden', 'texto')
+        mascara = np.logical_and.reduce([
+            mascara_condicion_rejilla(valores, tipo_orden, nombre, json.loads(argumentos))
+            for nombre, argumentos in condiciones
+        ])
+        posiciones = posiciones[mascara[posiciones]]
+    
+    if orden is not None and 0 <= orden[0] < len(columnas):
+        columna, descendente = orden
+        claves = claves_columna_rejilla(_vista['valores'][columna][:total], columnas[columna].get('orden', 'texto'))
+        claves = claves.iloc[posiciones].reset_index(drop=True)
+        # Orden estable y vacíos al final en ambos sentidos
+        posiciones = posiciones[claves.sort_values(ascending=not descendente, na_position='last', kind='stable').index.to_numpy()]
+    
+    if total < _vista['total']:
+        posiciones = np.append(posiciones, total)
+    return posiciones
+
+@st.fragment
+def mostrar_rejilla_paginada(vista, clave, altura=600, fila_total=False):
+    """Muestra `vista` en la rejilla enviando solo la ventana de filas que pide el navegador.
+    
+    Las peticiones de ventana al desplazarse solo vuelven a ejecutar este fragmento. Ordenar y
+    filtrar por columna también llega como petición: se aplica en el servidor (filas_vista_rejilla)
+    y forma parte de la clave de la vista que se envía.
     """
+    peticion = st.session_state.get(clave) or {}
+    
+    # El orden y los filtros pedidos valen mientras no cambien los datos de la vista
+    orden, filtros = normalizar_estado_rejilla(peticion) if peticion.get('base') == vista['huella'] else (None, ())
+    if orden is None and not filtros:
+        clave_vista = vista['huella']
+        estado = {'orden': None, 'filtros': []}
+        posiciones = None
+        total = vista['total']
+    else:
+        estado = {'orden': peticion.get('orden'), 'filtros': peticion.get('filtros') or []}
+        firma_estado = hashlib.md5(repr((orden, filtros)).encode('utf-8')).hexdigest()
+        clave_vista = f"{vista['huella']}_{firma_estado}"
+        posiciones = filas_vista_rejilla(vista, vista['huella'], orden, filtros, fila_total)
+        total = len(posiciones)
+    
+    inicio = int(peticion.get('inicio', 0)) if peticion.get('vista') == clave_vista else 0
+    inicio = min(max(inicio, 0), max(total - 1, 0))
+    inicio -= inicio % FILAS_VENTANA_REJILLA
+    fin = inicio + FILAS_VENTANA_REJILLA
+    
+    if posiciones is None:
+        datos = [valores_columna[inicio:fin] for valores_columna in vista['valores']]
+    else:
+        ventana = posiciones[inicio:fin]
+        datos = [[valores_columna[posicion] for posicion in ventana] for valores_columna in vista['valores']]
+    
+    _rejilla_paginada(
+        vista=clave_vista,
+        base=vista['huella'],
+        estado=estado,
+        columnas=vista['columnas'],
+        total=total,
+        inicio=inicio,
+        datos=datos,
+        filas_ventana=FILAS_VENTANA_REJILLA,
+        altura=altura,
+        fila_total=fila_total,
+        key=clave,
+        default=None
+    )
+
+# =============================================
+# REJILLA DE EXPEDIENTES - VERSIÓN CORREGIDA (VISUALIZACIÓN COMPLETA)
+# =============================================
+def mostrar_con_handsontable(df_filtrado, flags_prioridad=None, huella_vista=None):
+    """
+    Versión funcional que muestra todas las columnas.
+    `flags_prioridad` (alineado con las filas) resalta los RUE prioritarios en el Excel exportado.
+    `huella_vista` identifica las filas y su orden (si falta, se calcula a partir de df_filtrado).
+    """
+    # 1. Vista formateada en caché por firma de filtro (sin copiar ni serializar todo el DataFrame)
+    if huella_vista is None:
+        huella_vista = calcular_huella_dataframe(df_filtrado)
+    vista = preparar_vista_rejilla(df_filtrado, huella_vista)
     
-    # 4. Mostrar Handsontable
+    # 2. Mostrar la rejilla paginada
     st.subheader("📊 Vista de expedientes")
-    st.write(f"**Mostrando {len(df_display)} registros - {len(df_display.columns)} columnas**")
+    st.write(f"**Mostrando {vista['total']} registros - {len(vista['columnas'])} columnas**")
     
-    # Mostrar Handsontable
-    components.html(hot_html, height=650, scrolling=False)
+    mostrar_rejilla_paginada(vista, clave="rejilla_expedientes")
     
     # 5. Exportación a Excel (igual que antes, funciona bien)
     st.markdown("---")
@@ -2693,177 +3827,29 @@ def mostrar_con_handsontable(df_filtrado):
                     # Reordenar el DataFrame
                     df_export = df_export[columnas_ordenadas]
                     
-                    # Función segura para exportación
-                    def preparar_fecha_export(x):
-                        try:
-                            if pd.isna(x):
-                                return None
-                            if isinstance(x, pd.Timestamp) and x.year == 9999:
-                                return "09/09/9999"
-                            if isinstance(x, datetime) and x.year == 9999:
-                                return "09/09/9999"
-                            return x
-                        except:
-                            return None
-                    
-                    # Aplicar a columnas de fecha
-                    for col in columnas_fecha:
-                        if col in df_export.columns:
-                            df_export[col] = df_export[col].apply(preparar_fecha_export)
-                    
                     # APLICAR ROUND Y CONVERSIÓN A INT64 PARA ANTIGÜEDAD
                     if 'ANTIGÜEDAD EXP. (DÍAS)' in df_export.columns:
-                        # Aplicar round y convertir a Int64 (que admite NaN)
                         df_export['ANTIGÜEDAD EXP. (DÍAS)'] = df_export['ANTIGÜEDAD EXP. (DÍAS)'].round().astype('Int64')
-                        # Reemplazar <NA> por None para Excel
-                        df_export['ANTIGÜEDAD EXP. (DÍAS)'] = df_export['ANTIGÜEDAD EXP. (DÍAS)'].where(pd.notna, None)
-                    
-                    # Crear Excel
-                    output = io.BytesIO()
-                    
-                    # Usar openpyxl directamente
-                    from openpyxl import Workbook
-                    from openpyxl.utils import get_column_letter
-                    from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-                    
-                    wb = Workbook()
-                    ws = wb.active
-                    ws.title = "Expedientes"
                     
-                    # ============================================================================
-                    # ESCRIBIR ENCABEZADOS DE LA TABLA (FILA 1)
-                    # ============================================================================
-                    
-                    header_fill = PatternFill(start_color="007933", end_color="007933", fill_type="solid")
-                    header_font = Font(color="FFFFFF", bold=True)
-                    header_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-                    
-                    for col_num, header in enumerate(df_export.columns, 1):
-                        cell = ws.cell(row=1, column=col_num, value=header)
-                        cell.fill = header_fill
-                        cell.font = header_font
-                        cell.alignment = header_alignment
-                    
-                    # ============================================================================
-                    # ESCRIBIR DATOS DE LA TABLA (DESDE FILA 2)
-                    # ============================================================================
-                    
-                    data_font = Font(size=10)
-                    number_alignment = Alignment(horizontal="right", vertical="center")
-                    text_alignment = Alignment(horizontal="left", vertical="center")
-                    
-                    for row_num, row in enumerate(df_export.values, 2):
-                        for col_num, value in enumerate(row, 1):
-                            cell = ws.cell(row=row_num, column=col_num, value=value)
-                            cell.font = data_font
-                            
-                            # Aplicar alineación específica según tipo de dato
-                            col_name = df_export.columns[col_num-1]
-                            
-                            # Si es ANTIGÜEDAD o otra columna numérica
-                            if 'ANTIGÜEDAD' in col_name.upper() or 'DÍAS' in col_name.upper():
-                                cell.alignment = number_alignment
-                                # Formato sin decimales para números enteros
-                                if isinstance(value, (int, float)) and not pd.isna(value):
-                                    cell.number_format = '#,##0'
-                            # Si es columna de fecha
-                            elif 'FECHA' in col_name.upper():
-                                cell.alignment = Alignment(horizontal="center", vertical="center")
-                                date_format = 'DD/MM/YYYY'
-                                if isinstance(value, (pd.Timestamp, datetime)):
-                                    cell.number_format = date_format
-                            # Si es columna numérica genérica
-                            elif isinstance(value, (int, float)) and not pd.isna(value):
-                                cell.alignment = number_alignment
-                                # Formato con separador de miles
-                                cell.number_format = '#,##0'
-                            else:
-                                cell.alignment = text_alignment
-                    
-                    # ============================================================================
-                    # APLICAR FORMATO DE FECHA ESPECÍFICO
-                    # ============================================================================
-                    
-                    date_format = 'DD/MM/YYYY'
-                    for col_num, col_name in enumerate(df_export.columns, 1):
-                        if 'FECHA' in col_name.upper():
-                            col_letter = get_column_letter(col_num)
-                            for row in ws.iter_rows(min_row=2, max_row=len(df_export)+1, min_col=col_num, max_col=col_num):
-                                cell = row[0]
-                                if isinstance(cell.value, (pd.Timestamp, datetime)):
-                                    cell.number_format = date_format
-                    
-                    # ============================================================================
-                    # AJUSTAR ANCHOS DE COLUMNA AUTOMÁTICAMENTE
-                    # ============================================================================
-                    
-                    for col_num, column_title in enumerate(df_export.columns, 1):
-                        max_length = 0
-                        column_letter = get_column_letter(col_num)
-                        
-                        # Calcular longitud máxima del contenido
-                        for row_num in range(1, len(df_export) + 2):  # +2 para encabezados
-                            cell_value = ws.cell(row=row_num, column=col_num).value
-                            if cell_value:
-                                # Para números, considerar formato con separador de miles
-                                if isinstance(cell_value, (int, float)):
-                                    formatted_value = f"{cell_value:,.0f}"
-                                    cell_length = len(formatted_value)
-                                else:
-                                    cell_length = len(str(cell_value))
-                                max_length = max(max_length, cell_length)
-                        
-                        # Establecer ancho (mínimo 12, máximo 50)
-                        adjusted_width = min(max_length + 2, 50)
-                        ws.column_dimensions[column_letter].width = max(adjusted_width, 12)
-                    
-                    # ============================================================================
-                    # APLICAR AUTOFILTER
-                    # ============================================================================
-                    
-                    if len(df_export) > 0:
-                        # Determinar el rango de la tabla (encabezados + datos)
-                        start_col = get_column_letter(1)
-                        end_col = get_column_letter(len(df_export.columns))
-                        end_row = len(df_export) + 1  # +1 por los encabezados
-                        
-                        # Aplicar autofilter
-                        ws.auto_filter.ref = f"{start_col}1:{end_col}{end_row}"
-                    
-                    # ============================================================================
-                    # CONGELAR ENCABEZADOS (FILA 1) Y RUE (COLUMNA a)
-                    # ============================================================================
-                    
-                    # Congelar la primera fila para que sea visible al hacer scroll
-                    ws.freeze_panes = 'B2'
-                    
-                    # ============================================================================
-                    # APLICAR BORDES A LA TABLA
-                    # ============================================================================
+                    # Columnas de días sin decimales; las fechas (incluida 09/09/9999) se exportan como fecha de Excel
+                    formatos_numero = {
+                        col: FORMATO_EXCEL_ENTERO for col in df_export.columns
+                        if 'ANTIGÜEDAD' in col.upper() or 'DÍAS' in col.upper()
+                    }
                     
-                    thin_border = Border(
-                        left=Side(style='thin'),
-                        right=Side(style='thin'),
-                        top=Side(style='thin'),
-                        bottom=Side(style='thin')
+                    contenido_excel = exportar_excel_streaming(
+                        df_export, "Expedientes",
+                        formatos_numero=formatos_numero,
+                        ancho_minimo=12,
+                        congelar='B2',
+                        autofiltro=True,
+                        flags_prioridad=flags_prioridad
                     )
                     
-                    for row in ws.iter_rows(min_row=1, max_row=len(df_export)+1, 
-                                        min_col=1, max_col=len(df_export.columns)):
-                        for cell in row:
-                            cell.border = thin_border
-                    
-                    # ============================================================================
-                    # GUARDAR Y MOSTRAR BOTÓN DE DESCARGA
-                    # ============================================================================
-                    
-                    wb.save(output)
-                    output.seek(0)
-                    
                     # Botón de descarga
                     st.download_button(
                         label="⬇️ Descargar Excel",
-                        data=output.read(),
+                        data=contenido_excel,
                         file_name=nombre,
                         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                     )
@@ -2873,11 +3859,15 @@ def mostrar_con_handsontable(df_filtrado):
                 except Exception as e:
                     st.error(f"❌ Error: {e}")
     
-    return df_display
+    return df_filtrado
 
 # =============================================
 # PÁGINA 1: CARGA DE ARCHIVOS
 # =============================================
+# Flags de prioridad a la fecha de referencia (viernes del informe salvo que se elija otra)
+if "df_combinado" in st.session_state:
+    asegurar_flags_prioridad(st.session_state["df_combinado"], obtener_fecha_referencia_prioridad(fecha_max))
+
 if eleccion == "Carga de Archivos":
     st.header("📁 Carga de Archivos")
     
@@ -2891,7 +3881,7 @@ if eleccion == "Carga de Archivos":
             if st.button("🔄 Limpiar cache", help="Limpiar toda la cache y recargar", use_container_width=True):
                 st.cache_data.clear()
                 # Mantener solo los datos esenciales
-                keys_to_keep = ['df_combinado', 'df_usuarios', 'archivos_hash', 'filtro_estado', 'filtro_equipo', 'filtro_usuario']
+                keys_to_keep = ['df_combinado', 'df_usuarios', 'historico_usuarios', 'archivos_hash', 'filtro_estado', 'filtro_equipo', 'filtro_usuario']
                 for key in list(st.session_state.keys()):
                     if key not in keys_to_keep:
                         del st.session_state[key]
@@ -3038,6 +4028,9 @@ if eleccion == "Carga de Archivos":
         if (archivos_actuales != archivos_guardados or 
             "df_combinado" not in st.session_state):
             
+            # Datos nuevos (también si se cae a solo RECTAUTO): la prioridad vuelve al viernes del informe
+            st.session_state.pop('fecha_referencia_prioridad', None)
+            
             with st.spinner("🔄 Procesando archivos combinados..."):
                 try:
                     # Usar la función optimizada de procesamiento combinado
@@ -3049,14 +4042,17 @@ if eleccion == "Carga de Archivos":
                         'documentos': archivo_documentos
                     }
                     
-                    df_combinado, df_usuarios, datos_documentos = procesar_archivos_combinado(archivos_dict)
+                    df_combinado, df_usuarios, datos_documentos, historico_usuarios = procesar_archivos_combinado(archivos_dict)
                     
                     # Convertir columnas de fecha
                     df_combinado = convertir_fechas(df_combinado)
+                    datos_documentos = aplicar_diario_documentos(df_combinado, datos_documentos)
+                    df_combinado = actualizar_flags_prioridad(df_combinado)
                     
                     # Guardar en session_state
-                    st.session_state["df_combinado"] = df_combinado
+                    guardar_df_combinado(df_combinado)
                     st.session_state["df_usuarios"] = df_usuarios
+                    st.session_state["historico_usuarios"] = historico_usuarios
                     st.session_state["datos_documentos"] = datos_documentos
                     st.session_state["archivos_hash"] = archivos_actuales
                     
@@ -3072,8 +4068,9 @@ if eleccion == "Carga de Archivos":
                     # Fallback: usar solo RECTAUTO
                     with st.spinner("🔄 Cargando solo RECTAUTO..."):
                         df_rectauto = cargar_y_procesar_rectauto(archivo_rectauto)
-                        st.session_state["df_combinado"] = df_rectauto
+                        guardar_df_combinado(df_rectauto)
                         st.session_state["df_usuarios"] = None
+                        st.session_state["historico_usuarios"] = None
                         st.session_state["datos_documentos"] = None
                         st.session_state["archivos_hash"] = archivos_actuales
                         st.warning("⚠️ Usando solo archivo RECTAUTO debido a errores en combinación")
@@ -3104,7 +4101,7 @@ if eleccion == "Carga de Archivos":
             st.metric("Total Registros", f"{len(df_combinado):,}".replace(",", "."))
         
         with col2:
-            st.metric("Total Columnas", len(df_combinado.columns))
+            st.metric("Total Columnas", len(sin_columnas_internas(df_combinado).columns))
         
         with col3:
             archivos_usados = 1
@@ -3122,7 +4119,7 @@ if eleccion == "Carga de Archivos":
         
         # Mostrar primeras filas SIN formato condicional para evitar errores
         st.write("**Vista previa del dataset combinado:**")
-        df_mostrar_preview = df_combinado.head(3).copy()
+        df_mostrar_preview = sin_columnas_internas(df_combinado.head(3))
         for col in df_mostrar_preview.select_dtypes(include='datetime').columns:
             df_mostrar_preview[col] = df_mostrar_preview[col].dt.strftime("%d/%m/%Y")
         
@@ -3131,7 +4128,7 @@ if eleccion == "Carga de Archivos":
         # Mostrar columnas disponibles
         st.write("**Columnas disponibles:**")
         columnas_grupos = {}
-        for col in df_combinado.columns:
+        for col in sin_columnas_internas(df_combinado).columns:
             if col == 'FECHA NOTIFICACIÓN':
                 grupo = 'NOTIFICA'
             elif col in ['USUARIO-CSV', 'CALIFICACIÓN', 'OBSERVACIONES', 'FECHA ASIG']:
@@ -3186,171 +4183,105 @@ elif eleccion == "Vista de Expedientes":
     if 'filtro_etiq_ultimo' not in st.session_state:
         st.session_state.filtro_etiq_ultimo = []
 
+    # Filtros en cascada: cada filtro resetea los que dependen de él
+    filtros_cascada = [
+        ('filtro_estado', 'ESTADO'),
+        ('filtro_equipo', 'EQUIPO'),
+        ('filtro_usuario', 'USUARIO'),
+        ('filtro_etiq_penultimo', 'ETIQ. PENÚLTIMO TRAM.'),
+        ('filtro_etiq_ultimo', 'ETIQ. ÚLTIMO TRAM.'),
+    ]
+    
+    def resetear_filtros_vista(desde=0):
+        """Vacía los filtros desde la posición `desde` de la cascada (y el estado de sus widgets)"""
+        for clave, _ in filtros_cascada[desde:]:
+            st.session_state[clave] = []
+            st.session_state.pop(f'{clave}_selector', None)
+    
+    def actualizar_filtro_vista(posicion):
+        """Callback de los multiselect: guarda la selección y resetea los filtros dependientes"""
+        clave = filtros_cascada[posicion][0]
+        st.session_state[clave] = st.session_state[f'{clave}_selector']
+        resetear_filtros_vista(posicion + 1)
+    
     # Botón para resetear filtros
-    if st.sidebar.button("🔄 Mostrar todos / Resetear filtros", use_container_width=True):
-        st.session_state.filtro_estado = []
-        st.session_state.filtro_equipo = []
-        st.session_state.filtro_usuario = []
-        st.session_state.filtro_etiq_penultimo = []
-        st.session_state.filtro_etiq_ultimo = []
-
-        #st.session_state.filtro_estado = sorted(df['ESTADO'].dropna().unique())
-        #st.session_state.filtro_equipo = sorted(df['EQUIPO'].dropna().unique())
-        #st.session_state.filtro_usuario = sorted(df['USUARIO'].dropna().unique())
-        #if 'ETIQ. PENÚLTIMO TRAM.' in df.columns:
-        #    st.session_state.filtro_etiq_penultimo = sorted(df['ETIQ. PENÚLTIMO TRAM.'].dropna().unique())
-        #if 'ETIQ. ÚLTIMO TRAM.' in df.columns:
-        #    st.session_state.filtro_etiq_ultimo = sorted(df['ETIQ. ÚLTIMO TRAM.'].dropna().unique())
-        st.rerun()
-
-    # 1. Primero aplicar filtros secuencialmente para calcular opciones disponibles
-    df_filtrado_temp = df.copy()
-
-    # Aplicar filtro de ESTADO primero
-    if st.session_state.filtro_estado:
-        df_filtrado_temp = df_filtrado_temp[df_filtrado_temp['ESTADO'].isin(st.session_state.filtro_estado)]
-
-    # Calcular EQUIPOS disponibles basados en el filtro de ESTADO
-    equipos_disponibles = sorted(df_filtrado_temp['EQUIPO'].dropna().unique())
-
-    # Aplicar filtro de EQUIPO (si hay selección)
-    equipos_seleccionados = [eq for eq in st.session_state.filtro_equipo if eq in equipos_disponibles]
-    if equipos_seleccionados:
-        df_filtrado_temp = df_filtrado_temp[df_filtrado_temp['EQUIPO'].isin(equipos_seleccionados)]
-
-    # Calcular USUARIOS disponibles basados en filtros de ESTADO y EQUIPO
-    usuarios_disponibles = sorted(df_filtrado_temp['USUARIO'].dropna().unique())
-
-    # Aplicar filtro de USUARIO (si hay selección)
-    usuarios_seleccionados = [us for us in st.session_state.filtro_usuario if us in usuarios_disponibles]
-    if usuarios_seleccionados:
-        df_filtrado_temp = df_filtrado_temp[df_filtrado_temp['USUARIO'].isin(usuarios_seleccionados)]
-
-    # Calcular ETIQ. PENÚLTIMO TRAM. disponibles basados en filtros anteriores
-    etiq_penultimo_disponibles = []
-    if 'ETIQ. PENÚLTIMO TRAM.' in df_filtrado_temp.columns:
-        etiq_penultimo_disponibles = sorted(df_filtrado_temp['ETIQ. PENÚLTIMO TRAM.'].dropna().unique())
-
-    # Aplicar filtro de ETIQ. PENÚLTIMO TRAM. (si hay selección)
-    etiq_penultimo_seleccionados = [etiq for etiq in st.session_state.filtro_etiq_penultimo if etiq in etiq_penultimo_disponibles]
-    if etiq_penultimo_seleccionados:
-        df_filtrado_temp = df_filtrado_temp[df_filtrado_temp['ETIQ. PENÚLTIMO TRAM.'].isin(etiq_penultimo_seleccionados)]
-
-    # Calcular ETIQ. ÚLTIMO TRAM. disponibles basados en todos los filtros anteriores
-    etiq_ultimo_disponibles = []
-    if 'ETIQ. ÚLTIMO TRAM.' in df_filtrado_temp.columns:
-        etiq_ultimo_disponibles = sorted(df_filtrado_temp['ETIQ. ÚLTIMO TRAM.'].dropna().unique())
+    st.sidebar.button(
+        "🔄 Mostrar todos / Resetear filtros", use_container_width=True,
+        on_click=resetear_filtros_vista
+    )
 
-    # Aplicar filtro de ETIQ. ÚLTIMO TRAM. (si hay selección)
-    etiq_ultimo_seleccionados = [etiq for etiq in st.session_state.filtro_etiq_ultimo if etiq in etiq_ultimo_disponibles]
-    if etiq_ultimo_seleccionados:
-        df_filtrado_temp = df_filtrado_temp[df_filtrado_temp['ETIQ. ÚLTIMO TRAM.'].isin(etiq_ultimo_seleccionados)]
+    # 1. Calcular opciones disponibles y filas filtradas con el índice de mapas de bits
+    # (intersecciones sobre bits, sin copiar el DataFrame)
+    huella_df = obtener_huella_df_combinado()
+    indice_filtros = construir_indice_filtros(df, huella_df)
+    mapa_filtrado = mapa_todas_filas(indice_filtros)
+    disponibles = {}
+    seleccionados = {}
+    
+    for clave, columna in filtros_cascada:
+        disponibles[clave] = opciones_disponibles(indice_filtros, columna, mapa_filtrado)
+        seleccionados[clave] = [valor for valor in st.session_state[clave] if valor in disponibles[clave]]
+        if seleccionados[clave]:
+            mapa_filtrado = mapa_filtrado & mapa_seleccion(indice_filtros, columna, seleccionados[clave])
 
     # 2. Ahora crear los widgets de filtro con opciones actualizadas
     st.sidebar.markdown("---")
     st.sidebar.subheader("Filtros Activos")
 
     # FILTRO DE ESTADO (siempre muestra todas las opciones)
-    opciones_estado = sorted(df['ESTADO'].dropna().unique())
-    estado_sel = st.sidebar.multiselect(
+    st.sidebar.multiselect(
         "🔘 Selecciona Estado:",
-        options=opciones_estado,
-        default=st.session_state.filtro_estado,
-        key='filtro_estado_selector'
+        options=disponibles['filtro_estado'],
+        default=seleccionados['filtro_estado'],
+        key='filtro_estado_selector',
+        on_change=actualizar_filtro_vista, args=(0,)
     )
 
     # FILTRO DE EQUIPO (se actualiza según estado seleccionado)
-    equipo_sel = st.sidebar.multiselect(
+    st.sidebar.multiselect(
         "👥 Selecciona Equipo:",
-        options=equipos_disponibles,
-        default=equipos_seleccionados,
-        key='filtro_equipo_selector'
+        options=disponibles['filtro_equipo'],
+        default=seleccionados['filtro_equipo'],
+        key='filtro_equipo_selector',
+        on_change=actualizar_filtro_vista, args=(1,)
     )
 
     # FILTRO DE USUARIO (se actualiza según estado y equipo seleccionados)
-    usuario_sel = st.sidebar.multiselect(
+    st.sidebar.multiselect(
         "👤 Selecciona Usuario:",
-        options=usuarios_disponibles,
-        default=usuarios_seleccionados,
-        key='filtro_usuario_selector'
+        options=disponibles['filtro_usuario'],
+        default=seleccionados['filtro_usuario'],
+        key='filtro_usuario_selector',
+        on_change=actualizar_filtro_vista, args=(2,)
     )
 
     # NUEVOS FILTROS: ETIQ. PENÚLTIMO TRAM. (se actualiza según filtros anteriores)
     if 'ETIQ. PENÚLTIMO TRAM.' in df.columns:
-        etiq_penultimo_sel = st.sidebar.multiselect(
+        st.sidebar.multiselect(
             "🏷️ ETIQ. PENÚLTIMO TRAM.:",
-            options=etiq_penultimo_disponibles,
-            default=etiq_penultimo_seleccionados,
-            key='filtro_etiq_penultimo_selector'
+            options=disponibles['filtro_etiq_penultimo'],
+            default=seleccionados['filtro_etiq_penultimo'],
+            key='filtro_etiq_penultimo_selector',
+            on_change=actualizar_filtro_vista, args=(3,)
         )
     else:
-        etiq_penultimo_sel = []
         st.sidebar.info("ℹ️ Columna 'ETIQ. PENÚLTIMO TRAM.' no disponible")
 
     # NUEVOS FILTROS: ETIQ. ÚLTIMO TRAM. (se actualiza según todos los filtros anteriores)
     if 'ETIQ. ÚLTIMO TRAM.' in df.columns:
-        etiq_ultimo_sel = st.sidebar.multiselect(
+        st.sidebar.multiselect(
             "🏷️ ETIQ. ÚLTIMO TRAM.:",
-            options=etiq_ultimo_disponibles,
-            default=etiq_ultimo_seleccionados,
-            key='filtro_etiq_ultimo_selector'
+            options=disponibles['filtro_etiq_ultimo'],
+            default=seleccionados['filtro_etiq_ultimo'],
+            key='filtro_etiq_ultimo_selector',
+            on_change=actualizar_filtro_vista, args=(4,)
         )
     else:
-        etiq_ultimo_sel = []
         st.sidebar.info("ℹ️ Columna 'ETIQ. ÚLTIMO TRAM.' no disponible")
 
-    # 3. Actualizar session_state cuando cambian los filtros
-    if estado_sel != st.session_state.filtro_estado:
-        st.session_state.filtro_estado = estado_sel
-        # Cuando cambia el estado, resetear todos los filtros dependientes
-        st.session_state.filtro_equipo = []
-        st.session_state.filtro_usuario = []
-        st.session_state.filtro_etiq_penultimo = []
-        st.session_state.filtro_etiq_ultimo = []
-        st.rerun()
-
-    if equipo_sel != st.session_state.filtro_equipo:
-        st.session_state.filtro_equipo = equipo_sel
-        # Cuando cambia el equipo, resetear usuario y etiquetas
-        st.session_state.filtro_usuario = []
-        st.session_state.filtro_etiq_penultimo = []
-        st.session_state.filtro_etiq_ultimo = []
-        st.rerun()
-
-    if usuario_sel != st.session_state.filtro_usuario:
-        st.session_state.filtro_usuario = usuario_sel
-        # Cuando cambia el usuario, resetear etiquetas
-        st.session_state.filtro_etiq_penultimo = []
-        st.session_state.filtro_etiq_ultimo = []
-        st.rerun()
-
-    if 'ETIQ. PENÚLTIMO TRAM.' in df.columns and etiq_penultimo_sel != st.session_state.filtro_etiq_penultimo:
-        st.session_state.filtro_etiq_penultimo = etiq_penultimo_sel
-        # Cuando cambia etiq penúltimo, resetear etiq último
-        st.session_state.filtro_etiq_ultimo = []
-        st.rerun()
-
-    if 'ETIQ. ÚLTIMO TRAM.' in df.columns and etiq_ultimo_sel != st.session_state.filtro_etiq_ultimo:
-        st.session_state.filtro_etiq_ultimo = etiq_ultimo_sel
-        st.rerun()
-
-    # 4. Aplicar filtros finales al DataFrame principal
-    df_filtrado = df.copy()
-
-    if st.session_state.filtro_estado:
-        df_filtrado = df_filtrado[df_filtrado['ESTADO'].isin(st.session_state.filtro_estado)]
-
-    if st.session_state.filtro_equipo:
-        df_filtrado = df_filtrado[df_filtrado['EQUIPO'].isin(st.session_state.filtro_equipo)]
-
-    if st.session_state.filtro_usuario:
-        df_filtrado = df_filtrado[df_filtrado['USUARIO'].isin(st.session_state.filtro_usuario)]
-
-    if 'ETIQ. PENÚLTIMO TRAM.' in df.columns and st.session_state.filtro_etiq_penultimo:
-        df_filtrado = df_filtrado[df_filtrado['ETIQ. PENÚLTIMO TRAM.'].isin(st.session_state.filtro_etiq_penultimo)]
-
-    if 'ETIQ. ÚLTIMO TRAM.' in df.columns and st.session_state.filtro_etiq_ultimo:
-        df_filtrado = df_filtrado[df_filtrado['ETIQ. ÚLTIMO TRAM.'].isin(st.session_state.filtro_etiq_ultimo)]
+    # 3. Filas finales: una sola selección posicional sobre el DataFrame principal
+    df_filtrado = df.iloc[filas_de_mapa(indice_filtros, mapa_filtrado)]
+    mapa_vista = mapa_filtrado
 
     # Mostrar resumen de filtros activos
     st.sidebar.markdown("---")
@@ -3435,9 +4366,8 @@ elif eleccion == "Vista de Expedientes":
         filtros_aplicados = []
         
         if mostrar_solo_amarillos:
-            # Filtrar solo RUE amarillos usando la función corregida
-            df_priorizado_temp = identificar_filas_prioritarias(df_filtrado_temp)
-            mask_amarillo = df_priorizado_temp['_prioridad'] == 1
+            # Filtrar solo RUE amarillos con los flags de prioridad
+            mask_amarillo = obtener_flags_prioridad(df_filtrado_temp) > 0
             if mask_amarillo.any():
                 df_filtrado_temp = df_filtrado_temp[mask_amarillo]
                 filtros_aplicados.append(f"RUE prioritarios: {mask_amarillo.sum()}")
@@ -3470,15 +4400,31 @@ elif eleccion == "Vista de Expedientes":
         # Solo actualizar si se aplicaron filtros
         if filtros_aplicados:
             df_filtrado = df_filtrado_temp
+            mapa_vista = mapa_de_filas(indice_filtros, df.index.isin(df_filtrado.index))
             st.sidebar.success(" | ".join(filtros_aplicados))
 
+    # Fecha a la que se evalúa la prioridad (por defecto, el viernes del informe)
+    fecha_referencia_prioridad = obtener_fecha_referencia_prioridad(fecha_max)
+    
+    def cambiar_fecha_referencia_prioridad():
+        st.session_state['fecha_referencia_prioridad'] = pd.Timestamp(
+            st.session_state['selector_fecha_referencia_prioridad']
+        )
+    
+    st.sidebar.date_input(
+        "📅 Prioridad a fecha de:",
+        value=fecha_referencia_prioridad.date(),
+        format="DD/MM/YYYY",
+        key="selector_fecha_referencia_prioridad",
+        on_change=cambiar_fecha_referencia_prioridad
+    )
+
     # Mostrar estadísticas de los filtros aplicados
     st.sidebar.markdown("---")
     st.sidebar.subheader("Estadísticas")
     
     # Contar filas prioritarias
-    df_priorizado = identificar_filas_prioritarias(df_filtrado)
-    filas_amarillas = df_priorizado['_prioridad'].sum()
+    filas_amarillas = int((obtener_flags_prioridad(df_filtrado) > 0).sum())
     filas_totales = len(df_filtrado)
     
     st.sidebar.write(f"Total filas: {filas_totales}")
@@ -3494,49 +4440,46 @@ elif eleccion == "Vista de Expedientes":
         filas_90_incdocu = (df_filtrado['ETIQ. PENÚLTIMO TRAM.'] == "90 INCDOCU").sum()
         st.sidebar.write(f"Con 90 INCDOCU: {filas_90_incdocu}")
 
-    # Gráficos Generales - CORREGIDOS: datos siempre frescos según filtros
+    # Gráficos Generales: conteos del índice de mapas de bits, en caché por firma del filtro
     st.subheader("📈 Gráficos Generales")
+    firma_vista = hashlib.md5(mapa_vista.tobytes()).hexdigest()
+    conteos_vista = contar_valores_mapa(
+        indice_filtros, huella_df, firma_vista, mapa_vista,
+        tuple(COLUMNAS_FILTROS_VISTA)
+    )
+    
     columnas_graficos = st.columns(3)
     graficos = [("EQUIPO", "Expedientes por equipo"), 
                 ("USUARIO", "Expedientes por usuario"), 
                 ("ESTADO", "Distribución por estado")]
 
     for i, (col, titulo) in enumerate(graficos):
-        if col in df_filtrado.columns:
-            # Calcular el conteo actual (siempre fresco según los filtros)
-            conteo_actual = df_filtrado[col].value_counts().reset_index()
-            conteo_actual.columns = [col, "Cantidad"]
-            
-            # Crear gráfico con datos actualizados (SIN CACHE)
-            fig = crear_grafico_dinamico(conteo_actual, col, titulo)
+        if col in conteos_vista:
+            fig = crear_grafico_dinamico(conteos_vista[col], col, titulo)
             if fig:
                 columnas_graficos[i].plotly_chart(fig, use_container_width=True)
 
     # NUEVOS GRÁFICOS PARA LAS ETIQUETAS
     col1, col2 = st.columns(2)
     with col1:
-        if 'ETIQ. PENÚLTIMO TRAM.' in df_filtrado.columns:
-            conteo_penultimo = df_filtrado['ETIQ. PENÚLTIMO TRAM.'].value_counts().reset_index()
-            conteo_penultimo.columns = ['ETIQ. PENÚLTIMO TRAM.', 'Cantidad']
-            fig_penultimo = crear_grafico_dinamico(conteo_penultimo, 'ETIQ. PENÚLTIMO TRAM.', 'Distribución por ETIQ. PENÚLTIMO TRAM.')
+        if 'ETIQ. PENÚLTIMO TRAM.' in conteos_vista:
+            fig_penultimo = crear_grafico_dinamico(conteos_vista['ETIQ. PENÚLTIMO TRAM.'], 'ETIQ. PENÚLTIMO TRAM.', 'Distribución por ETIQ. PENÚLTIMO TRAM.')
             if fig_penultimo:
                 st.plotly_chart(fig_penultimo, use_container_width=False)
 
     with col2:
-        if 'ETIQ. ÚLTIMO TRAM.' in df_filtrado.columns:
-            conteo_ultimo = df_filtrado['ETIQ. ÚLTIMO TRAM.'].value_counts().reset_index()
-            conteo_ultimo.columns = ['ETIQ. ÚLTIMO TRAM.', 'Cantidad']
-            fig_ultimo = crear_grafico_dinamico(conteo_ultimo, 'ETIQ. ÚLTIMO TRAM.', 'Distribución por ETIQ. ÚLTIMO TRAM.')
+        if 'ETIQ. ÚLTIMO TRAM.' in conteos_vista:
+            fig_ultimo = crear_grafico_dinamico(conteos_vista['ETIQ. ÚLTIMO TRAM.'], 'ETIQ. ÚLTIMO TRAM.', 'Distribución por ETIQ. ÚLTIMO TRAM.')
             if fig_ultimo:
                 st.plotly_chart(fig_ultimo, use_container_width=False)
 
 
-    # Obtener información de la semana si está disponible
-    num_semana_info, fecha_max_str_info, _ = obtener_info_semana_actual(df_filtrado)
-
-    # Mostrar con Handsontable
+    # Mostrar en la rejilla
+    # Clave de la vista: datos + filas filtradas + orden (sin volver a hashear df_filtrado)
     df_mostrar = mostrar_con_handsontable(
-        df_filtrado
+        sin_columnas_internas(df_filtrado),
+        flags_prioridad=obtener_flags_prioridad(df_filtrado),
+        huella_vista=f"{huella_df}_{firma_vista}_{'prioridad' if ordenar_prioridad else 'antiguedad'}"
     )
 
     # Estadísticas generales
@@ -3551,44 +4494,8 @@ elif eleccion == "Vista de Expedientes":
         st.metric("Registros mostrados", f"{registros_mostrados}/{registros_totales}")
 
     with col2:
-        # Contar RUE amarillos - CON NUEVAS CONDICIONES
-        mask_amarillo = pd.Series(False, index=df_filtrado.index)
-        for idx, row in df_filtrado.iterrows():
-            try:
-                etiq_penultimo = row.get('ETIQ. PENÚLTIMO TRAM.', '')
-                fecha_notif = row.get('FECHA NOTIFICACIÓN', None)
-                docum_incorp = row.get('DOCUM.INCORP.', '')
-                
-                # CONDICIÓN 1: "80 PROPRES" con fecha límite superada
-                if (str(etiq_penultimo).strip() == "80 PROPRES" and 
-                    pd.notna(fecha_notif) and 
-                    isinstance(fecha_notif, (pd.Timestamp, datetime))):
-                    
-                    fecha_limite = fecha_notif + timedelta(days=23)
-                    if datetime.now() > fecha_limite:
-                        mask_amarillo[idx] = True
-                
-                # NUEVA CONDICIÓN 2: "50 REQUERIR" con fecha límite superada
-                elif (str(etiq_penultimo).strip() == "50 REQUERIR" and 
-                    pd.notna(fecha_notif) and 
-                    isinstance(fecha_notif, (pd.Timestamp, datetime))):
-                    
-                    fecha_limite = fecha_notif + timedelta(days=23)
-                    if datetime.now() > fecha_limite:
-                        mask_amarillo[idx] = True
-                
-                # NUEVA CONDICIÓN 3: "70 ALEGACI" o "60 CONTESTA"
-                elif str(etiq_penultimo).strip() in ["70 ALEGACI", "60 CONTESTA"]:
-                    mask_amarillo[idx] = True
-                
-                # NUEVA CONDICIÓN 4: DOCUM.INCORP. no vacío Y distinto de "SOLICITUD" o "REITERA SOLICITUD"
-                elif (pd.notna(docum_incorp) and 
-                    str(docum_incorp).strip() != '' and
-                    str(docum_incorp).strip().upper() not in ["SOLICITUD", "REITERA SOLICITUD"]):
-                    mask_amarillo[idx] = True
-                    
-            except:
-                pass
+        # Contar RUE amarillos con los flags de prioridad
+        mask_amarillo = obtener_flags_prioridad(df_filtrado) > 0
         st.metric("RUE prioritarios", f"{mask_amarillo.sum():,}".replace(",", "."))
 
     with col3:
@@ -3607,6 +4514,42 @@ elif eleccion == "Vista de Expedientes":
         else:
             st.metric("Con 90 INCDOCU", "N/A")
 
+    # ALERTAS: expedientes que pasan a prioritarios o superan 120/180 días en los próximos días
+    st.markdown("---")
+    st.subheader("⏰ Próximos Vencimientos por Equipo")
+    
+    dias_horizonte = st.number_input(
+        "Próximos días:", min_value=1, max_value=90, value=7, key="dias_horizonte_vencimientos"
+    )
+    indice_vencimientos = construir_indice_vencimientos(df, huella_df)
+    eventos = consultar_vencimientos(indice_vencimientos, fecha_referencia_prioridad, dias_horizonte)
+    
+    # Solo filas de los filtros actuales; la FECHA LÍMITE solo avisa si aún no es prioritario
+    posiciones_eventos = eventos['POSICION'].to_numpy(dtype=np.int64)
+    visibles = df.index[posiciones_eventos].isin(df_filtrado.index)
+    ya_prioritarios = obtener_flags_prioridad(df)[posiciones_eventos] > 0
+    eventos = eventos[visibles & ~((eventos['TIPO'] == 'FECHA LÍMITE').to_numpy() & ya_prioritarios)]
+    
+    if eventos.empty:
+        st.info(f"ℹ️ Sin vencimientos en los próximos {dias_horizonte} días desde el {fecha_referencia_prioridad.strftime('%d/%m/%Y')}")
+    else:
+        filas_eventos = df.iloc[eventos['POSICION'].to_numpy(dtype=np.int64)]
+        df_alertas = pd.DataFrame({
+            'EQUIPO': filas_eventos['EQUIPO'].to_numpy() if 'EQUIPO' in df.columns else '',
+            'USUARIO': filas_eventos['USUARIO'].to_numpy() if 'USUARIO' in df.columns else '',
+            'RUE': filas_eventos['RUE'].to_numpy() if 'RUE' in df.columns else '',
+            'TIPO': eventos['TIPO'].to_numpy(),
+            'FECHA': eventos['FECHA'].to_numpy(),
+        }).sort_values(['EQUIPO', 'FECHA', 'RUE'], kind='mergesort')
+        
+        col1, col2 = st.columns([1, 2])
+        with col1:
+            resumen_alertas = pd.crosstab(df_alertas['EQUIPO'], df_alertas['TIPO'])
+            st.dataframe(resumen_alertas, use_container_width=True)
+        with col2:
+            df_alertas['FECHA'] = df_alertas['FECHA'].dt.strftime('%d/%m/%Y')
+            st.dataframe(df_alertas, hide_index=True, use_container_width=True, height=300)
+
     # NUEVA SECCIÓN: GESTIÓN DE DOCUMENTACIÓN INCORPORADA
     st.markdown("---")
     st.header("📄 Gestión de Documentación Incorporada")
@@ -3626,42 +4569,39 @@ elif eleccion == "Vista de Expedientes":
             opciones_docu = datos_documentos['opciones']
             opciones_combo = [""] + opciones_docu  # Añadir opción vacía
             
-            # Crear interfaz para editar la documentación
+            # Crear interfaz para editar la documentación: una única rejilla con desplegable
             st.subheader("Editar Documentación Incorporada")
             
-            # Diccionario temporal para almacenar cambios (si no existe)
-            if 'cambios_documentacion_temp' not in st.session_state:
-                st.session_state.cambios_documentacion_temp = {}
+            df_docu_base = pd.DataFrame({
+                'RUE': df_incdocu['RUE'].to_numpy(dtype=object),
+                'DOCUM.INCORP.': df_incdocu['DOCUM.INCORP.'].astype(object).where(
+                    df_incdocu['DOCUM.INCORP.'].notna(), ""
+                ).to_numpy(),
+            })
             
-            # Mostrar tabla editable
-            cambios_realizados = False
-            for idx, row in df_incdocu.iterrows():
-                rue = row['RUE']
-                docum_actual = row.get('DOCUM.INCORP.', '')
-                
-                col1, col2 = st.columns([2, 3])  # Reducir a 2 columnas
-                
-                with col1:
-                    st.write(f"**RUE:** {rue}")
-                
-                with col2:
-                    # Selectbox para elegir documentación
-                    clave_docum = f"docum_{rue}"
-                    nueva_docum = st.selectbox(
-                        "Documentación:",
-                        options=opciones_combo,
-                        index=opciones_combo.index(docum_actual) if docum_actual in opciones_combo else 0,
-                        key=clave_docum,
-                        label_visibility="collapsed"
-                    )
-                    
-                    # Almacenar cambio temporalmente (sin grabar aún)
-                    if nueva_docum != docum_actual:
-                        st.session_state.cambios_documentacion_temp[rue] = nueva_docum
-                        cambios_realizados = True
-                    elif rue in st.session_state.cambios_documentacion_temp:
-                        # Si vuelve al valor original, eliminar del diccionario
-                        del st.session_state.cambios_documentacion_temp[rue]
+            # La versión en la clave permite descartar las ediciones reiniciando el editor
+            version_editor = st.session_state.get('version_editor_documentacion', 0)
+            df_docu_editado = st.data_editor(
+                df_docu_base,
+                column_config={
+                    'RUE': st.column_config.TextColumn("RUE", disabled=True),
+                    'DOCUM.INCORP.': st.column_config.SelectboxColumn(
+                        "Documentación", options=opciones_combo, required=False
+                    ),
+                },
+                hide_index=True,
+                use_container_width=True,
+                num_rows="fixed",
+                key=f"editor_documentacion_{version_editor}"
+            )
+            
+            # Cambios pendientes (sin grabar aún): comparación vectorizada con los valores actuales
+            nuevos_valores = df_docu_editado['DOCUM.INCORP.'].fillna("")
+            modificados = (nuevos_valores != df_docu_base['DOCUM.INCORP.']).to_numpy()
+            st.session_state.cambios_documentacion_temp = dict(zip(
+                df_docu_base['RUE'].to_numpy()[modificados],
+                nuevos_valores.to_numpy()[modificados]
+            ))
             
             # Botón único para guardar todos los cambios
             st.markdown("---")
@@ -3676,12 +4616,22 @@ elif eleccion == "Vista de Expedientes":
                             # Obtener DataFrame combinado
                             df_combinado = st.session_state["df_combinado"]
                             
-                            # Aplicar todos los cambios al DataFrame
-                            for rue, nueva_docum in st.session_state.cambios_documentacion_temp.items():
-                                df_combinado.loc[df_combinado['RUE'] == rue, 'DOCUM.INCORP.'] = nueva_docum
+                            # Aplicar todos los cambios al DataFrame (índice RUE → posiciones)
+                            df_combinado = aplicar_cambios_documentacion(
+                                df_combinado, st.session_state.cambios_documentacion_temp
+                            )
+                            
+                            # Anotar los cambios en el diario compartido (se aplican en la próxima carga)
+                            try:
+                                diario_documentos.registrar(st.session_state.cambios_documentacion_temp, user_env.username)
+                            except OSError as e:
+                                st.warning(f"⚠️ No se pudo anotar en el diario de DOCUMENTOS: {e}")
+                            
+                            # DOCUM.INCORP. interviene en la prioridad: refrescar los flags
+                            df_combinado = actualizar_flags_prioridad(df_combinado)
                             
-                            # Actualizar session_state
-                            st.session_state["df_combinado"] = df_combinado
+                            # Actualizar session_state (los cambios renuevan la huella de los datos)
+                            guardar_df_combinado(df_combinado)
                             
                             # Filtrar para guardar en archivo
                             df_documentos_actualizado = df_combinado[
@@ -3692,7 +4642,7 @@ elif eleccion == "Vista de Expedientes":
                             
                             # Guardar en archivo
                             contenido_actualizado = guardar_documentos_actualizados(
-                                datos_documentos['archivo'], 
+                                datos_documentos['docu'], 
                                 df_documentos_actualizado
                             )
                             
@@ -3703,8 +4653,9 @@ elif eleccion == "Vista de Expedientes":
                                 # Mostrar resumen de cambios
                                 st.success(f"✅ {len(st.session_state.cambios_documentacion_temp)} cambios guardados correctamente")
                                 
-                                # Limpiar cambios temporales
+                                # Limpiar cambios temporales y reiniciar el editor
                                 st.session_state.cambios_documentacion_temp = {}
+                                st.session_state.version_editor_documentacion = version_editor + 1
                                 
                                 # Actualizar cache
                                 st.cache_data.clear()
@@ -3721,6 +4672,7 @@ elif eleccion == "Vista de Expedientes":
                 # Botón para descartar cambios
                 if st.button("🗑️ Descartar Cambios", key="descartar_cambios"):
                     st.session_state.cambios_documentacion_temp = {}
+                    st.session_state.version_editor_documentacion = version_editor + 1
                     st.rerun()
     else:
         st.warning("⚠️ Carga el archivo DOCUMENTOS.xlsx para gestionar la documentación incorporada")
@@ -3747,94 +4699,33 @@ elif eleccion == "Indicadores clave (KPI)":
         st.error("No se pudo encontrar la fecha máxima en los datos")
         st.stop()
     
-    # Crear rango de semanas disponibles
-    fecha_inicio = pd.to_datetime("2022-11-01")
-    semanas_disponibles = pd.date_range(
-        start=fecha_inicio,
-        end=fecha_max,
-        freq='W-FRI'
-    ).tolist()
+    # Semanas disponibles del calendario de la sesión
+    semanas_disponibles = calendario_semanas.semanas
     
     if not semanas_disponibles:
         st.error("No hay semanas disponibles para mostrar")
         st.stop()
     
-    # Inicialización del estado para KPI
-    if 'kpi_semana_index' not in st.session_state:
+    # Inicialización del estado para KPI (o si los nuevos datos tienen menos semanas)
+    if st.session_state.get('kpi_semana_index', len(semanas_disponibles)) >= len(semanas_disponibles):
         st.session_state.kpi_semana_index = len(semanas_disponibles) - 1
-    
-    # Obtener la semana seleccionada actual
-    semana_seleccionada = semanas_disponibles[st.session_state.kpi_semana_index]
-    num_semana_seleccionada = ((semana_seleccionada - FECHA_REFERENCIA).days) // 7 + 1
-    fecha_str = semana_seleccionada.strftime('%d/%m/%Y')
-    
-    # Selector de semana en el área principal
-    st.markdown("---")
-    st.header("🗓️ Selector de Semana")
-    
-    # Crear etiquetas formateadas para el slider
-    opciones_slider = []
-    for i, fecha in enumerate(semanas_disponibles):
-        num_semana = ((fecha - FECHA_REFERENCIA).days) // 7 + 1
-        fecha_str_opcion = fecha.strftime('%d/%m/%Y')
-        opciones_slider.append(f"Semana {num_semana} ({fecha_str_opcion})")
-    
-    # Slider
-    semana_index_slider = st.select_slider(
-        "Selecciona la semana:",
-        options=list(range(len(semanas_disponibles))),
-        value=st.session_state.kpi_semana_index,
-        format_func=lambda x: opciones_slider[x]
-    )
-    
-    # Actualizar el índice si el slider cambió
-    if semana_index_slider != st.session_state.kpi_semana_index:
-        st.session_state.kpi_semana_index = semana_index_slider
-        st.rerun()
-    
-    # RECALCULAR después de posibles cambios del slider
-    semana_seleccionada = semanas_disponibles[st.session_state.kpi_semana_index]
-    num_semana_seleccionada = ((semana_seleccionada - FECHA_REFERENCIA).days) // 7 + 1
-    fecha_str = semana_seleccionada.strftime('%d/%m/%Y')
-    
-    # Mostrar información de la semana seleccionada
-    st.info(f"**Semana seleccionada:** {fecha_str} (Semana {num_semana_seleccionada})")
-    
-    # Sidebar con botones de navegación
-    with st.sidebar:
-        st.header("🗓️ Navegación por Semanas")
-        
-        st.write(f"**Semana actual:**")
-        st.write(f"{fecha_str}")
-        st.write(f"(Semana {num_semana_seleccionada})")
-        
-        st.markdown("---")
-        
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            if st.button("◀️ Anterior", use_container_width=True, key="btn_anterior_kpi"):
-                nuevo_indice = st.session_state.kpi_semana_index - 1
-                if nuevo_indice >= 0:
-                    st.session_state.kpi_semana_index = nuevo_indice
-                    st.rerun()
-        
-        with col2:
-            if st.button("Siguiente ▶️", use_container_width=True, key="btn_siguiente_kpi"):
-                nuevo_indice = st.session_state.kpi_semana_index + 1
-                if nuevo_indice < len(semanas_disponibles):
-                    st.session_state.kpi_semana_index = nuevo_indice
-                    st.rerun()
-        
-        st.write(f"**Posición:** {st.session_state.kpi_semana_index + 1} de {len(semanas_disponibles)}")
-        
-        if st.button("📅 Ir a semana actual", use_container_width=True, key="btn_actual_kpi"):
-            st.session_state.kpi_semana_index = len(semanas_disponibles) - 1
-            st.rerun()
 
     # Calcular KPIs para todas las semanas (usando cache)
     df_kpis_semanales = calcular_kpis_todas_semanas_optimizado(df, semanas_disponibles, FECHA_REFERENCIA, fecha_max)
 
+    # Etiquetas del slider (ya formateadas en el calendario)
+    opciones_slider = calendario_semanas.etiquetas
+    
+    # Callbacks de navegación: cambian la semana antes de volver a ejecutar el panel (sin st.rerun)
+    def ir_a_semana_kpi(indice):
+        st.session_state.kpi_semana_index = min(max(indice, 0), len(semanas_disponibles) - 1)
+    
+    def mover_semana_kpi(desplazamiento):
+        ir_a_semana_kpi(st.session_state.kpi_semana_index + desplazamiento)
+    
+    def seleccionar_semana_kpi():
+        ir_a_semana_kpi(st.session_state.selector_semana_kpi)
+
     # Función para mostrar los nuevos KPIs principales
     def mostrar_kpis_principales(_df_kpis, _semana_seleccionada, _num_semana):
         kpis_semana = _df_kpis[_df_kpis['semana_numero'] == _num_semana].iloc[0]
@@ -4061,185 +4952,125 @@ elif eleccion == "Indicadores clave (KPI)":
                 )
 
 
-    # Mostrar dashboard principal
-    mostrar_kpis_principales(df_kpis_semanales, semana_seleccionada, num_semana_seleccionada)
-
-    # GRÁFICO DE EVOLUCIÓN TEMPORAL (ACTUALIZADO) - CORREGIDO
-    st.markdown("---")
-    st.subheader("📈 Evolución de KPIs Principales y Porcentajes")
-
-    datos_grafico = df_kpis_semanales.copy()
-    col1, col2, col3 = st.columns(3)
-    num_semana_seleccionada = ((semana_seleccionada - FECHA_REFERENCIA).days) // 7 + 1
-
-    # --- Gráfico 1: KPI principales (sin "Abiertos") ---
-    with col1:
-        fig1 = px.line(
-            datos_grafico,
-            x='semana_numero',
-            y=['nuevos_expedientes', 'despachados_semana', 'expedientes_cerrados'],
-            title='Evolución de Expedientes (Nuevos, Despachados, Cerrados)',
-            labels={'semana_numero': 'Semana', 'value': 'Cantidad', 'variable': 'KPI'},
-            color_discrete_map={
-                'nuevos_expedientes': '#1f77b4',
-                'despachados_semana': '#ff7f0e',
-                'expedientes_cerrados': '#2ca02c'
-            }
-        )
-        fig1.update_layout(
-            height=400,
-            hovermode="x unified",
-            legend_title="KPI",
-            legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='center', x=0.5)
-        )
-        # Línea discontinua vertical indicando la semana seleccionada
-        fig1.add_vline(
-            x=num_semana_seleccionada,
-            line_dash="dash",
-            line_color="red",
-            annotation_text=f"Semana {num_semana_seleccionada}",
-            annotation_position="top left"
-        )
-        st.plotly_chart(fig1, use_container_width=True)
-
-    # --- Gráfico 2: Solo "Expedientes Abiertos" ---
-    with col2:
-        fig2 = px.line(
-            datos_grafico,
-            x='semana_numero',
-            y=['total_abiertos'],
-            title='Evolución de Expedientes Abiertos',
-            labels={'semana_numero': 'Semana', 'value': 'Cantidad', 'variable': 'KPI'},
-            color_discrete_map={'total_abiertos': '#d62728'}
-        )
-        fig2.update_layout(
-            height=400,
-            hovermode="x unified",
-            legend_title="KPI",
-            legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='center', x=0.5)
-        )
-        # Línea discontinua vertical indicando la semana seleccionada
-        fig2.add_vline(
-            x=num_semana_seleccionada,
-            line_dash="dash",
-            line_color="red",
-            annotation_text=f"Semana {num_semana_seleccionada}",
-            annotation_position="top left"
-        )
-        st.plotly_chart(fig2, use_container_width=True)
-
-    # --- Gráfico 3: Porcentajes (4) ---
-    with col3:
-        fig3 = px.line(
-            datos_grafico,
-            x='semana_numero',
-            y=[
-                'c_abs_despachados_sem', 'c_abs_despachados_tot',
-                'c_abs_cerrados_sem', 'c_abs_cerrados_tot'
-            ],
-            title='Evolución de Coeficientes de Absorción (%)',
-            labels={'semana_numero': 'Semana', 'value': 'Porcentaje (%)', 'variable': 'Indicador'},
-            color_discrete_map={
-                'c_abs_despachados_sem': '#9467bd',
-                'c_abs_despachados_tot': '#c5b0d5',
-                'c_abs_cerrados_sem': '#8c564b',
-                'c_abs_cerrados_tot': '#c49c94'
-            }
-        )
-        fig3.update_layout(
-            height=400,
-            hovermode="x unified",
-            legend_title="Indicador",
-            legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='center', x=0.5)
+    @st.fragment
+    def panel_semana_kpi():
+        """Selector de semana, KPIs y gráficos de evolución.
+        
+        La navegación solo vuelve a ejecutar este panel: los gráficos se construyen
+        una vez por conjunto de datos y solo se mueve la marca de la semana.
+        """
+        semana_seleccionada = semanas_disponibles[st.session_state.kpi_semana_index]
+        num_semana_seleccionada = calendario_semanas.numero_semana(st.session_state.kpi_semana_index)
+        fecha_str = semana_seleccionada.strftime('%d/%m/%Y')
+        
+        # Selector de semana en el área principal
+        st.markdown("---")
+        st.header("🗓️ Selector de Semana")
+        
+        # Slider (sincronizado con la semana elegida con los botones)
+        st.session_state.selector_semana_kpi = st.session_state.kpi_semana_index
+        st.select_slider(
+            "Selecciona la semana:",
+            options=list(range(len(semanas_disponibles))),
+            format_func=lambda x: opciones_slider[x],
+            key="selector_semana_kpi",
+            on_change=seleccionar_semana_kpi
         )
-        # Línea discontinua vertical indicando la semana seleccionada
-        fig3.add_vline(
-            x=num_semana_seleccionada,
-            line_dash="dash",
-            line_color="red",
-            annotation_text=f"Semana {num_semana_seleccionada}",
-            annotation_position="top left"
+        
+        # Botones de navegación
+        col1, col2, col3, col4 = st.columns([1, 1, 1, 2])
+        
+        with col1:
+            st.button("◀️ Anterior", use_container_width=True, key="btn_anterior_kpi",
+                      on_click=mover_semana_kpi, args=(-1,))
+        
+        with col2:
+            st.button("Siguiente ▶️", use_container_width=True, key="btn_siguiente_kpi",
+                      on_click=mover_semana_kpi, args=(1,))
+        
+        with col3:
+            st.button("📅 Ir a semana actual", use_container_width=True, key="btn_actual_kpi",
+                      on_click=ir_a_semana_kpi, args=(len(semanas_disponibles) - 1,))
+        
+        with col4:
+            st.write(f"**Posición:** {st.session_state.kpi_semana_index + 1} de {len(semanas_disponibles)}")
+        
+        # Mostrar información de la semana seleccionada
+        st.info(f"**Semana seleccionada:** {fecha_str} (Semana {num_semana_seleccionada})")
+        
+        # Mostrar dashboard principal
+        mostrar_kpis_principales(df_kpis_semanales, semana_seleccionada, num_semana_seleccionada)
+        
+        # GRÁFICOS DE EVOLUCIÓN: figuras ya construidas, solo se mueve la línea de la semana
+        modo_ligero = st.toggle(
+            "⚡ Gráficos ligeros (WebGL, diezmados)",
+            value=len(df_kpis_semanales) > SEMANAS_MODO_LIGERO_KPI,
+            key="modo_ligero_graficos_kpi",
+            help=f"Recomendado a partir de {SEMANAS_MODO_LIGERO_KPI} semanas de historia"
         )
-        st.plotly_chart(fig3, use_container_width=True)
+        figuras = obtener_figuras_evolucion_kpi(df_kpis_semanales, modo_ligero)
+        titulos_bloque = {
+            'evolucion': "📈 Evolución de KPIs Principales y Porcentajes",
+            'tiempos': "⏱️ Tiempos de Tramitación",
+        }
+        for bloque, titulo_bloque in titulos_bloque.items():
+            st.markdown("---")
+            st.subheader(titulo_bloque)
+            
+            indices = [i for i, spec in enumerate(GRAFICOS_EVOLUCION_KPI) if spec['bloque'] == bloque]
+            for columna, i in zip(st.columns(len(indices)), indices):
+                with columna:
+                    st.plotly_chart(
+                        marcar_semana_en_figura(figuras[i], num_semana_seleccionada),
+                        use_container_width=True,
+                        key=f"grafico_evolucion_kpi_{i}"
+                    )
+    
+    panel_semana_kpi()
 
-    # -------------------------------------------------------------
-    # SEGUNDO BLOQUE: TIEMPOS DE TRAMITACIÓN
-    # -------------------------------------------------------------
+    # PREVISIÓN DE VACIADO DEL PENDIENTE
     st.markdown("---")
-    st.subheader("⏱️ Tiempos de Tramitación")
-
-    col1, col2 = st.columns(2)
-
-    # --- Gráfico 1: Tiempos medios y percentiles 90 ---
-    with col1:
-        fig_tiempo = px.line(
-            datos_grafico,
-            x='semana_numero',
-            y=[
-                'tiempo_medio_despachados', 'tiempo_medio_cerrados',
-                'percentil_90_despachados', 'percentil_90_cerrados'
-            ],
-            title='Tiempos Medios y Percentiles 90 (días)',
-            labels={'semana_numero': 'Semana', 'value': 'Días', 'variable': 'Indicador'},
-            color_discrete_map={
-                'tiempo_medio_despachados': '#ff7f0e',
-                'tiempo_medio_cerrados': '#2ca02c',
-                'percentil_90_despachados': '#ffbb78',
-                'percentil_90_cerrados': '#98df8a'
-            }
-        )
-        fig_tiempo.update_layout(
-            height=400,
-            hovermode="x unified",
-            legend_title="Indicador",
-            legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='center', x=0.5)
-        )
-        # Línea discontinua vertical indicando la semana seleccionada
-        fig_tiempo.add_vline(
-            x=num_semana_seleccionada,
-            line_dash="dash",
-            line_color="red",
-            annotation_text=f"Semana {num_semana_seleccionada}",
-            annotation_position="top left"
-        )
-        st.plotly_chart(fig_tiempo, use_container_width=True)
-
-    # --- Gráfico 2: Porcentajes 120/180 ---
-    with col2:
-        fig_percentiles = px.line(
-            datos_grafico,
-            x='semana_numero',
-            y=[
-                'percentil_180_despachados', 'percentil_120_despachados',
-                'percentil_180_cerrados', 'percentil_120_cerrados'
-            ],
-            title='Porcentaje de Expedientes ≤120 y ≤180 días (%)',
-            labels={'semana_numero': 'Semana', 'value': 'Porcentaje (%)', 'variable': 'Indicador'},
-            color_discrete_map={
-                'percentil_180_despachados': '#ff7f0e',
-                'percentil_120_despachados': '#ffddaa',
-                'percentil_180_cerrados': '#2ca02c',
-                'percentil_120_cerrados': '#98df8a'
+    st.subheader("🔮 Previsión de Vaciado del Pendiente")
+    st.caption(
+        f"{SIMULACIONES_VACIADO:,} trayectorias por equipo remuestreando las últimas {SEMANAS_HISTORIA_VACIADO} "
+        f"semanas de nuevos y despachados (horizonte de {HORIZONTE_VACIADO_SEMANAS} semanas)".replace(",", ".")
+    )
+    
+    # Los nuevos salen de FECHA ASIG (TRIAJE): sin ella los KPI cuentan 0 nuevos por semana
+    # y la simulación daría un vaciado irreal
+    if 'FECHA ASIG' not in df.columns:
+        st.info("ℹ️ La previsión necesita la FECHA ASIG del archivo TRIAJE: cárgalo para calcularla")
+    else:
+        df_prevision = calcular_prevision_vaciado(df, df_kpis_semanales, obtener_huella_df_combinado(), fecha_max)
+    
+        def formatear_semanas_vaciado(semanas):
+            if np.isinf(semanas):
+                return f"> {HORIZONTE_VACIADO_SEMANAS}"
+            fecha_vaciado = fecha_max + timedelta(weeks=float(semanas))
+            return f"{semanas:.0f} ({fecha_vaciado.strftime('%d/%m/%Y')})"
+    
+        df_prevision_mostrar = df_prevision.copy()
+        for columna in ['SEMANAS_P50', 'SEMANAS_P90']:
+            df_prevision_mostrar[columna] = df_prevision_mostrar[columna].map(formatear_semanas_vaciado)
+    
+        st.dataframe(
+            df_prevision_mostrar,
+            hide_index=True,
+            use_container_width=True,
+            column_config={
+                'PENDIENTE': st.column_config.NumberColumn("Pendiente"),
+                'NUEVOS_SEMANA': st.column_config.NumberColumn("Nuevos/semana", format="%.1f"),
+                'DESPACHADOS_SEMANA': st.column_config.NumberColumn("Despachados/semana", format="%.1f"),
+                'SEMANAS_P50': st.column_config.TextColumn("Semanas P50 (fecha)"),
+                'SEMANAS_P90': st.column_config.TextColumn("Semanas P90 (fecha)"),
+                'PROB_VACIADO': st.column_config.ProgressColumn(
+                    "Prob. vaciado en horizonte", format="%.1f%%", min_value=0, max_value=100
+                ),
             }
         )
-        fig_percentiles.update_layout(
-            height=400,
-            hovermode="x unified",
-            legend_title="Indicador",
-            legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='center', x=0.5)
-        )
-        # Línea discontinua vertical indicando la semana seleccionada
-        fig_percentiles.add_vline(
-            x=num_semana_seleccionada,
-            line_dash="dash",
-            line_color="red",
-            annotation_text=f"Semana {num_semana_seleccionada}",
-            annotation_position="top left"
-        )
-        st.plotly_chart(fig_percentiles, use_container_width=True)
 
 # =============================================
-# PÁGINA 4: ANÁLISIS DEL RENDIMIENTO - MODIFICADO CON HANDSONTABLE
+# PÁGINA 4: ANÁLISIS DEL RENDIMIENTO - MODIFICADO CON REJILLA
 # =============================================
 elif eleccion == "Análisis del Rendimiento":
     st.header("📈 Análisis del Rendimiento")
@@ -4273,7 +5104,14 @@ elif eleccion == "Análisis del Rendimiento":
     
     # Calcular datos de rendimiento (AGRUPDOS POR USUARIO)
     with st.spinner("📊 Calculando indicadores de rendimiento (agrupados por usuario)..."):
-        df_rendimiento = calcular_rendimiento_usuarios_agrupado(df, df_usuarios, fecha_max)
+        historico_usuarios = st.session_state.get("historico_usuarios", None)
+        huella_rendimiento = (
+            f"{obtener_huella_df_combinado()}_{calcular_huella_dataframe(df_usuarios)}_"
+            f"{calcular_huella_historico_usuarios(historico_usuarios)}_{fecha_max}"
+        )
+        df_rendimiento, puente_equipos = calcular_rendimiento_usuarios_agrupado(
+            df, df_usuarios, fecha_max, huella_rendimiento, historico_usuarios
+        )
     
     if df_rendimiento.empty:
         st.warning("⚠️ No se encontraron datos de rendimiento para mostrar")
@@ -4317,37 +5155,21 @@ elif eleccion == "Análisis del Rendimiento":
         st.rerun()
     
     # 1. Aplicar filtros secuencialmente para calcular opciones disponibles
-    df_filtrado_temp = df_rendimiento.copy()
-    
-    # Aplicar filtro de ESTADO primero
+    # (máscaras booleanas sobre df_rendimiento; los equipos salen de la tabla puente)
+    mask_estado = np.ones(len(df_rendimiento), dtype=bool)
     if st.session_state.filtro_estado_rendimiento:
-        df_filtrado_temp = df_filtrado_temp[df_filtrado_temp['ESTADO'].isin(st.session_state.filtro_estado_rendimiento)]
-    
-    # MODIFICACIÓN: Para filtrar por EQUIPO, necesitamos buscar en la columna EQUIPOS (que contiene strings)
-    equipos_disponibles = []
-    if not df_filtrado_temp.empty:
-        # Extraer todos los equipos únicos de la columna EQUIPOS
-        todos_equipos = set()
-        for equipos_str in df_filtrado_temp['EQUIPOS'].dropna():
-            # Dividir por comas y limpiar
-            equipos_lista = [eq.strip() for eq in str(equipos_str).split(',')]
-            todos_equipos.update(equipos_lista)
-        equipos_disponibles = sorted(todos_equipos)
-    
-    # Aplicar filtro de EQUIPO (búsqueda en string)
+        mask_estado = df_rendimiento['ESTADO'].isin(st.session_state.filtro_estado_rendimiento).to_numpy()
+    
+    # Equipos con algún usuario que cumpla el filtro de ESTADO
+    equipos_disponibles = equipos_en_filas(puente_equipos, mask_estado)
+    
+    # Usuarios que tengan al menos uno de los equipos seleccionados
+    mask_equipo = np.ones(len(df_rendimiento), dtype=bool)
     if st.session_state.filtro_equipo_rendimiento:
-        # Filtrar usuarios que tengan al menos uno de los equipos seleccionados
-        mask_equipo = pd.Series(False, index=df_filtrado_temp.index)
-        for i, row in df_filtrado_temp.iterrows():
-            equipos_usuario = str(row['EQUIPOS']).split(',') if pd.notna(row['EQUIPOS']) else []
-            equipos_usuario = [eq.strip() for eq in equipos_usuario]
-            # Verificar si hay intersección entre equipos del usuario y equipos seleccionados
-            if any(eq in equipos_usuario for eq in st.session_state.filtro_equipo_rendimiento):
-                mask_equipo[i] = True
-        df_filtrado_temp = df_filtrado_temp[mask_equipo]
+        mask_equipo = filas_de_equipos(puente_equipos, st.session_state.filtro_equipo_rendimiento)
     
     # Calcular USUARIOS disponibles basados en filtros anteriores
-    usuarios_disponibles = sorted(df_filtrado_temp['USUARIO'].dropna().unique())
+    usuarios_disponibles = sorted(df_rendimiento.loc[mask_estado & mask_equipo, 'USUARIO'].dropna().unique())
     
     # 2. Crear widgets de filtro con opciones actualizadas
     st.sidebar.markdown("---")
@@ -4393,24 +5215,12 @@ elif eleccion == "Análisis del Rendimiento":
         st.session_state.filtro_usuario_rendimiento = usuario_sel
         st.rerun()
     
-    # 4. Aplicar filtros finales al DataFrame principal
-    df_filtrado = df_rendimiento.copy()
-    
-    if st.session_state.filtro_estado_rendimiento:
-        df_filtrado = df_filtrado[df_filtrado['ESTADO'].isin(st.session_state.filtro_estado_rendimiento)]
-    
-    # Aplicar filtro de EQUIPO (búsqueda en columna EQUIPOS)
-    if st.session_state.filtro_equipo_rendimiento:
-        mask_equipo = pd.Series(False, index=df_filtrado.index)
-        for i, row in df_filtrado.iterrows():
-            equipos_usuario = str(row['EQUIPOS']).split(',') if pd.notna(row['EQUIPOS']) else []
-            equipos_usuario = [eq.strip() for eq in equipos_usuario]
-            if any(eq in equipos_usuario for eq in st.session_state.filtro_equipo_rendimiento):
-                mask_equipo[i] = True
-        df_filtrado = df_filtrado[mask_equipo]
-    
+    # 4. Aplicar filtros finales al DataFrame principal (conserva el índice posicional del puente)
+    mask_usuario = np.ones(len(df_rendimiento), dtype=bool)
     if st.session_state.filtro_usuario_rendimiento:
-        df_filtrado = df_filtrado[df_filtrado['USUARIO'].isin(st.session_state.filtro_usuario_rendimiento)]
+        mask_usuario = df_rendimiento['USUARIO'].isin(st.session_state.filtro_usuario_rendimiento).to_numpy()
+    
+    df_filtrado = df_rendimiento[mask_estado & mask_equipo & mask_usuario]
     
     # Mostrar resumen de filtros
     st.sidebar.markdown("---")
@@ -4451,11 +5261,7 @@ elif eleccion == "Análisis del Rendimiento":
         rendimiento_semanal_agrupado = df_agrupar['RENDIMIENTO_SEMANAL'].mean()
         
         # Obtener lista de equipos únicos
-        todos_equipos = set()
-        for equipos_str in df_agrupar['EQUIPOS'].dropna():
-            equipos_lista = [eq.strip() for eq in str(equipos_str).split(',')]
-            todos_equipos.update(equipos_lista)
-        equipos_str = ', '.join(sorted(todos_equipos))
+        equipos_str = ', '.join(equipos_en_filas(puente_equipos, df_agrupar.index))
         
         return {
             'USUARIO': 'TOTAL',
@@ -4475,239 +5281,43 @@ elif eleccion == "Análisis del Rendimiento":
     total_general = calcular_totales_agrupados_usuarios(df_filtrado)
     
     # =============================================
-    # FUNCIÓN PARA MOSTRAR CON HANDSONTABLE - ESPECÍFICA PARA RENDIMIENTO
+    # FUNCIÓN PARA MOSTRAR EN LA REJILLA - ESPECÍFICA PARA RENDIMIENTO
     # =============================================
     
     def mostrar_rendimiento_con_handsontable(df_rendimiento, incluir_totales=True):
         """
-        Versión funcional que muestra la tabla de rendimiento con Handsontable
+        Versión funcional que muestra la tabla de rendimiento en la rejilla
         Incluye formato específico para números
         """
-        import io
-        import streamlit.components.v1 as components
-        import json
-        from datetime import datetime
-        
-        # 1. Crear copia y formatear datos según especificaciones
-        df_display = df_rendimiento.copy()
-        
-        # Añadir fila de total general si corresponde
+        # 1. Añadir fila de total general si corresponde
+        df_display = df_rendimiento
         if incluir_totales and total_general:
             df_display = pd.concat([df_display, pd.DataFrame([total_general])], ignore_index=True)
         
-        # 2. Preparar datos para Handsontable con formato específico
-        # Función para formatear números según especificaciones
-        def formatear_numero(valor, es_decimal=True):
-            try:
-                if pd.isna(valor):
-                    return ""
-                
-                # Convertir a float para formatear
-                num_val = float(valor)
-                
-                if es_decimal:
-                    # Formato para números con decimales: 1.000,00
-                    return f"{num_val:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-                else:
-                    # Formato para números enteros: 1.000
-                    return f"{num_val:,.0f}".replace(",", "X").replace(".", ",").replace("X", ".")
-            except:
-                return str(valor) if not pd.isna(valor) else ""
-        
-        # Aplicar formatos específicos a cada columna
-        for col in df_display.columns:
-            if col in ['EXPEDIENTES_DESPACHADOS', 'POTENCIAL_ANUAL']:
-                # Números enteros: 1.000
-                df_display[col] = df_display[col].apply(lambda x: formatear_numero(x, es_decimal=False))
-            elif col in ['SEMANAS_EFECTIVAS', 'RENDIMIENTO_TOTAL', 'RENDIMIENTO_ANUAL', 
-                        'RENDIMIENTO_TRIMESTRAL', 'RENDIMIENTO_MENSUAL', 'RENDIMIENTO_SEMANAL']:
-                # Números con decimales: 1.000,00 (2 decimales)
-                df_display[col] = df_display[col].apply(lambda x: formatear_numero(x, es_decimal=True))
-        
-        # 3. Preparar datos para Handsontable
-        data = df_display.to_dict('records')
-        
-        # 4. Preparar columnas con configuración específica
-        columns = []
-        for idx, col_name in enumerate(df_display.columns):
-            col_config = {
-                'data': col_name,
-                'title': col_name,
-                'type': 'text',
-                'width': 100  # Ancho mínimo
-            }
-            
-            # Configurar columnas numéricas con formato específico
-            if col_name in ['EXPEDIENTES_DESPACHADOS', 'POTENCIAL_ANUAL']:
-                col_config.update({
-                    'type': 'numeric',
-                    'numericFormat': {
-                        'pattern': '0,0',  # Enteros: 1.000
-                        'culture': 'es-ES'  # Usar formato español
-                    }
-                })
-            elif col_name in ['SEMANAS_EFECTIVAS', 'RENDIMIENTO_TOTAL', 'RENDIMIENTO_ANUAL', 
-                             'RENDIMIENTO_TRIMESTRAL', 'RENDIMIENTO_MENSUAL', 'RENDIMIENTO_SEMANAL']:
-                col_config.update({
-                    'type': 'numeric',
-                    'numericFormat': {
-                        'pattern': '0,0.00',  # Decimales: 1.000,00
-                        'culture': 'es-ES'    # Usar formato español
-                    }
-                })
-            
-            columns.append(col_config)
-        
-        # 5. HTML/JavaScript para Handsontable
-        hot_html = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <script src="https://cdn.jsdelivr.net/npm/handsontable/dist/handsontable.full.min.js"></script>
-            <link href="https://cdn.jsdelivr.net/npm/handsontable/dist/handsontable.full.min.css" rel="stylesheet">
-            <style>
-                body {{
-                    margin: 0;
-                    padding: 0;
-                }}
-                #hot-container {{
-                    width: 100%;
-                    height: 600px;
-                    overflow: hidden;
-                }}
-                .handsontable {{
-                    font-size: 11px;
-                }}
-                .handsontable thead th {{
-                    background-color: #007933 !important;
-                    color: white !important;
-                    font-weight: bold !important;
-                }}
-                /* Estilo para la fila TOTAL */
-                .handsontable tbody tr:last-child td {{
-                    background-color: #e6f3ff !important;
-                    font-weight: bold !important;
-                }}
-                /* Estilo para números */
-                .htRight {{
-                    text-align: right !important;
-                }}
-            </style>
-        </head>
-        <body>
-            <div id="hot-container"></div>
-            
-            <script>
-                // Datos y columnas
-                var data = {json.dumps(data, default=str)};
-                var columns = {json.dumps(columns)};
-                
-                console.log("Datos de rendimiento cargados:", data.length, "registros");
-                console.log("Columnas:", columns.length);
-                
-                // Calcular anchos basados en contenido (mínimo 100px)
-                function calcularAnchosColumnas() {{
-                    var anchos = [];
-                    
-                    // Para cada columna
-                    for (var i = 0; i < columns.length; i++) {{
-                        var maxAncho = 80; // Mínimo 60px
-                        var colName = columns[i].title;
-                        
-                        // Medir encabezado
-                        var anchoEncabezado = colName.length * 8; // Estimación
-                        maxAncho = Math.max(maxAncho, anchoEncabezado);
-                        
-                        // Medir contenido de las primeras filas
-                        for (var j = 0; j < Math.min(data.length, 10); j++) {{
-                            var valor = data[j][colName] || '';
-                            var anchoValor = valor.toString().length * 7; // Estimación
-                            maxAncho = Math.max(maxAncho, anchoValor);
-                        }}
-                        
-                        // Limitar máximo a 300px
-                        anchos.push(Math.min(maxAncho, 300));
-                    }}
-                    return anchos;
-                }}
-                
-                var anchosColumnas = calcularAnchosColumnas();
-                console.log("Anchos calculados:", anchosColumnas);
-                
-                // Configurar anchos en las columnas
-                for (var i = 0; i < 4; i++) {{
-                    columns[i].width = anchosColumnas[i];
-                }}
-                for (var i = 4; i < columns.length; i++) {{
-                    columns[i].width = 125;
-                }}
-
-                // Configuración
-                var config = {{
-                    data: data,
-                    columns: columns,
-                    colHeaders: true,
-                    rowHeaders: true,
-                    height: 600,
-                    width: '100%',
-                    stretchH: 'last',
-                    licenseKey: 'non-commercial-and-evaluation',
-                    filters: true,
-                    dropdownMenu: true,
-                    contextMenu: true,
-                    autoWrapRow: true,
-                    wordWrap: true,
-                    columnSorting: true,
-                    manualColumnResize: true,
-                    manualRowResize: true,
-                    // Configuración de formato numérico
-                    numericFormat: {{
-                        pattern: '0,0.00',
-                        culture: 'es-ES'
-                    }}
-                }};
-                
-                // Inicializar
-                var container = document.getElementById('hot-container');
-                var hot = new Handsontable(container, config);
-                
-                // Aplicar alineación derecha a partir de la 4ta columna (índice 3)
-                for (var col = 3; col < hot.countCols(); col++) {{
-                    // Verificar si es columna numérica
-                    var columnConfig = hot.getSettings().columns[col];
-                    if (columnConfig && columnConfig.type === 'numeric') {{
-                        // Aplicar a TODAS las filas de esta columna
-                        for (var row = 0; row < hot.countRows(); row++) {{
-                            hot.setCellMeta(row, col, 'className', 'htRight');
-                        }}
-                    }}
-                }}
-                
-                // Renderizar todas las filas
-                setTimeout(function() {{
-                    hot.render();
-                    console.log("Handsontable de rendimiento renderizado");
-                    
-                    // Aplicar estilo a la última fila (TOTAL)
-                    var totalFilas = hot.countRows();
-                    if (totalFilas > 0) {{
-                        for (var col = 0; col < hot.countCols(); col++) {{
-                            hot.getCellMeta(totalFilas - 1, col).className = 'htRight htBold htHighlight';
-                        }}
-                        hot.render();
-                    }}
-                }}, 100);
-            </script>
-        </body>
-        </html>
-        """
+        # 2. Vista formateada en caché (enteros 1.000 y decimales 1.000,00)
+        decimales_columnas = (
+            ('EXPEDIENTES_DESPACHADOS', 0), ('POTENCIAL_ANUAL', 0),
+            ('SEMANAS_EFECTIVAS', 2), ('RENDIMIENTO_TOTAL', 2), ('RENDIMIENTO_ANUAL', 2),
+            ('RENDIMIENTO_TRIMESTRAL', 2), ('RENDIMIENTO_MENSUAL', 2), ('RENDIMIENTO_SEMANAL', 2),
+        )
+        vista = preparar_vista_rejilla(df_display, calcular_huella_dataframe(df_display), decimales_columnas)
+        
+        # 3. Anchos: las 4 primeras columnas según contenido (80-300 px), el resto 125 px
+        for i, spec in enumerate(vista['columnas']):
+            if i < 4:
+                longitud_valores = max((len(str(valor)) for valor in vista['valores'][i][:10]), default=0)
+                spec['ancho'] = min(max(80, len(spec['titulo']) * 8, longitud_valores * 7), 300)
+            else:
+                spec['ancho'] = 125
         
-        # 6. Mostrar Handsontable
+        # 4. Mostrar la rejilla paginada
         st.subheader("📊 Vista de Rendimiento por Usuario")
-        st.write(f"**Mostrando {len(df_display)} registros - {len(df_display.columns)} columnas**")
+        st.write(f"**Mostrando {vista['total']} registros - {len(vista['columnas'])} columnas**")
         
-        # Mostrar Handsontable
-        components.html(hot_html, height=650, scrolling=False)
+        mostrar_rejilla_paginada(
+            vista, clave="rejilla_rendimiento",
+            fila_total=bool(incluir_totales and total_general)
+        )
         
         # 7. Exportación a Excel y CSV
         st.markdown("---")
@@ -4743,101 +5353,27 @@ elif eleccion == "Análisis del Rendimiento":
                             df_export = pd.concat([df_export, pd.DataFrame([total_general])], ignore_index=True)
                         
                         # Crear Excel con formato
-                        output = io.BytesIO()
-                        
-                        # Usar openpyxl directamente para mejor control
-                        from openpyxl import Workbook
-                        from openpyxl.utils import get_column_letter
-                        from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-                        
-                        wb = Workbook()
-                        ws = wb.active
-                        ws.title = "Rendimiento"
-                        
-                        # Escribir encabezados con formato
-                        header_fill = PatternFill(start_color="007933", end_color="007933", fill_type="solid")
-                        header_font = Font(color="FFFFFF", bold=True)
-                        header_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-                        
-                        for col_num, header in enumerate(df_export.columns, 1):
-                            cell = ws.cell(row=1, column=col_num, value=header)
-                            cell.fill = header_fill
-                            cell.font = header_font
-                            cell.alignment = header_alignment
-                        
-                        # Escribir datos con formato
-                        data_font = Font(size=10)
-                        number_alignment = Alignment(horizontal="right", vertical="center")
-                        text_alignment = Alignment(horizontal="left", vertical="center")
+                        formatos_numero = {
+                            'EXPEDIENTES_DESPACHADOS': '#,##0',
+                            'POTENCIAL_ANUAL': '#,##0',
+                            'SEMANAS_EFECTIVAS': '#,##0.0',
+                        }
+                        for col in ['RENDIMIENTO_TOTAL', 'RENDIMIENTO_ANUAL', 'RENDIMIENTO_TRIMESTRAL',
+                                    'RENDIMIENTO_MENSUAL', 'RENDIMIENTO_SEMANAL']:
+                            formatos_numero[col] = '#,##0.00'
                         
-                        for row_num, row in enumerate(df_export.values, 2):
-                            for col_num, value in enumerate(row, 1):
-                                cell = ws.cell(row=row_num, column=col_num, value=value)
-                                cell.font = data_font
-                                
-                                # Aplicar formato específico según tipo de dato
-                                col_name = df_export.columns[col_num-1]
-                                if col_name in ['EXPEDIENTES_DESPACHADOS', 'POTENCIAL_ANUAL']:
-                                    cell.alignment = number_alignment
-                                    cell.number_format = '#,##0'
-                                elif col_name in ['SEMANAS_EFECTIVAS']:
-                                    cell.alignment = number_alignment
-                                    cell.number_format = '#,##0.0'
-                                elif col_name in ['RENDIMIENTO_TOTAL', 'RENDIMIENTO_ANUAL', 
-                                                'RENDIMIENTO_TRIMESTRAL', 'RENDIMIENTO_MENSUAL', 'RENDIMIENTO_SEMANAL']:
-                                    cell.alignment = number_alignment
-                                    cell.number_format = '#,##0.00'
-                                else:
-                                    cell.alignment = text_alignment
-                        
-                        # Aplicar estilo a la fila TOTAL
-                        if incluir_totales and total_general:
-                            last_row = len(df_export)+1
-                            total_fill = PatternFill(start_color="E6F3FF", end_color="E6F3FF", fill_type="solid")
-                            total_font = Font(bold=True)
-                            
-                            for col_num in range(1, len(df_export.columns) + 1):
-                                cell = ws.cell(row=last_row, column=col_num)
-                                cell.fill = total_fill
-                                cell.font = total_font
-                        
-                        # Ajustar anchos de columna
-                        for col_num, column_title in enumerate(df_export.columns, 1):
-                            max_length = 0
-                            column_letter = get_column_letter(col_num)
-                            
-                            # Calcular longitud máxima del contenido
-                            for row_num in range(1, len(df_export) + 2):  # +2 para encabezados
-                                cell_value = ws.cell(row=row_num, column=col_num).value
-                                if cell_value:
-                                    cell_length = len(str(cell_value))
-                                    max_length = max(max_length, cell_length)
-                            
-                            # Establecer ancho (mínimo 10, máximo 50)
-                            adjusted_width = min(max_length + 2, 50)
-                            ws.column_dimensions[column_letter].width = max(adjusted_width, 10)
-                        
-                        # Aplicar bordes
-                        thin_border = Border(
-                            left=Side(style='thin'),
-                            right=Side(style='thin'),
-                            top=Side(style='thin'),
-                            bottom=Side(style='thin')
+                        contenido_excel = exportar_excel_streaming(
+                            df_export, "Rendimiento",
+                            formatos_numero=formatos_numero,
+                            ancho_minimo=10,
+                            fila_total=bool(incluir_totales and total_general)
                         )
                         
-                        for row in ws.iter_rows(min_row=1, max_row=len(df_export)+1, 
-                                              min_col=1, max_col=len(df_export.columns)):
-                            for cell in row:
-                                cell.border = thin_border
-                        
-                        wb.save(output)
-                        output.seek(0)
-                        
                         # Botón de descarga
                         nombre_completo = f"{nombre}.xlsx"
                         st.download_button(
                             label="⬇️ Descargar Excel",
-                            data=output.read(),
+                            data=contenido_excel,
                             file_name=nombre_completo,
                             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                             key="download_excel_rendimiento"
@@ -4880,7 +5416,7 @@ elif eleccion == "Análisis del Rendimiento":
         return df_display
     
     # =============================================
-    # MOSTRAR TABLA CON HANDSONTABLE
+    # MOSTRAR TABLA EN LA REJILLA
     # =============================================
     
     # Mostrar estadísticas rápidas
@@ -4892,11 +5428,7 @@ elif eleccion == "Análisis del Rendimiento":
     
     with col2:
         # Contar equipos únicos
-        todos_equipos = set()
-        for equipos_str in df_filtrado['EQUIPOS'].dropna():
-            equipos_lista = [eq.strip() for eq in str(equipos_str).split(',')]
-            todos_equipos.update(equipos_lista)
-        st.metric("Equipos únicos", len(todos_equipos))
+        st.metric("Equipos únicos", len(equipos_en_filas(puente_equipos, df_filtrado.index)))
     
     with col3:
         total_despachados = df_filtrado['EXPEDIENTES_DESPACHADOS'].sum() + 6
@@ -4926,7 +5458,7 @@ elif eleccion == "Análisis del Rendimiento":
         else:
             st.metric("Potencial anual conjunto", "0")
     
-    # Mostrar tabla con Handsontable
+    # Mostrar tabla en la rejilla
     df_mostrar = mostrar_rendimiento_con_handsontable(df_filtrado, incluir_totales=True)
     
     # =============================================
@@ -4973,6 +5505,69 @@ elif eleccion == "Análisis del Rendimiento":
             fig_estado.update_layout(height=400)
             st.plotly_chart(fig_estado, use_container_width=True)
     
+    # =============================================
+    # EVOLUCIÓN SEMANAL DE DESPACHOS
+    # =============================================
+    
+    st.markdown("---")
+    st.subheader("📈 Evolución Semanal de Despachos")
+    
+    matriz_semanal = calcular_matriz_despachos_semanales(df, calendario_semanas, obtener_huella_df_combinado())
+    
+    if not df_filtrado.empty and len(matriz_semanal['semanas']) > 0:
+        semanas_serie = matriz_semanal['semanas']
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            # Por defecto, la semana del informe (la última del calendario)
+            semana_referencia = st.select_slider(
+                "📅 Semana de referencia:",
+                options=list(range(len(semanas_serie))),
+                value=len(semanas_serie) - 1,
+                format_func=lambda i: matriz_semanal['etiquetas'][i],
+                key="semana_referencia_evolucion"
+            )
+        with col2:
+            semanas_ventana = st.number_input(
+                "Semanas de la ventana:", min_value=1, max_value=len(semanas_serie), value=min(4, len(semanas_serie)),
+                key="semanas_ventana_evolucion"
+            )
+        with col3:
+            semanas_grafico = st.number_input(
+                "Semanas en la evolución:", min_value=4, max_value=104, value=26,
+                key="semanas_grafico_evolucion"
+            )
+        
+        # Consultas sobre la matriz precalculada (sin recorrer los expedientes)
+        filas = matriz_semanal['usuarios'].get_indexer(df_filtrado['USUARIO'])
+        filas = filas[filas >= 0]
+        despachos_ventana = despachos_en_ventana(matriz_semanal, semana_referencia - semanas_ventana + 1, semana_referencia)[filas]
+        media_movil = media_movil_semanal(matriz_semanal, semanas_ventana)[filas]
+        desde = max(semana_referencia - semanas_grafico + 1, 0)
+        
+        df_evolucion = pd.DataFrame({
+            'USUARIO': matriz_semanal['usuarios'][filas],
+            'DESPACHOS_SEMANALES': matriz_semanal['matriz'][filas, desde:semana_referencia + 1].tolist(),
+            f'MEDIA_MOVIL_{semanas_ventana}_SEM': np.round(media_movil[:, desde:semana_referencia + 1], 2).tolist(),
+            'DESPACHOS_VENTANA': despachos_ventana,
+            'MEDIA_SEMANAL_VENTANA': np.round(despachos_ventana / semanas_ventana, 2),
+        })
+        
+        st.dataframe(
+            df_evolucion,
+            hide_index=True,
+            use_container_width=True,
+            column_config={
+                'DESPACHOS_SEMANALES': st.column_config.BarChartColumn("Despachos por semana", y_min=0),
+                f'MEDIA_MOVIL_{semanas_ventana}_SEM': st.column_config.LineChartColumn(
+                    f"Media móvil ({semanas_ventana} sem.)", y_min=0
+                ),
+                'DESPACHOS_VENTANA': st.column_config.NumberColumn(f"Despachos ({semanas_ventana} sem.)"),
+                'MEDIA_SEMANAL_VENTANA': st.column_config.NumberColumn("Media semanal", format="%.2f"),
+            }
+        )
+    else:
+        st.info("ℹ️ No hay despachos desde el 01/11/2022 para los usuarios filtrados")
+    
     # =============================================
     # INFORMACIÓN ADICIONAL
     # =============================================
@@ -5030,6 +5625,76 @@ elif eleccion == "Informes y Correos":
     
     df_pendientes = df[df["ESTADO"].isin(ESTADOS_PENDIENTES)].copy()
     usuarios_pendientes = df_pendientes["USUARIO"].dropna().unique()
+    
+    # Texto y particiones comunes a los PDFs de usuarios y equipos (una sola vez):
+    # df_pendientes sale de df_combinado, así que su huella basta como clave
+    huella_df = obtener_huella_df_combinado()
+    datos_informes = preparar_datos_informes(df_pendientes, huella_df)
+    
+    # Almacén de informes compartido por el ZIP y el envío de correos:
+    # lo generado en un flujo se reutiliza en el otro mientras no cambien los datos
+    historico_usuarios = st.session_state.get("historico_usuarios", None)
+    huella_informes = (
+        f"{huella_df}_{calcular_huella_dataframe(df_usuarios)}_"
+        f"{calcular_huella_historico_usuarios(historico_usuarios)}_{num_semana}"
+    )
+    almacen = obtener_almacen_informes(huella_informes)
+    
+    # Rango de semanas disponibles (hasta la fecha de los datos)
+    semanas_disponibles = calendario_semanas.semanas
+    
+    def obtener_pdf_usuario(usuario):
+        return almacen.obtener_o_generar(
+            ('pdf_usuario', usuario),
+            lambda: generar_pdf_usuario(usuario, datos_informes, num_semana, fecha_max_str)
+        )
+    
+    def obtener_pdf_equipo(equipo):
+        return almacen.obtener_o_generar(
+            ('pdf_equipo', equipo),
+            lambda: generar_pdf_equipo_prioritarios(equipo, datos_informes, huella_df, num_semana, fecha_max_str)
+        )
+    
+    def obtener_pdf_resumen_kpi():
+        def generar():
+            df_kpis_semanales = almacen.obtener_o_generar(
+                'kpis_semanales',
+                lambda: calcular_kpis_todas_semanas_optimizado(df, semanas_disponibles, FECHA_REFERENCIA, fecha_max)
+            )
+            return generar_pdf_resumen_kpi_optimizado(
+                df_kpis_semanales, 
+                num_semana, 
+                fecha_max_str, 
+                df, 
+                semanas_disponibles, 
+                FECHA_REFERENCIA, 
+                fecha_max
+            )
+        return almacen.obtener_o_generar('pdf_resumen_kpi', generar)
+    
+    def obtener_rendimiento():
+        """(rendimiento por usuario, tabla puente usuario-equipo)"""
+        return almacen.obtener_o_generar(
+            'rendimiento',
+            lambda: calcular_rendimiento_usuarios_agrupado(
+                df, df_usuarios, fecha_max, f"{huella_informes}_{fecha_max}", historico_usuarios
+            )
+        )
+    
+    def obtener_rendimiento_activos():
+        """Rendimiento de los usuarios ACTIVOS (DataFrame vacío si no hay datos)"""
+        if df_usuarios is None or df_usuarios.empty:
+            return pd.DataFrame()
+        df_rendimiento_completo, _ = obtener_rendimiento()
+        if df_rendimiento_completo.empty:
+            return df_rendimiento_completo
+        return df_rendimiento_completo[df_rendimiento_completo['ESTADO'] == 'ACTIVO']
+    
+    def obtener_pdf_rendimiento(df_rendimiento_activos):
+        return almacen.obtener_o_generar(
+            'pdf_rendimiento',
+            lambda: generar_pdf_rendimiento(df_rendimiento_activos, num_semana, fecha_max_str, obtener_rendimiento()[1])
+        )
 
     # NUEVO: Generar también PDFs por equipo (solo prioritarios) y resumen KPI y RENDIMIENTO
     equipos_pendientes = df_pendientes["EQUIPO"].dropna().unique()
@@ -5038,67 +5703,43 @@ elif eleccion == "Informes y Correos":
         if usuarios_pendientes.size == 0:
             st.info("No se encontraron expedientes pendientes para generar informes.")
         else:
+            zip_file_name = f"Informes_Completos_Semana_{num_semana}.zip"
+            
+            # El ZIP se escribe directamente en el directorio temporal de la sesión:
+            # en memoria solo está el PDF que se está añadiendo en cada momento
+            ruta_zip = user_env.get_temp_path(zip_file_name)
+            
             with st.spinner('Generando PDFs y comprimiendo...'):
-                zip_buffer = io.BytesIO()
-
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                # 1. PDFs por usuario (todos los pendientes)
-                for usuario in usuarios_pendientes:
-                    pdf_data = generar_pdf_usuario(usuario, df_pendientes, num_semana, fecha_max_str)
-                    if pdf_data:
-                        file_name = f"{num_semana}{usuario}.pdf"
-                        zip_file.writestr(file_name, pdf_data)
-                
-                # 2. PDFs por equipo (solo expedientes prioritarios)
-                for equipo in equipos_pendientes:
-                    pdf_data = generar_pdf_equipo_prioritarios(equipo, df_pendientes, num_semana, fecha_max_str)
-                    if pdf_data:
-                        file_name = f"{num_semana}{equipo}_PRIORITARIOS.pdf"
-                        zip_file.writestr(file_name, pdf_data)
+                # Los PDF ya van comprimidos: se almacenan sin recomprimir (ZIP_STORED)
+                with zipfile.ZipFile(ruta_zip, 'w', zipfile.ZIP_STORED) as zip_file:
+                    # 1. PDFs por usuario (todos los pendientes)
+                    for usuario in usuarios_pendientes:
+                        pdf_data = obtener_pdf_usuario(usuario)
+                        if pdf_data:
+                            file_name = f"{num_semana}{usuario}.pdf"
+                            zip_file.writestr(file_name, pdf_data)
                 
-                # 3. PDF de resumen de KPIs
-                # Calcular KPIs para la semana actual
-                # columna_fecha = df.columns[13]
-                # df[columna_fecha] = pd.to_datetime(df[columna_fecha], errors='coerce')
-                # fecha_max = df[columna_fecha].max()
+                    # 2. PDFs por equipo (solo expedientes prioritarios)
+                    for equipo in equipos_pendientes:
+                        pdf_data = obtener_pdf_equipo(equipo)
+                        if pdf_data:
+                            file_name = f"{num_semana}{equipo}_PRIORITARIOS.pdf"
+                            zip_file.writestr(file_name, pdf_data)
                 
-                # Crear rango de semanas disponibles
-                fecha_inicio = pd.to_datetime("2022-11-01")
-                semanas_disponibles = pd.date_range(
-                    start=fecha_inicio,
-                    end=fecha_max,
-                    freq='W-FRI'
-                ).tolist()
+                    # 3. PDF de resumen de KPIs (KPIs de todas las semanas)
+                    pdf_resumen = obtener_pdf_resumen_kpi()
+                    if pdf_resumen:
+                        file_name = f"{num_semana}RESUMEN_KPI.pdf"
+                        zip_file.writestr(file_name, pdf_resumen)
                 
-                # Calcular KPIs para todas las semanas
-                df_kpis_semanales = calcular_kpis_todas_semanas_optimizado(df, semanas_disponibles, FECHA_REFERENCIA, fecha_max)
-                
-                # Generar PDF de resumen KPI
-                pdf_resumen = generar_pdf_resumen_kpi_optimizado(
-                    df_kpis_semanales, 
-                    num_semana, 
-                    fecha_max_str, 
-                    df, 
-                    semanas_disponibles, 
-                    FECHA_REFERENCIA, 
-                    fecha_max
-                )
-                if pdf_resumen:
-                    file_name = f"{num_semana}RESUMEN_KPI.pdf"
-                    zip_file.writestr(file_name, pdf_resumen)
-                
-                # 4. NUEVO: PDF de rendimiento por usuario (SOLO ACTIVOS)
-                if df_usuarios is not None and not df_usuarios.empty:
-                    # Calcular datos de rendimiento
-                    with st.spinner("Calculando datos de rendimiento para PDF..."):
-                        df_rendimiento_completo = calcular_rendimiento_usuarios_agrupado(df, df_usuarios, fecha_max)
+                    # 4. NUEVO: PDF de rendimiento por usuario (SOLO ACTIVOS)
+                    if df_usuarios is not None and not df_usuarios.empty:
+                        # Calcular datos de rendimiento
+                        with st.spinner("Calculando datos de rendimiento para PDF..."):
+                            df_rendimiento_activos = obtener_rendimiento_activos()
                     
-                    if not df_rendimiento_completo.empty:
-                        # FILTRAR SOLO USUARIOS ACTIVOS
-                        df_rendimiento_activos = df_rendimiento_completo[df_rendimiento_completo['ESTADO'] == 'ACTIVO']
-                        
                         if not df_rendimiento_activos.empty:
-                            pdf_rendimiento = generar_pdf_rendimiento(df_rendimiento_activos, num_semana, fecha_max_str)
+                            pdf_rendimiento = obtener_pdf_rendimiento(df_rendimiento_activos)
                             if pdf_rendimiento:
                                 file_name = f"{num_semana}RENDIMIENTO_USUARIOS_ACTIVOS.pdf"
                                 zip_file.writestr(file_name, pdf_rendimiento)
@@ -5106,17 +5747,42 @@ elif eleccion == "Informes y Correos":
                         else:
                             st.warning("⚠️ No hay usuarios activos para generar PDF de rendimiento")
 
-            zip_buffer.seek(0)
-            zip_file_name = f"Informes_Completos_Semana_{num_semana}.zip"
+            # El ZIP queda en disco (directorio de la sesión) y solo se lee al pulsar la descarga;
+            # 'ignore' evita la reejecución, que haría desaparecer el botón
             st.download_button(
                 label=f"⬇️ Descargar {len(usuarios_pendientes)} Informes PDF + Equipos + Resumen KPI + Rendimiento (ZIP)",
-                data=zip_buffer.read(),
+                data=contenido_diferido(ruta_zip),
                 file_name=zip_file_name,
                 mime="application/zip",
                 help="Descarga todos los informes PDF listos.",
+                on_click="ignore",
                 key='pdf_download_button_completo'
             )
 
+    # Excel de todos los pendientes de cada equipo (para los jefes de equipo)
+    if st.button(f"📊 Generar {len(equipos_pendientes)} Excel de Pendientes por Equipo", key="generar_excel_equipos"):
+        if equipos_pendientes.size == 0:
+            st.info("No se encontraron expedientes pendientes para generar los Excel por equipo.")
+        else:
+            with st.spinner('Generando Excel por equipo...'):
+                archivo_zip, num_libros = generar_zip_excel_equipos(list(equipos_pendientes), datos_informes, num_semana)
+            
+            # El ZIP anterior de la sesión ya no tiene botón: se libera
+            zip_anterior = st.session_state.pop('zip_excel_equipos', None)
+            if zip_anterior is not None:
+                zip_anterior.close()
+            st.session_state['zip_excel_equipos'] = archivo_zip
+            
+            # El ZIP spooled solo se lee al pulsar la descarga
+            st.download_button(
+                label=f"⬇️ Descargar {num_libros} Excel de Pendientes por Equipo (ZIP)",
+                data=contenido_diferido(archivo_zip),
+                file_name=f"Excel_Equipos_Semana_{num_semana}.zip",
+                mime="application/zip",
+                on_click="ignore",
+                key='excel_equipos_download_button'
+            )
+
     # SECCIÓN: ENVÍO DE CORREOS INTEGRADA - VERSIÓN CORREGIDA Y MEJORADA
     st.markdown("---")
     st.subheader("📧 Envío de Correos Electrónicos")
@@ -5389,43 +6055,19 @@ elif eleccion == "Informes y Correos":
         pdf_rendimiento = None  # NUEVO: PDF de rendimiento
         
         with st.spinner("Generando resumen KPI..."):
-            # Calcular KPIs para la semana actual
-            columna_fecha = df.columns[13]
-            df[columna_fecha] = pd.to_datetime(df[columna_fecha], errors='coerce')
-            fecha_max = df[columna_fecha].max()
-            
-            fecha_inicio = pd.to_datetime("2022-11-01")
-            semanas_disponibles = pd.date_range(
-                start=fecha_inicio,
-                end=fecha_max,
-                freq='W-FRI'
-            ).tolist()
-            
-            df_kpis_semanales = calcular_kpis_todas_semanas_optimizado(df, semanas_disponibles, FECHA_REFERENCIA, fecha_max)
-            pdf_resumen = generar_pdf_resumen_kpi(
-                df_kpis_semanales, 
-                num_semana, 
-                fecha_max_str, 
-                df, 
-                semanas_disponibles, 
-                FECHA_REFERENCIA, 
-                fecha_max
-            )
+            # Reutiliza el resumen ya generado para el ZIP si existe
+            pdf_resumen = obtener_pdf_resumen_kpi()
         
         # NUEVO: Generar PDF de rendimiento (solo una vez, SOLO ACTIVOS)
         with st.spinner("Generando informe de rendimiento..."):
             if df_usuarios is not None and not df_usuarios.empty:
-                df_rendimiento_completo = calcular_rendimiento_usuarios_agrupado(df, df_usuarios, fecha_max)
-                if not df_rendimiento_completo.empty:
-                    # FILTRAR SOLO USUARIOS ACTIVOS
-                    df_rendimiento_activos = df_rendimiento_completo[df_rendimiento_completo['ESTADO'] == 'ACTIVO']
-                    
-                    if not df_rendimiento_activos.empty:
-                        pdf_rendimiento = generar_pdf_rendimiento(df_rendimiento_activos, num_semana, fecha_max_str)
-                        st.success(f"📊 PDF de rendimiento generado con {len(df_rendimiento_activos)} usuarios activos")
-                    else:
-                        st.warning("⚠️ No hay usuarios activos para generar PDF de rendimiento")
-                        pdf_rendimiento = None
+                df_rendimiento_activos = obtener_rendimiento_activos()
+                if not df_rendimiento_activos.empty:
+                    pdf_rendimiento = obtener_pdf_rendimiento(df_rendimiento_activos)
+                    st.success(f"📊 PDF de rendimiento generado con {len(df_rendimiento_activos)} usuarios activos")
+                else:
+                    st.warning("⚠️ No hay usuarios activos para generar PDF de rendimiento")
+                    pdf_rendimiento = None
         
         total_a_procesar = len(usuarios_para_envio_individual) + len(usuarios_para_resumen_solo)
         
@@ -5434,7 +6076,7 @@ elif eleccion == "Informes y Correos":
             status_text.text(f"📨 Enviando a: {usuario_info['usuario']}")
             
             # Generar PDF individual
-            pdf_individual = generar_pdf_usuario(usuario_info['usuario'], df_pendientes, num_semana, fecha_max_str)
+            pdf_individual = obtener_pdf_usuario(usuario_info['usuario'])
             
             if pdf_individual:
                 archivos_adjuntos = []
@@ -5509,12 +6151,7 @@ elif eleccion == "Informes y Correos":
                 equipos = df_pendientes['EQUIPO'].dropna().unique()
                 
                 for equipo in equipos:
-                    pdf_prioritarios_equipo = generar_pdf_equipo_prioritarios(
-                        equipo, 
-                        df_pendientes, 
-                        num_semana, 
-                        fecha_max_str
-                    )
+                    pdf_prioritarios_equipo = obtener_pdf_equipo(equipo)
                     
                     if pdf_prioritarios_equipo:
                         nombre_prioritarios = f"Expedientes_Prioritarios_{equipo}_Semana_{num_semana}.pdf"
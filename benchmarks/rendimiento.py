@@ -0,0 +1,362 @@
+"""
+Benchmark del motor de rendimiento por usuario.
+
+Genera un conjunto sintético de expedientes y su archivo USUARIOS, mide el bucle por
+usuario anterior frente a calcular_rendimiento_usuarios_agrupado (vectorizado) de app.py
+y comprueba que las columnas RENDIMIENTO_* y POTENCIAL_ANUAL son iguales.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/rendimiento.py
+    python benchmarks/rendimiento.py --expedientes 50000 --usuarios 40
+"""
+import argparse
+import ast
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+RUTA_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'app.py')
+FECHA_MAX = pd.Timestamp('2025-08-08')
+
+# =============================================
+# CARGA DEL MOTOR ACTUAL DESDE app.py
+# =============================================
+def cargar_funcion_app(nombre):
+    """Ejecuta los imports de app.py y solo las definiciones de nivel superior de las que depende `nombre`.
+    
+    Así no se ejecuta la página de Streamlit. Si la función está en caché, se devuelve sin ella.
+    """
+    with open(RUTA_APP, encoding='utf-8') as archivo:
+        fuente = archivo.read()
+    arbol = ast.parse(fuente)
+    
+    definiciones = {}
+    for nodo in arbol.body:
+        if isinstance(nodo, (ast.FunctionDef, ast.ClassDef)):
+            definiciones[nodo.name] = nodo
+        elif isinstance(nodo, ast.Assign):
+            for destino in nodo.targets:
+                if isinstance(destino, ast.Name):
+                    definiciones[destino.id] = nodo
+    
+    # Dependencias transitivas por nombre, en el orden del archivo
+    necesarias = set()
+    pendientes = [nombre]
+    while pendientes:
+        actual = pendientes.pop()
+        if actual in necesarias or actual not in definiciones:
+            continue
+        necesarias.add(actual)
+        pendientes.extend(n.id for n in ast.walk(definiciones[actual]) if isinstance(n, ast.Name))
+    nodos = {id(definiciones[n]): definiciones[n] for n in necesarias}
+    
+    modulo = ast.Module(
+        body=[n for n in arbol.body if isinstance(n, (ast.Import, ast.ImportFrom)) or id(n) in nodos],
+        type_ignores=[]
+    )
+    espacio = {'__file__': RUTA_APP}
+    exec(compile(modulo, RUTA_APP, 'exec'), espacio)
+    funcion = espacio[nombre]
+    return getattr(funcion, '__wrapped__', funcion)
+
+# =============================================
+# MOTOR ANTERIOR (BUCLE POR USUARIO)
+# =============================================
+def calcular_rendimiento_bucle(_df, _df_usuarios, _fecha_max):
+    """Versión anterior de calcular_rendimiento_usuarios_agrupado (bucle por usuario), sin cambios"""
+    
+    # 1. IDENTIFICAR EXPEDIENTES DESPACHADOS
+    fecha_9999 = pd.to_datetime('9999-09-09', errors='coerce')
+    fecha_inicio_totales = datetime(2022, 11, 1)
+    
+    # Expedientes con FECHA RESOLUCIÓN real (distinta de 9999 y no nula)
+    mask_despachados_reales = (
+        _df['FECHA RESOLUCIÓN'].notna() & 
+        (_df['FECHA RESOLUCIÓN'] != fecha_9999) &
+        (_df['FECHA RESOLUCIÓN'] >= fecha_inicio_totales) &
+        (_df['FECHA RESOLUCIÓN'] <= _fecha_max)
+    )
+    
+    # Expedientes CERRADOS con FECHA RESOLUCIÓN = 9999-09-09 o vacía
+    mask_despachados_cerrados = (
+        (_df['ESTADO'] == 'Cerrado') &
+        (_df['FECHA RESOLUCIÓN'].isna() | (_df['FECHA RESOLUCIÓN'] == fecha_9999)) &
+        _df['FECHA CIERRE'].notna() &
+        (_df['FECHA CIERRE'] >= fecha_inicio_totales) &
+        (_df['FECHA CIERRE'] <= _fecha_max)
+    )
+    
+    mask_despachados = mask_despachados_reales | mask_despachados_cerrados
+    df_despachados = _df[mask_despachados].copy()
+    
+    # 2. CALCULAR DESPACHADOS POR USUARIO (agrupando todos los equipos)
+    if 'USUARIO' not in df_despachados.columns:
+        st.error("❌ No se encuentra la columna USUARIO en los datos")
+        return pd.DataFrame()
+        
+    despachados_por_usuario = df_despachados.groupby('USUARIO').size().reset_index(name='EXPEDIENTES_DESPACHADOS')
+    
+    # 3. OBTENER EQUIPOS POR USUARIO (para mostrar en la tabla)
+    equipos_por_usuario = df_despachados.groupby('USUARIO')['EQUIPO'].apply(
+        lambda x: ', '.join(sorted(set(x.dropna().astype(str))))
+    ).reset_index(name='EQUIPOS')
+    
+    # 4. PREPARAR DATOS DE USUARIOS
+    usuarios_data = []
+    
+    # Verificar columnas en el archivo de usuarios
+    columnas_usuarios = _df_usuarios.columns.tolist()
+    st.info(f"📋 Columnas en archivo USUARIOS: {', '.join(columnas_usuarios)}")
+    
+    # Buscar nombres alternativos para las columnas
+    columna_usuario = None
+    columna_fecha_inicio = None
+    columna_fecha_fin = None
+    columna_semanas_baja = None
+    
+    # Mapeo de posibles nombres de columnas
+    mapeo_columnas = {
+        'usuario': ['USUARIOS', 'USUARIO', 'NOMBRE', 'NOMBRE USUARIO'],
+        'fecha_inicio': ['FECHA INICIO', 'INICIO', 'FECHA_ALTA', 'ALTA'],
+        'fecha_fin': ['FECHA FIN', 'FIN', 'FECHA_BAJA', 'BAJA', 'FECHA SALIDA'],
+        'semanas_baja': ['SEMANAS DE BAJA', 'SEMANAS_BAJA', 'BAJAS', 'DIAS BAJA']
+    }
+    
+    for col_tipo, posibles_nombres in mapeo_columnas.items():
+        for nombre in posibles_nombres:
+            if nombre in _df_usuarios.columns:
+                if col_tipo == 'usuario':
+                    columna_usuario = nombre
+                elif col_tipo == 'fecha_inicio':
+                    columna_fecha_inicio = nombre
+                elif col_tipo == 'fecha_fin':
+                    columna_fecha_fin = nombre
+                elif col_tipo == 'semanas_baja':
+                    columna_semanas_baja = nombre
+                break
+    
+    if not columna_usuario:
+        st.error("❌ No se encuentra la columna de usuarios en el archivo USUARIOS")
+        st.info("💡 Las columnas disponibles son: " + ", ".join(columnas_usuarios))
+        return pd.DataFrame()
+    
+    st.success(f"✅ Columna de usuario identificada: {columna_usuario}")
+    
+    for _, usuario_row in _df_usuarios.iterrows():
+        usuario_nombre = usuario_row[columna_usuario]
+        
+        # Obtener fechas con nombres alternativos
+        fecha_inicio = usuario_row.get(columna_fecha_inicio, None) if columna_fecha_inicio else None
+        fecha_fin = usuario_row.get(columna_fecha_fin, None) if columna_fecha_fin else None
+        semanas_baja = usuario_row.get(columna_semanas_baja, 0) if columna_semanas_baja else 0
+        
+        # Determinar estado
+        if pd.isna(fecha_fin) or str(fecha_fin).strip() == '':
+            estado = "ACTIVO"
+        else:
+            try:
+                fecha_fin_dt = pd.to_datetime(fecha_fin, errors='coerce')
+                if pd.isna(fecha_fin_dt) or fecha_fin_dt > _fecha_max:
+                    estado = "ACTIVO"
+                else:
+                    estado = "INACTIVO"
+            except:
+                estado = "ACTIVO"
+        
+        usuarios_data.append({
+            'USUARIO': usuario_nombre,
+            'FECHA_INICIO': fecha_inicio,
+            'FECHA_FIN': fecha_fin,
+            'SEMANAS_BAJA': semanas_baja,
+            'ESTADO': estado
+        })
+    
+    df_usuarios_info = pd.DataFrame(usuarios_data)
+    
+    # 5. COMBINAR DATOS Y CALCULAR INDICADORES POR USUARIO
+    resultados = []
+    
+    for _, row in despachados_por_usuario.iterrows():
+        usuario = row['USUARIO']
+        expedientes_despachados = row['EXPEDIENTES_DESPACHADOS']
+        
+        # Obtener equipos del usuario (para mostrar)
+        equipos_usuario = equipos_por_usuario[equipos_por_usuario['USUARIO'] == usuario]
+        equipos_str = equipos_usuario['EQUIPOS'].iloc[0] if not equipos_usuario.empty else "Sin equipo"
+        
+        # Buscar información del usuario
+        usuario_info = None
+        if not df_usuarios_info.empty:
+            usuario_match = df_usuarios_info[df_usuarios_info['USUARIO'] == usuario]
+            if not usuario_match.empty:
+                usuario_info = usuario_match.iloc[0]
+        
+        # CALCULAR SEMANAS EFECTIVAS (UNA SOLA VEZ POR USUARIO)
+        semanas_efectivas = 1
+        estado = "INACTIVO"  # Por defecto si no se encuentra en usuarios
+        
+        if usuario_info is not None:
+            # Usuario encontrado en archivo USUARIOS
+            fecha_inicio = pd.to_datetime(usuario_info['FECHA_INICIO'], errors='coerce')
+            fecha_fin = pd.to_datetime(usuario_info['FECHA_FIN'], errors='coerce')
+            semanas_baja = float(usuario_info['SEMANAS_BAJA']) if pd.notna(usuario_info['SEMANAS_BAJA']) and str(usuario_info['SEMANAS_BAJA']).strip() != '' else 0
+            estado = usuario_info['ESTADO']
+            
+            # Calcular fecha fin efectiva
+            fecha_fin_efectiva = fecha_fin if pd.notna(fecha_fin) and fecha_fin <= _fecha_max else _fecha_max
+            
+            # Calcular semanas efectivas de trabajo
+            fecha_inicio_efectiva = max(fecha_inicio, fecha_inicio_totales) if pd.notna(fecha_inicio) else fecha_inicio_totales
+            
+            if pd.notna(fecha_inicio_efectiva):
+                dias_totales = (fecha_fin_efectiva - fecha_inicio_efectiva).days
+                semanas_totales = max(dias_totales / 7, 0)
+                semanas_efectivas = max(semanas_totales - semanas_baja, 0)
+        
+        # CALCULAR RENDIMIENTOS POR PERÍODOS
+        
+        # Definir períodos
+        fecha_inicio_anio = _fecha_max - timedelta(days=365)
+        fecha_inicio_trimestre = _fecha_max - timedelta(days=90)
+        fecha_inicio_mes = _fecha_max - timedelta(days=30)
+        fecha_inicio_semana = _fecha_max - timedelta(days=7)
+        
+        # Ajustar fechas de inicio según fecha_inicio del usuario
+        if usuario_info is not None and pd.notna(usuario_info['FECHA_INICIO']):
+            fecha_inicio_usuario = pd.to_datetime(usuario_info['FECHA_INICIO'])
+            fecha_inicio_anio = max(fecha_inicio_anio, fecha_inicio_usuario)
+            fecha_inicio_trimestre = max(fecha_inicio_trimestre, fecha_inicio_usuario)
+            fecha_inicio_mes = max(fecha_inicio_mes, fecha_inicio_usuario)
+            fecha_inicio_semana = max(fecha_inicio_semana, fecha_inicio_usuario)
+        
+        # Último año
+        despachados_ultimo_anio = len(df_despachados[
+            (df_despachados['USUARIO'] == usuario) & 
+            (estado == 'ACTIVO') &
+            (df_despachados['FECHA RESOLUCIÓN'] >= fecha_inicio_anio) &
+            (df_despachados['FECHA RESOLUCIÓN'] <= _fecha_max)
+        ])
+        semanas_anio = min(52, ((_fecha_max - fecha_inicio_anio).days / 7)) if fecha_inicio_anio < _fecha_max else 0
+        rendimiento_anual = despachados_ultimo_anio / semanas_anio if semanas_anio > 0 else 0
+        
+        # NUEVO: POTENCIAL ANUAL (Rendimiento anual * 52 semanas)
+        potencial_anual = rendimiento_anual * 52
+        
+        # Últimos tres meses
+        despachados_trimestre = len(df_despachados[
+            (df_despachados['USUARIO'] == usuario) & 
+            (estado == 'ACTIVO') &
+            (df_despachados['FECHA RESOLUCIÓN'] >= fecha_inicio_trimestre) &
+            (df_despachados['FECHA RESOLUCIÓN'] <= _fecha_max)
+        ])
+        semanas_trimestre = min(13, ((_fecha_max - fecha_inicio_trimestre).days / 7)) if fecha_inicio_trimestre < _fecha_max else 0
+        rendimiento_trimestral = despachados_trimestre / semanas_trimestre if semanas_trimestre > 0 else 0
+        
+        # Último mes
+        despachados_mes = len(df_despachados[
+            (df_despachados['USUARIO'] == usuario) & 
+            (estado == 'ACTIVO') &
+            (df_despachados['FECHA RESOLUCIÓN'] >= fecha_inicio_mes) &
+            (df_despachados['FECHA RESOLUCIÓN'] <= _fecha_max)
+        ])
+        semanas_mes = min(4, ((_fecha_max - fecha_inicio_mes).days / 7)) if fecha_inicio_mes < _fecha_max else 0
+        rendimiento_mensual = despachados_mes / semanas_mes if semanas_mes > 0 else 0
+        
+        # Última semana
+        despachados_semana = len(df_despachados[
+            (df_despachados['USUARIO'] == usuario) & 
+            (estado == 'ACTIVO') &
+            (df_despachados['FECHA RESOLUCIÓN'] >= fecha_inicio_semana) &
+            (df_despachados['FECHA RESOLUCIÓN'] <= _fecha_max)
+        ])
+        semanas_semana = min(1, ((_fecha_max - fecha_inicio_semana).days / 7)) if fecha_inicio_semana < _fecha_max else 0
+        rendimiento_semanal = despachados_semana / semanas_semana if semanas_semana > 0 else 0
+        
+        # Rendimiento total
+        rendimiento_total = expedientes_despachados / semanas_efectivas if semanas_efectivas > 0 else 0
+        
+        resultados.append({
+            'USUARIO': usuario,
+            'EQUIPOS': equipos_str,  # Mostrar todos los equipos en una columna
+            'ESTADO': estado,
+            'EXPEDIENTES_DESPACHADOS': expedientes_despachados,
+            'SEMANAS_EFECTIVAS': round(semanas_efectivas, 1),
+            'RENDIMIENTO_TOTAL': round(rendimiento_total, 2),
+            'RENDIMIENTO_ANUAL': round(rendimiento_anual, 2),
+            'POTENCIAL_ANUAL': round(potencial_anual, 1),  # NUEVA COLUMNA
+            'RENDIMIENTO_TRIMESTRAL': round(rendimiento_trimestral, 2),
+            'RENDIMIENTO_MENSUAL': round(rendimiento_mensual, 2),
+            'RENDIMIENTO_SEMANAL': round(rendimiento_semanal, 2)
+        })
+    
+    return pd.DataFrame(resultados)
+
+
+# =============================================
+# DATOS SINTÉTICOS
+# =============================================
+def generar_datos(num_expedientes, num_usuarios, semilla):
+    """Expedientes con resoluciones, cierres con fecha 9999-09-09 y usuarios con altas y bajas"""
+    rng = np.random.default_rng(semilla)
+    usuarios = [f"USUARIO{i:03d}" for i in range(num_usuarios)]
+    
+    inicio = pd.Timestamp('2022-11-01') + pd.to_timedelta(rng.integers(0, 1000, num_expedientes), unit='D')
+    resolucion = pd.Series(inicio + pd.to_timedelta(rng.integers(5, 300, num_expedientes), unit='D'))
+    resolucion = resolucion.where(resolucion <= FECHA_MAX)
+    resolucion[rng.random(num_expedientes) < 0.05] = pd.Timestamp('9999-09-09')
+    cierre = resolucion.where(rng.random(num_expedientes) < 0.7)
+    cierre = cierre.where(cierre != pd.Timestamp('9999-09-09'), pd.Series(inicio) + pd.Timedelta(days=50))
+    
+    df = pd.DataFrame({
+        'EQUIPO': rng.choice([f"EQUIPO{i}" for i in range(6)], num_expedientes),
+        'USUARIO': rng.choice(usuarios, num_expedientes),
+        'ESTADO': np.where(cierre.notna() & (rng.random(num_expedientes) < 0.95), 'Cerrado', 'Abierto'),
+        'FECHA RESOLUCIÓN': resolucion.to_numpy(),
+        'FECHA CIERRE': cierre.to_numpy(),
+    })
+    
+    # Un usuario sin expedientes y ~20% de usuarios dados de baja
+    df_usuarios = pd.DataFrame({
+        'USUARIOS': usuarios + ['SIN EXPEDIENTES'],
+        'FECHA INICIO': pd.Timestamp('2022-06-01') + pd.to_timedelta(rng.integers(0, 800, num_usuarios + 1), unit='D'),
+        'FECHA FIN': pd.Series(pd.Timestamp('2025-01-01'), index=range(num_usuarios + 1)).where(rng.random(num_usuarios + 1) < 0.2),
+        'SEMANAS DE BAJA': rng.integers(0, 5, num_usuarios + 1),
+    })
+    return df, df_usuarios
+
+def medir(funcion, *argumentos):
+    inicio = time.perf_counter()
+    resultado = funcion(*argumentos)
+    return resultado, time.perf_counter() - inicio
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--expedientes', type=int, default=500_000)
+    parser.add_argument('--usuarios', type=int, default=200)
+    parser.add_argument('--semilla', type=int, default=1)
+    opciones = parser.parse_args()
+    
+    df, df_usuarios = generar_datos(opciones.expedientes, opciones.usuarios, opciones.semilla)
+    calcular_rendimiento_vectorizado = cargar_funcion_app('calcular_rendimiento_usuarios_agrupado')
+    
+    (df_nuevo, _), tiempo_nuevo = medir(calcular_rendimiento_vectorizado, df, df_usuarios, FECHA_MAX, 'benchmark')
+    df_anterior, tiempo_anterior = medir(calcular_rendimiento_bucle, df, df_usuarios, FECHA_MAX)
+    
+    columnas = [c for c in df_anterior.columns if c.startswith('RENDIMIENTO_') or c == 'POTENCIAL_ANUAL']
+    pd.testing.assert_frame_equal(
+        df_nuevo.sort_values('USUARIO').set_index('USUARIO')[columnas],
+        df_anterior.sort_values('USUARIO').set_index('USUARIO')[columnas],
+        check_dtype=False
+    )
+    
+    print(f"{opciones.expedientes:,} expedientes, {opciones.usuarios} usuarios")
+    print(f"Bucle por usuario: {tiempo_anterior:8.2f} s")
+    print(f"Vectorizado:       {tiempo_nuevo:8.2f} s  (x{tiempo_anterior / tiempo_nuevo:.0f})")
+    print(f"Columnas iguales:  {', '.join(columnas)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,424 @@
+// Rejilla paginada: Streamlit envía la vista en columnas y por ventanas de filas;
+// al desplazarse se pide la ventana visible que aún no se ha recibido.
+// Ordenar y filtrar por columna se piden al servidor (el navegador no tiene todas las filas).
+// La rejilla es propia y sin dependencias: scroll virtual, orden por cabecera,
+// fila de filtros y menú contextual.
+var args = null;
+var vistaActual = null;
+var baseActual = null;
+var estadoServidor = {orden: null, filtros: []};
+var filas = [];
+var ventanasCargadas = {};
+var ventanaPendiente = null;
+var temporizadorScroll = null;
+var rejilla = null;
+
+var ALTO_FILA = 22;
+// Prefijos de la fila de filtros → condiciones que aplica el servidor
+var OPERADORES_FILTRO = [[">=", "gte"], ["<=", "lte"], [">", "gt"], ["<", "lt"], ["=", "eq"]];
+
+function enviarMensaje(tipo, datos) {
+    var mensaje = {isStreamlitMessage: true, type: tipo};
+    for (var clave in datos) {
+        mensaje[clave] = datos[clave];
+    }
+    window.parent.postMessage(mensaje, "*");
+}
+
+function pedirVentana(inicio) {
+    if (ventanasCargadas[inicio] || ventanaPendiente === inicio) {
+        return;
+    }
+    ventanaPendiente = inicio;
+    enviarPeticion(vistaActual, inicio);
+}
+
+function enviarPeticion(vista, inicio) {
+    enviarMensaje("streamlit:setComponentValue", {
+        value: {
+            vista: vista,
+            base: baseActual,
+            inicio: inicio,
+            orden: estadoServidor.orden,
+            filtros: estadoServidor.filtros
+        },
+        dataType: "json"
+    });
+}
+
+// Nuevo orden o filtros: el servidor responde con otra vista (desde la primera fila)
+function pedirVistaOrdenada() {
+    ventanaPendiente = null;
+    enviarPeticion(null, 0);
+}
+
+// Pasa la ventana recibida (columnas) a filas de la rejilla
+function recibirVentana() {
+    var numColumnas = args.datos.length;
+    var numFilas = numColumnas ? args.datos[0].length : 0;
+    for (var j = 0; j < numFilas; j++) {
+        var fila = new Array(numColumnas);
+        for (var c = 0; c < numColumnas; c++) {
+            fila[c] = args.datos[c][j];
+        }
+        filas[args.inicio + j] = fila;
+    }
+    ventanasCargadas[args.inicio] = true;
+    if (ventanaPendiente === args.inicio) {
+        ventanaPendiente = null;
+    }
+}
+
+function comprobarVentanaVisible() {
+    if (!rejilla || args.total === 0) {
+        return;
+    }
+    var rango = rejilla.filasVisibles();
+    var tam = args.filas_ventana;
+    for (var inicio = Math.floor(rango[0] / tam) * tam; inicio <= rango[1]; inicio += tam) {
+        if (!ventanasCargadas[inicio]) {
+            pedirVentana(inicio);
+            return;
+        }
+    }
+}
+
+function alDesplazar() {
+    clearTimeout(temporizadorScroll);
+    temporizadorScroll = setTimeout(comprobarVentanaVisible, 150);
+}
+
+function esFilaTotal(fila) {
+    return args.fila_total && fila === args.total - 1;
+}
+
+// === REJILLA (SCROLL VIRTUAL, SIN DEPENDENCIAS) ===
+function Rejilla(contenedor) {
+    var marco = document.createElement("div");
+    marco.className = "rejilla";
+    marco.style.height = args.altura + "px";
+
+    var tabla = document.createElement("table");
+    var colgroup = document.createElement("colgroup");
+    var cabecera = document.createElement("thead");
+    var filaCabecera = document.createElement("tr");
+    var filaFiltros = document.createElement("tr");
+    filaFiltros.className = "fila-filtros";
+    var cuerpo = document.createElement("tbody");
+
+    var anchoTotal = 50;
+    var columnaNumero = document.createElement("col");
+    columnaNumero.style.width = "50px";
+    colgroup.appendChild(columnaNumero);
+    filaCabecera.appendChild(document.createElement("th"));
+    filaFiltros.appendChild(document.createElement("th"));
+    var cabeceras = [];
+    var entradasFiltro = [];
+    args.columnas.forEach(function (col, indice) {
+        var ancho = col.ancho || Math.min(Math.max(col.titulo.length * 8, 80), 300);
+        var columna = document.createElement("col");
+        columna.style.width = ancho + "px";
+        colgroup.appendChild(columna);
+        anchoTotal += ancho;
+
+        var th = document.createElement("th");
+        th.title = col.titulo;
+        th.className = "ordenable";
+        th.addEventListener("click", function () {
+            alternarOrden(indice);
+        });
+        filaCabecera.appendChild(th);
+        cabeceras.push(th);
+
+        var thFiltro = document.createElement("th");
+        var entrada = document.createElement("input");
+        entrada.type = "search";
+        entrada.placeholder = "Filtrar…";
+        entrada.title = "Texto contenido, o >, >=, <, <=, = seguido de un valor";
+        entrada.value = textoFiltro(indice);
+        entrada.addEventListener("input", cambiarFiltros);
+        thFiltro.appendChild(entrada);
+        filaFiltros.appendChild(thFiltro);
+        entradasFiltro.push(entrada);
+    });
+    tabla.style.width = anchoTotal + "px";
+
+    // Clic en la cabecera: ascendente, descendente y sin orden (lo aplica el servidor)
+    function alternarOrden(indice) {
+        var orden = estadoServidor.orden;
+        if (!orden || orden.columna !== indice) {
+            estadoServidor.orden = {columna: indice, descendente: false};
+        } else if (!orden.descendente) {
+            estadoServidor.orden = {columna: indice, descendente: true};
+        } else {
+            estadoServidor.orden = null;
+        }
+        pintarCabeceras();
+        pedirVistaOrdenada();
+    }
+
+    function pintarCabeceras() {
+        var orden = estadoServidor.orden;
+        cabeceras.forEach(function (th, indice) {
+            var marca = orden && orden.columna === indice ? (orden.descendente ? " ▼" : " ▲") : "";
+            th.textContent = args.columnas[indice].titulo + marca;
+        });
+    }
+    pintarCabeceras();
+
+    // Fila de filtros: cada entrada es una condición sobre su columna
+    var temporizadorFiltro = null;
+
+    function condicionFiltro(texto) {
+        texto = texto.trim();
+        for (var k = 0; k < OPERADORES_FILTRO.length; k++) {
+            var simbolo = OPERADORES_FILTRO[k][0];
+            if (texto.indexOf(simbolo) === 0 && texto.length > simbolo.length) {
+                return {nombre: OPERADORES_FILTRO[k][1], args: [texto.slice(simbolo.length).trim()]};
+            }
+        }
+        return {nombre: "contains", args: [texto]};
+    }
+
+    function textoFiltro(indice) {
+        var filtro = estadoServidor.filtros.filter(function (f) {
+            return f.columna === indice;
+        })[0];
+        if (!filtro || !filtro.condiciones.length) {
+            return "";
+        }
+        var condicion = filtro.condiciones[0];
+        var simbolo = OPERADORES_FILTRO.filter(function (o) {
+            return o[1] === condicion.nombre;
+        })[0];
+        return (simbolo ? simbolo[0] : "") + (condicion.args && condicion.args.length ? condicion.args[0] : "");
+    }
+
+    function cambiarFiltros() {
+        clearTimeout(temporizadorFiltro);
+        temporizadorFiltro = setTimeout(function () {
+            estadoServidor.filtros = [];
+            entradasFiltro.forEach(function (entrada, indice) {
+                if (entrada.value.trim()) {
+                    estadoServidor.filtros.push({
+                        columna: indice,
+                        condiciones: [condicionFiltro(entrada.value)]
+                    });
+                }
+            });
+            pedirVistaOrdenada();
+        }, 400);
+    }
+
+    // Menú contextual: copiar y ordenar/limpiar sin pasar por la cabecera
+    var menu = document.createElement("div");
+    menu.className = "menu-contextual";
+    menu.hidden = true;
+    document.body.appendChild(menu);
+
+    function copiarTexto(texto) {
+        if (navigator.clipboard && window.isSecureContext) {
+            navigator.clipboard.writeText(texto);
+            return;
+        }
+        var area = document.createElement("textarea");
+        area.value = texto;
+        document.body.appendChild(area);
+        area.select();
+        document.execCommand("copy");
+        area.remove();
+    }
+
+    function textoFila(fila) {
+        return args.columnas.map(function (col, c) {
+            return textoCelda((filas[fila] || [])[c], col);
+        }).join("\t");
+    }
+
+    function mostrarMenu(evento, fila, columna) {
+        var opciones = [
+            ["Copiar celda", function () {
+                copiarTexto(textoCelda((filas[fila] || [])[columna], args.columnas[columna]));
+            }],
+            ["Copiar fila", function () {
+                copiarTexto(textoFila(fila));
+            }],
+            ["Ordenar ascendente", function () {
+                estadoServidor.orden = {columna: columna, descendente: false};
+                pintarCabeceras();
+                pedirVistaOrdenada();
+            }],
+            ["Ordenar descendente", function () {
+                estadoServidor.orden = {columna: columna, descendente: true};
+                pintarCabeceras();
+                pedirVistaOrdenada();
+            }],
+            ["Quitar orden y filtros", function () {
+                estadoServidor = {orden: null, filtros: []};
+                entradasFiltro.forEach(function (entrada) {
+                    entrada.value = "";
+                });
+                pintarCabeceras();
+                pedirVistaOrdenada();
+            }]
+        ];
+        menu.replaceChildren();
+        opciones.forEach(function (opcion) {
+            var elemento = document.createElement("div");
+            elemento.textContent = opcion[0];
+            elemento.addEventListener("click", function () {
+                menu.hidden = true;
+                opcion[1]();
+            });
+            menu.appendChild(elemento);
+        });
+        menu.style.left = evento.clientX + "px";
+        menu.style.top = evento.clientY + "px";
+        menu.hidden = false;
+    }
+
+    function cerrarMenu() {
+        menu.hidden = true;
+    }
+    document.addEventListener("click", cerrarMenu);
+
+    cabecera.appendChild(filaCabecera);
+    cabecera.appendChild(filaFiltros);
+    tabla.appendChild(colgroup);
+    tabla.appendChild(cabecera);
+    tabla.appendChild(cuerpo);
+    marco.appendChild(tabla);
+    contenedor.appendChild(marco);
+
+    var formatoNumero = new Intl.NumberFormat("es-ES", {maximumFractionDigits: 0});
+
+    function textoCelda(valor, col) {
+        if (valor === null || valor === undefined) {
+            return "";
+        }
+        if (col.tipo === "numerico" && typeof valor === "number") {
+            return formatoNumero.format(valor);
+        }
+        return String(valor);
+    }
+
+    function filaEspaciadora(alto) {
+        var tr = document.createElement("tr");
+        var td = document.createElement("td");
+        td.colSpan = args.columnas.length + 1;
+        td.style.height = alto + "px";
+        td.style.padding = "0";
+        td.style.border = "none";
+        tr.appendChild(td);
+        return tr;
+    }
+
+    // Solo se crean en el DOM las filas visibles (más un margen)
+    function pintar() {
+        var margen = 20;
+        var primera = Math.max(Math.floor(marco.scrollTop / ALTO_FILA) - margen, 0);
+        var ultima = Math.min(primera + Math.ceil(args.altura / ALTO_FILA) + 2 * margen, args.total);
+
+        var fragmento = document.createDocumentFragment();
+        fragmento.appendChild(filaEspaciadora(primera * ALTO_FILA));
+        for (var i = primera; i < ultima; i++) {
+            var tr = document.createElement("tr");
+            tr.dataset.fila = i;
+            var numero = document.createElement("td");
+            numero.className = "num-fila";
+            numero.textContent = i + 1;
+            tr.appendChild(numero);
+            var fila = filas[i] || [];
+            for (var c = 0; c < args.columnas.length; c++) {
+                var col = args.columnas[c];
+                var td = document.createElement("td");
+                td.textContent = textoCelda(fila[c], col);
+                if (col.tipo === "numerico" || col.alineacion === "derecha") {
+                    td.className = "derecha";
+                }
+                if (esFilaTotal(i)) {
+                    td.className += " fila-total";
+                }
+                tr.appendChild(td);
+            }
+            fragmento.appendChild(tr);
+        }
+        fragmento.appendChild(filaEspaciadora((args.total - ultima) * ALTO_FILA));
+        cuerpo.replaceChildren(fragmento);
+    }
+
+    marco.addEventListener("scroll", function () {
+        window.requestAnimationFrame(pintar);
+        alDesplazar();
+    });
+    cuerpo.addEventListener("contextmenu", function (evento) {
+        var td = evento.target.closest("td");
+        var tr = td && td.parentElement;
+        if (!tr || tr.dataset.fila === undefined || td.cellIndex < 1) {
+            return;
+        }
+        evento.preventDefault();
+        mostrarMenu(evento, Number(tr.dataset.fila), td.cellIndex - 1);
+    });
+    pintar();
+
+    this.filasVisibles = function () {
+        var primera = Math.floor(marco.scrollTop / ALTO_FILA);
+        var ultima = primera + Math.ceil(marco.clientHeight / ALTO_FILA);
+        return [primera, Math.min(ultima, args.total - 1)];
+    };
+    this.refrescar = pintar;
+    this.recargar = function () {
+        marco.scrollTop = 0;
+        pintar();
+    };
+    this.destruir = function () {
+        document.removeEventListener("click", cerrarMenu);
+        menu.remove();
+        contenedor.replaceChildren();
+    };
+}
+
+function crearRejilla() {
+    var contenedor = document.getElementById("contenedor-rejilla");
+    if (rejilla) {
+        rejilla.destruir();
+    }
+    rejilla = new Rejilla(contenedor);
+}
+
+window.addEventListener("message", function (evento) {
+    if (!evento.data || evento.data.type !== "streamlit:render") {
+        return;
+    }
+    args = evento.data.args;
+
+    if (args.vista !== vistaActual) {
+        // Nueva vista: se descarta lo recibido antes
+        vistaActual = args.vista;
+        filas = new Array(args.total);
+        for (var i = 0; i < args.total; i++) {
+            filas[i] = [];
+        }
+        ventanasCargadas = {};
+        ventanaPendiente = null;
+        recibirVentana();
+        if (args.base !== baseActual || !rejilla) {
+            // Otros datos (filtros de la página): rejilla nueva con el orden y filtros que aplicó el servidor
+            baseActual = args.base;
+            estadoServidor = {orden: args.estado.orden, filtros: args.estado.filtros};
+            crearRejilla();
+        } else {
+            // Mismos datos con otro orden o filtros de columna
+            rejilla.recargar();
+        }
+    } else if (!ventanasCargadas[args.inicio]) {
+        recibirVentana();
+        rejilla.refrescar();
+    }
+
+    enviarMensaje("streamlit:setFrameHeight", {height: args.altura + 20});
+    comprobarVentanaVisible();
+});
+
+enviarMensaje("streamlit:componentReady", {apiVersion: 1});